@@ -0,0 +1,124 @@
+"""
+Compares approximate related objects, found through MinHash buckets,
+with the exact ``get_related`` query, for recall and latency.
+
+Usage::
+
+   DJANGO_SETTINGS_MODULE=benchsettings python benchmarks/minhash.py [rows]
+
+The settings must point to a scratch database and have
+``django.contrib.contenttypes``, ``tagging`` and ``tagging.tests`` in
+``INSTALLED_APPS``; ``TAG_MINHASH_BANDS`` and ``TAG_MINHASH_ROWS`` may
+be set there to compare configurations. The posts, tags, tagged items
+and buckets tables are emptied and filled with ``rows`` posts (100000
+by default), each having five tags picked from 1000 with a skewed
+distribution, like real tags.
+
+The recall of a query is the fraction of its top ``K`` results sharing
+at least as many tags with the post as the ``K``-th exact result, so
+that ties don't count as misses.
+"""
+import random
+import sys
+import time
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+
+from tagging import minhash, settings
+from tagging.models import Tag, TagBucket, TaggedItem
+from tagging.tests.models import Post
+
+TAGS = 1000
+TAGS_PER_POST = 5
+BATCH = 10000
+QUERIES = 50
+K = 20
+CANDIDATES = (50, 200, 1000)
+
+def qn(name):
+    return connection.ops.quote_name(name)
+
+def populate(rows):
+    cursor = connection.cursor()
+    for model in (TagBucket, TaggedItem, Post, Tag):
+        cursor.execute('DELETE FROM %s' % qn(model._meta.db_table))
+    tag_ids = [Tag.objects.create(name='tag%04d' % i).pk for i in range(TAGS)]
+    content_type = ContentType.objects.get_for_model(Post)
+
+    random.seed(0)
+    for start in range(1, rows + 1, BATCH):
+        posts, items = [], []
+        for pk in range(start, min(start + BATCH, rows + 1)):
+            tags = set()
+            while len(tags) < TAGS_PER_POST:
+                tags.add(tag_ids[min(int(random.paretovariate(1.2)) - 1, TAGS - 1)
+                                 if random.random() < 0.5
+                                 else random.randrange(TAGS)])
+            posts.append((pk, 'post %d' % pk, ''))
+            items.extend([(tag, content_type.pk, pk) for tag in tags])
+        cursor.executemany('INSERT INTO %s (id, name, tag_ids) VALUES (%%s, %%s, %%s)'
+                           % qn(Post._meta.db_table), posts)
+        cursor.executemany('INSERT INTO %s (tag_id, content_type_id, object_id) VALUES (%%s, %%s, %%s)'
+                           % qn(TaggedItem._meta.db_table), items)
+        transaction.commit_unless_managed()
+        sys.stdout.write('\r%d posts' % min(start + BATCH - 1, rows))
+        sys.stdout.flush()
+    print
+
+    start = time.time()
+    minhash.rebuild(Post)
+    print 'buckets built in %.1f s' % (time.time() - start)
+
+def shared_tags(post, others):
+    tags = set(TaggedItem.objects.filter(object_id=post.pk).values_list('tag', flat=True))
+    counts = {}
+    for object_id, tag_id in TaggedItem.objects.filter(
+            object_id__in=[other.pk for other in others]).values_list('object_id', 'tag'):
+        if tag_id in tags:
+            counts[object_id] = counts.get(object_id, 0) + 1
+    return [counts.get(other.pk, 0) for other in others]
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    result = function(*args, **kwargs)
+    return result, (time.time() - start) * 1000
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or 100000
+    call_command('syncdb', interactive=False, verbosity=0)
+    populate(rows)
+
+    random.seed(1)
+    posts = Post.objects.in_bulk(random.sample(xrange(1, rows + 1), QUERIES)).values()
+    exact = []
+    timings = []
+    for post in posts:
+        related, elapsed = timed(TaggedItem.objects.get_related, post, Post, num=K)
+        scores = shared_tags(post, related)
+        exact.append((scores and scores[-1] or 0, len(scores)))
+        timings.append(elapsed)
+    print '%-16s %10s %12s' % ('query', 'recall', 'median, ms')
+    print '%-16s %10.3f %12.1f' % ('exact', 1.0, median(timings))
+
+    for candidates in CANDIDATES:
+        found = []
+        timings = []
+        for post, (threshold, expected) in zip(posts, exact):
+            related, elapsed = timed(TaggedItem.objects.get_related, post, Post,
+                                     num=K, approximate=True, candidates=candidates)
+            hits = len([score for score in shared_tags(post, related)
+                        if score >= threshold])
+            found.append(float(min(hits, expected)) / max(expected, 1))
+            timings.append(elapsed)
+        print '%-16s %10.3f %12.1f' % ('%d candidates' % candidates,
+                                       sum(found) / len(found), median(timings))
+    print '(%d bands of %d rows)' % (settings.TAG_MINHASH_BANDS, settings.TAG_MINHASH_ROWS)
+
+if __name__ == '__main__':
+    main()
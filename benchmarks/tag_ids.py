@@ -0,0 +1,101 @@
+"""
+Compares filtering by tags through a ``TagIdsField`` with the join of
+the tagged model with tagged items.
+
+Usage::
+
+   DJANGO_SETTINGS_MODULE=benchsettings python benchmarks/tag_ids.py [rows]
+
+The settings must point to a scratch PostgreSQL database and have
+``django.contrib.contenttypes``, ``tagging`` and ``tagging.tests`` in
+``INSTALLED_APPS``. The posts, tags and tagged items tables are emptied
+and filled with ``rows`` posts (1000000 by default), each having five
+tags picked from 1000 with a skewed distribution, like real tags.
+"""
+import random
+import sys
+import time
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+
+from tagging import settings
+from tagging.models import Tag, TaggedItem
+from tagging.tests.models import Post
+from tagging.utils import format_tag_ids
+
+TAGS = 1000
+TAGS_PER_POST = 5
+BATCH = 10000
+REPEAT = 5
+
+def qn(name):
+    return connection.ops.quote_name(name)
+
+def populate(rows):
+    cursor = connection.cursor()
+    for model in (TaggedItem, Post, Tag):
+        cursor.execute('TRUNCATE %s CASCADE' % qn(model._meta.db_table))
+    tag_ids = [Tag.objects.create(name='tag%04d' % i).pk for i in range(TAGS)]
+    content_type = ContentType.objects.get_for_model(Post)
+
+    random.seed(0)
+    for start in range(1, rows + 1, BATCH):
+        posts, items = [], []
+        for pk in range(start, min(start + BATCH, rows + 1)):
+            tags = set()
+            while len(tags) < TAGS_PER_POST:
+                tags.add(tag_ids[min(int(random.paretovariate(1.2)) - 1, TAGS - 1)
+                                 if random.random() < 0.5
+                                 else random.randrange(TAGS)])
+            posts.append((pk, 'post %d' % pk, format_tag_ids(tags)))
+            items.extend([(tag, content_type.pk, pk) for tag in tags])
+        cursor.executemany('INSERT INTO %s (id, name, tag_ids) VALUES (%%s, %%s, %%s)'
+                           % qn(Post._meta.db_table), posts)
+        cursor.executemany('INSERT INTO %s (tag_id, content_type_id, object_id) VALUES (%%s, %%s, %%s)'
+                           % qn(TaggedItem._meta.db_table), items)
+        transaction.commit_unless_managed()
+        sys.stdout.write('\r%d posts' % min(start + BATCH - 1, rows))
+        sys.stdout.flush()
+    print
+
+    cursor.execute("CREATE INDEX tagging_tests_post_tag_ids ON %s USING gin "
+                   "((string_to_array(trim(both ',' from tag_ids), ',')::integer[]))"
+                   % qn(Post._meta.db_table))
+    for model in (Post, TaggedItem, Tag):
+        cursor.execute('ANALYZE %s' % qn(model._meta.db_table))
+    transaction.commit_unless_managed()
+
+def measure(tags):
+    timings = []
+    for i in range(REPEAT):
+        start = time.time()
+        ids = list(TaggedItem.objects.get_by_model(Post, tags).values_list('pk', flat=True))
+        timings.append(time.time() - start)
+    timings.sort()
+    return len(ids), timings[len(timings) / 2] * 1000
+
+def main():
+    rows = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+    call_command('syncdb', interactive=False, verbosity=0)
+    populate(rows)
+
+    by_usage = list(Tag.objects.usage_for_model(Post, counts=True))
+    by_usage.sort(key=lambda tag: -tag.count)
+    lookups = (
+        ('most used tag', [by_usage[0]]),
+        ('rare tag', [by_usage[-1]]),
+        ('two most used tags', by_usage[:2]),
+        ('three common tags', by_usage[:5:2]),
+    )
+    print '%-20s %10s %12s %12s' % ('lookup', 'objects', 'join, ms', 'tag_ids, ms')
+    for name, tags in lookups:
+        settings.TAG_IDS_LOOKUPS = False
+        count, join = measure(tags)
+        settings.TAG_IDS_LOOKUPS = True
+        count, contained = measure(tags)
+        print '%-20s %10d %12.1f %12.1f' % (name, count, join, contained)
+
+if __name__ == '__main__':
+    main()
@@ -13,17 +13,25 @@ class AlreadyRegistered(Exception):
 registry = []
 
 def register(model, tag_descriptor_attr='tags',
-             tagged_item_manager_attr='tagged'):
+             tagged_item_manager_attr='tagged', generic_relation_attr=None):
     """
     Sets the given model class up for working with tags.
+
+    If ``generic_relation_attr`` is given, a ``GenericRelation`` to
+    ``TaggedItem`` is added to the model under that name.
     """
     if model in registry:
         raise AlreadyRegistered(
             _('The model %s has already been registered.') % model.__name__)
     registry.append(model)
 
+    # Add generic relation to tagged items
+    if generic_relation_attr is not None:
+        from tagging.generic import add_tagged_items_relation
+        add_tagged_items_relation(model, generic_relation_attr)
+
     # Add tag descriptor
-    setattr(model, tag_descriptor_attr, TagDescriptor())
+    setattr(model, tag_descriptor_attr, TagDescriptor(generic_relation_attr))
 
     # Add custom manager
     ModelTaggedItemManager().contribute_to_class(model,
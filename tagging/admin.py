@@ -1,11 +1,146 @@
+from django import forms
 from django.contrib import admin
-from tagging.models import Tag, TaggedItem, Synonym
+from django.contrib.admin import helpers
+from django.db import transaction
+from django.db.models import Count
+from django.shortcuts import render_to_response
+from django.template import RequestContext
+from tagging.models import Tag, TaggedItem, Synonym, TagJob
 from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
 from tagging import settings
 from tagging.forms import TagAdminForm
+from tagging.jobs import enqueue
+from tagging.generic import fetch_content_objects, fetch_synonyms, \
+                            fetch_translations, prefetch_queryset
 
-admin.site.register(TaggedItem)
+# Changelist querysets below load everything which is displayed in bulk,
+# so a page costs the same number of queries whatever its size.
+# Usage counts are distinct, since searching synonyms or translations
+# joins them and multiplies the rows of tagged items.
+
+def _tag_translations(objects):
+    if settings.MULTILINGUAL_TAGS:
+        fetch_translations([obj.tag for obj in objects])
+
+class TaggedItemAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'tag', 'content_type')
+
+    def queryset(self, request):
+        qs = super(TaggedItemAdmin, self).queryset(request)
+        return prefetch_queryset(qs.select_related('tag'),
+                                 fetch_content_objects, _tag_translations)
+
+admin.site.register(TaggedItem, TaggedItemAdmin)
+
+class _MergeForm(forms.Form):
+    def __init__(self, tags, *args, **kwargs):
+        super(_MergeForm, self).__init__(*args, **kwargs)
+        self.fields['target'] = forms.TypedChoiceField(label=_('Merge into'),
+            coerce=int, choices=[(tag.pk, unicode(tag)) for tag in tags])
+
+class _RenameForm(forms.Form):
+    def __init__(self, tags, *args, **kwargs):
+        super(_RenameForm, self).__init__(*args, **kwargs)
+        self.tags = tags
+        for tag in tags:
+            self.fields['name_%d' % tag.pk] = forms.CharField(
+                label=unicode(tag), initial=tag.name,
+                max_length=settings.MAX_TAG_LENGTH)
+
+    def clean(self):
+        for tag in self.tags:
+            name = self.cleaned_data.get('name_%d' % tag.pk)
+            if name and name != tag.name and \
+                    Tag.objects.filter(name=name).exclude(pk=tag.pk).count():
+                raise forms.ValidationError(
+                    _('Tag "%s" already exists, merge the tags instead.') % name)
+        return self.cleaned_data
+
+    def renamed(self):
+        return [(tag, self.cleaned_data['name_%d' % tag.pk]) for tag in self.tags
+                if self.cleaned_data['name_%d' % tag.pk] != tag.name]
+
+class _TagJobActions(object):
+    """
+    Admin actions which queue merging, deletion and renaming of the
+    selected tags as background jobs (see ``tagging.jobs``).
+    """
+    actions = ['merge_tags', 'delete_tags', 'rename_tags']
+
+    def _queue_jobs(self, request, jobs):
+        for job in jobs:
+            job.save()
+        # Workers have connections of their own, so they can only find
+        # the jobs once they are committed, even when the request runs
+        # in a transaction, as with TransactionMiddleware.
+        if transaction.is_managed():
+            transaction.commit()
+        for job in jobs:
+            enqueue(job)
+        self.message_user(request,
+            _('%d job(s) were queued, their progress is shown on the tag jobs page.') % len(jobs))
+
+    def _confirm(self, request, queryset, action, description, form=None):
+        opts = self.model._meta
+        return render_to_response('admin/tagging/tag/bulk_action.html', {
+            'title': _('Are you sure?'),
+            'description': description,
+            'queryset': queryset,
+            'form': form,
+            'action': action,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+            'opts': opts,
+            'app_label': opts.app_label,
+        }, context_instance=RequestContext(request))
+
+    def merge_tags(self, request, queryset):
+        tags = list(queryset)
+        if len(tags) < 2:
+            self.message_user(request, _('At least two tags must be selected to merge them.'))
+            return None
+        form = _MergeForm(tags, request.POST.get('post') and request.POST or None)
+        if form.is_valid():
+            target = form.cleaned_data['target']
+            self._queue_jobs(request, [
+                TagJob(action=TagJob.MERGE, tag_pk=tag.pk, tag_name=tag.name,
+                       target_pk=target)
+                for tag in tags if tag.pk != target])
+            return None
+        return self._confirm(request, tags, 'merge_tags',
+            _('The selected tags will be merged into one of them, becoming its synonyms.'),
+            form)
+    merge_tags.short_description = _('Merge selected tags into...')
+
+    def delete_tags(self, request, queryset):
+        tags = list(queryset)
+        if request.POST.get('post'):
+            self._queue_jobs(request, [
+                TagJob(action=TagJob.DELETE, tag_pk=tag.pk, tag_name=tag.name)
+                for tag in tags])
+            return None
+        return self._confirm(request, tags, 'delete_tags',
+            _('The selected tags will be detached from all objects and deleted.'))
+    delete_tags.short_description = _('Delete selected tags and detach them')
+
+    def rename_tags(self, request, queryset):
+        tags = list(queryset)
+        form = _RenameForm(tags, request.POST.get('post') and request.POST or None)
+        if form.is_valid():
+            self._queue_jobs(request, [
+                TagJob(action=TagJob.RENAME, tag_pk=tag.pk, tag_name=tag.name,
+                       new_name=name)
+                for tag, name in form.renamed()])
+            return None
+        return self._confirm(request, tags, 'rename_tags',
+            _('The selected tags will be renamed and all objects tagged with them updated.'),
+            form)
+    rename_tags.short_description = _('Rename selected tags')
+
+def _usage(tag):
+    return tag.usage_count
+_usage.short_description = _('usage')
+_usage.admin_order_field = 'usage_count'
 
 if settings.MULTILINGUAL_TAGS:
     import multilingual
@@ -15,25 +150,34 @@ if settings.MULTILINGUAL_TAGS:
     _name.short_description = _('name')
 
     def _synonyms(tag):
-        return ', '.join(s.name for s in tag.synonyms.all())
+        return ', '.join(s.name for s in tag.synonyms_cache)
     _synonyms.short_description = _('synonyms')
 
     def _translations(tag):
-        return ', '.join(s.name for s in tag.translations.all())
+        return ', '.join(s.name for s in tag.translations_cache)
     _translations.short_description = _('translations')
 
-    class TagAdmin(multilingual.ModelAdmin):
+    class TagAdmin(_TagJobActions, multilingual.ModelAdmin):
         form = TagAdminForm
-        list_display = (_name, _synonyms, _translations)
+        list_display = (_name, _synonyms, _translations, _usage)
         search_fields = ('name', 'synonyms__name', 'translations__name')
 
+        def queryset(self, request):
+            qs = super(TagAdmin, self).queryset(request)
+            return prefetch_queryset(qs.annotate(usage_count=Count('items', distinct=True)),
+                                     fetch_synonyms, fetch_translations)
+
     _synonym_tag_name = 'name_any'
 else:
-    class TagAdmin(admin.ModelAdmin):
+    class TagAdmin(_TagJobActions, admin.ModelAdmin):
         form = TagAdminForm
-        list_display = ('name',)
+        list_display = ('name', _usage)
         search_fields = ('name', 'synonyms__name')
 
+        def queryset(self, request):
+            qs = super(TagAdmin, self).queryset(request)
+            return qs.annotate(usage_count=Count('items', distinct=True))
+
     _synonym_tag_name = 'name'
 
 
@@ -47,8 +191,24 @@ def _tag_name(synonym):
 _tag_name.short_description = _('tag')
 _tag_name.allow_tags = True
 
-admin.site.register(Synonym,
-    list_display = ('name', _tag_name),
-    search_fields = ('name',),
-)
+class SynonymAdmin(admin.ModelAdmin):
+    list_display = ('name', _tag_name)
+    search_fields = ('name',)
+
+    def queryset(self, request):
+        qs = super(SynonymAdmin, self).queryset(request)
+        return prefetch_queryset(qs.select_related('tag'), _tag_translations)
+
+admin.site.register(Synonym, SynonymAdmin)
+
+def _progress(job):
+    return '%d%%' % job.progress()
+_progress.short_description = _('progress')
+
+class TagJobAdmin(admin.ModelAdmin):
+    list_display = ('__unicode__', 'status', _progress, 'done', 'total',
+                    'created', 'modified')
+    list_filter = ('status', 'action')
+    search_fields = ('tag_name', 'new_name', 'error')
 
+admin.site.register(TagJob, TagJobAdmin)
@@ -0,0 +1,194 @@
+"""
+Bulk auto-tagging of existing objects.
+
+The objects of a queryset are read in chunks, ordered by primary key,
+and the text of some of their fields is searched for the names of
+existing tags and synonyms (see ``tagging.suggest``) by a pool of
+worker processes, while the main process reads the next chunks and
+inserts the associations found. Progress is saved to a checkpoint file
+after each chunk, so an interrupted run can be resumed.
+"""
+import os
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils.encoding import force_unicode
+
+from tagging.suggest import TagMatcher, _load_names
+from tagging.utils import get_queryset_and_model
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5
+    multiprocessing = None
+
+class AutotagProgress(object):
+    """
+    Counts the rows read and the associations found and added by an
+    auto-tagging run.
+    """
+    def __init__(self, last_pk=None):
+        self.last_pk = last_pk
+        self.rows = 0
+        self.found = 0
+        self.added = 0
+        self.started = time.time()
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def rows_per_second(self):
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.rows / elapsed
+
+    def __str__(self):
+        return '%d rows, %d tags found, %d added, %.0f rows/s' % (
+            self.rows, self.found, self.added, self.rows_per_second())
+
+_worker_matcher = None
+
+def _init_worker(names):
+    global _worker_matcher
+    _worker_matcher = TagMatcher()
+    for tag_id, name in names:
+        _worker_matcher._add(tag_id, name)
+
+def _match_rows(rows):
+    """
+    Returns ``(pk, tag ids)`` pairs for rows of a primary key followed by
+    text values.
+    """
+    matched = []
+    for row in rows:
+        text = u'\n'.join([force_unicode(value) for value in row[1:]
+                           if value is not None])
+        tag_ids = _worker_matcher.count(text).keys()
+        if tag_ids:
+            matched.append((row[0], tag_ids))
+    return matched
+
+def _read_checkpoint(checkpoint):
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return None
+    value = open(checkpoint).read().strip()
+    if not value:
+        return None
+    return int(value)
+
+def _write_checkpoint(checkpoint, last_pk):
+    if checkpoint is None:
+        return
+    # Renaming is atomic, so the checkpoint is never left half written.
+    temporary = '%s.tmp' % checkpoint
+    output = open(temporary, 'w')
+    try:
+        output.write('%s\n' % last_pk)
+    finally:
+        output.close()
+    os.rename(temporary, checkpoint)
+
+def _chunks(queryset, fields, last_pk, chunk_size):
+    pk_name = queryset.model._meta.pk.name
+    queryset = queryset.order_by(pk_name).values_list(pk_name, *fields)
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(**{'%s__gt' % pk_name: last_pk})
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield chunk
+
+def autotag(queryset_or_model, fields, chunk_size=1000, processes=None,
+            dry_run=False, checkpoint=None, callback=None):
+    """
+    Associates the objects of the given queryset or model with the
+    existing tags whose names or synonyms occur in any of the given
+    text ``fields``. Existing associations are kept.
+
+    Objects are read ``chunk_size`` at a time, and searched by
+    ``processes`` worker processes (as many as there are CPUs by
+    default; ``1`` searches in the current process). The associations
+    of each chunk are inserted with batched statements, after which
+    ``TagField``s, ``TagIdsField``s and tag stamps are updated.
+
+    If ``checkpoint`` is the path of a file, the primary key of the last
+    processed object is saved to it after each chunk, and objects up to
+    the primary key it holds are skipped. If ``dry_run`` is ``True``,
+    nothing is written.
+
+    ``callback`` is called with an ``AutotagProgress`` after each chunk,
+    which is also returned.
+    """
+    queryset, model = get_queryset_and_model(queryset_or_model)
+    progress = AutotagProgress(_read_checkpoint(checkpoint))
+    names = _load_names()
+    if processes is None:
+        processes = multiprocessing and multiprocessing.cpu_count() or 1
+    if multiprocessing is None:
+        processes = 1
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, _init_worker, (names,))
+        # Keeps the workers busy while a chunk is being written.
+        pending = []
+        try:
+            for chunk in _chunks(queryset, fields, progress.last_pk, chunk_size):
+                pending.append((chunk[-1][0], len(chunk),
+                                pool.apply_async(_match_rows, (chunk,))))
+                while len(pending) > processes:
+                    last_pk, rows, result = pending.pop(0)
+                    _save(model, result.get(), last_pk, rows, progress,
+                          dry_run, checkpoint, callback)
+            for last_pk, rows, result in pending:
+                _save(model, result.get(), last_pk, rows, progress,
+                      dry_run, checkpoint, callback)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(names)
+        for chunk in _chunks(queryset, fields, progress.last_pk, chunk_size):
+            _save(model, _match_rows(chunk), chunk[-1][0], len(chunk),
+                  progress, dry_run, checkpoint, callback)
+    return progress
+
+def _save(model, matched, last_pk, rows, progress, dry_run, checkpoint, callback):
+    from tagging.models import Tag, TaggedItem, TagStamp, _insert_ignore, _write_db
+
+    content_type = ContentType.objects.get_for_model(model)
+    items = []
+    for object_id, tag_ids in matched:
+        items.extend([(tag_id, content_type.pk, object_id) for tag_id in tag_ids])
+    progress.rows += rows
+    progress.found += len(items)
+    if items and not dry_run:
+        # Associations which already exist, for example on a re-run,
+        # mustn't touch their tags' stamps.
+        existing = set(TaggedItem._default_manager.filter(
+            content_type__pk=content_type.pk,
+            object_id__in=[object_id for object_id, tag_ids in matched]
+            ).values_list('tag', 'object_id'))
+        items = [item for item in items if (item[0], item[2]) not in existing]
+    if items and not dry_run:
+        try:
+            added = _insert_ignore(_write_db(TaggedItem), TaggedItem,
+                ('tag_id', 'content_type_id', 'object_id'), items)
+        except:
+            transaction.rollback_unless_managed()
+            raise
+        transaction.commit_unless_managed()
+        progress.added += added
+        if added:
+            TagStamp.objects.touch_all(set([item[0] for item in items]), content_type)
+            Tag.objects._sync_objects(model, list(set([item[2] for item in items])))
+    progress.last_pk = last_pk
+    if not dry_run:
+        _write_checkpoint(checkpoint, last_pk)
+    if callback is not None:
+        callback(progress)
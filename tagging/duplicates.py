@@ -0,0 +1,193 @@
+"""
+Detection of near-duplicate tags, such as "OpenSource", "Open Source"
+and "opensource".
+
+Names are normalized by lowercasing them and dropping everything but
+letters and digits, so that tags differing only by case, spaces or
+punctuation have the same key. Keys are then indexed in a BK-tree, a
+metric tree which finds all keys within an edit distance of a given one
+without comparing it with every other key. Groups are formed around the
+most used names, with complete linkage. Groups of duplicates are
+returned as rules in the format of ``Tag.objects.process_rules``, which
+joins them into their most used tag once reviewed.
+"""
+import re
+
+_non_alphanumeric = re.compile(r'[\W_]+', re.UNICODE)
+
+def normalize(name):
+    """
+    Returns the key under which near-duplicates of ``name`` are looked
+    up.
+    """
+    return _non_alphanumeric.sub(u'', name.lower())
+
+def edit_distance(first, second):
+    """
+    Returns the Levenshtein distance between two strings.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    previous = range(len(second) + 1)
+    for i, char in enumerate(first):
+        current = [i + 1]
+        for j, other in enumerate(second):
+            current.append(min(previous[j + 1] + 1, current[j] + 1,
+                               previous[j] + (char != other)))
+        previous = current
+    return previous[-1]
+
+class BKTree(object):
+    """
+    A Burkhard-Keller tree of strings under the edit distance.
+    """
+    def __init__(self):
+        self.root = None
+
+    def add(self, key):
+        if self.root is None:
+            self.root = (key, {})
+            return
+        node = self.root
+        while True:
+            distance = edit_distance(key, node[0])
+            if distance == 0:
+                return
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (key, {})
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """
+        Returns the list of ``(distance, key)`` pairs of the keys within
+        ``max_distance`` of ``key``.
+        """
+        if self.root is None:
+            return []
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node_key, children = nodes.pop()
+            distance = edit_distance(key, node_key)
+            if distance <= max_distance:
+                found.append((distance, node_key))
+            # By the triangle inequality, matches can only be below
+            # edges within max_distance of the distance to this node.
+            for edge, child in children.iteritems():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    nodes.append(child)
+        return found
+
+class DuplicateGroup(object):
+    """
+    A group of near-duplicate tags, most used first, each having a
+    ``count`` attribute with its number of tagged items.
+
+    ``similarity`` is ``1.0`` for names which are equal once normalized,
+    and one minus the largest edit distance relative to the length of
+    the keys otherwise.
+    """
+    def __init__(self, tags, similarity):
+        self.tags = sorted(tags, key=lambda tag: (-tag.count, _name(tag)))
+        self.similarity = similarity
+        self.count = sum([tag.count for tag in tags])
+
+    def __repr__(self):
+        return '<DuplicateGroup %s (%.2f)>' % (self.rule().encode('utf-8'),
+                                                self.similarity)
+
+    def rule(self):
+        """
+        Returns the ``=`` rule joining the tags into the first one.
+        """
+        return u' = '.join([_name(tag) for tag in self.tags])
+
+def _name(tag):
+    return tag.name or tag.name_any
+
+def find_duplicates(queryset=None, max_distance=1, min_length=4):
+    """
+    Returns the list of ``DuplicateGroup``s of the tags in ``queryset``
+    (all tags by default), most similar first, then most used first.
+
+    Names are duplicates if they are equal once normalized, or if their
+    normalized keys, both at least ``min_length`` characters long, are
+    within ``max_distance`` edits of each other. Every name of a group
+    is within ``max_distance`` edits of every other, the most used one
+    being picked first.
+    """
+    from tagging.models import Tag, TaggedItem, _connection, _read_db, preload_translations
+
+    if queryset is None:
+        queryset = Tag.objects.all()
+    tags = list(queryset)
+    preload_translations(tags)
+    db = _read_db(Tag.objects, TaggedItem)
+    qn = _connection(db).ops.quote_name
+    cursor = _connection(db).cursor()
+    cursor.execute('SELECT tag_id, COUNT(*) FROM %s GROUP BY tag_id'
+                   % qn(TaggedItem._meta.db_table))
+    counts = dict(cursor.fetchall())
+
+    by_key = {}
+    for tag in tags:
+        name = _name(tag)
+        # Such names can't be written as rules.
+        if not name or '=' in name or ':' in name:
+            continue
+        tag.count = counts.get(tag.pk, 0)
+        key = normalize(name)
+        if key:
+            by_key.setdefault(key, []).append(tag)
+
+    # Each group forms around the most used key which isn't in a group
+    # yet, and only takes keys within max_distance of all its members,
+    # so that chains of small differences aren't joined together.
+    def usage(name_key):
+        return sum([name_tag.count for name_tag in by_key[name_key]])
+    order = sorted(by_key, key=lambda name_key: (-usage(name_key), name_key))
+    tree = BKTree()
+    if max_distance > 0:
+        for name_key in order:
+            if len(name_key) >= min_length:
+                tree.add(name_key)
+
+    grouped = set()
+    result = []
+    for head in order:
+        if head in grouped:
+            continue
+        grouped.add(head)
+        members = [head]
+        if max_distance > 0 and len(head) >= min_length:
+            neighbours = [(distance, -usage(other), other)
+                          for distance, other in tree.search(head, max_distance)
+                          if other not in grouped]
+            neighbours.sort()
+            for distance, count, other in neighbours:
+                if max([edit_distance(other, kept) for kept in members[1:]]
+                       + [distance]) <= max_distance:
+                    members.append(other)
+                    grouped.add(other)
+        group_tags = []
+        for member in members:
+            group_tags.extend(by_key[member])
+        if len(group_tags) < 2:
+            continue
+        similarity = 1.0
+        for i, first in enumerate(members):
+            for second in members[i + 1:]:
+                similarity = min(similarity, 1.0 - float(edit_distance(first, second))
+                                 / max(len(first), len(second)))
+        result.append(DuplicateGroup(group_tags, similarity))
+    result.sort(key=lambda group: (-group.similarity, -group.count, group.rule()))
+    return result
+
+def duplicate_rules(groups):
+    """
+    Returns the rules joining the given ``DuplicateGroup``s, one per
+    line, for ``Tag.objects.process_rules``.
+    """
+    return u'\n'.join([group.rule() for group in groups])
@@ -1,9 +1,11 @@
 """
 A custom Model Field for tagging.
 """
-from django.db import IntegrityError
+import threading
+
+from django.core.signals import request_started, request_finished
 from django.db.models import signals
-from django.db.models.fields import CharField
+from django.db.models.fields import CharField, TextField
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
@@ -23,6 +25,8 @@ class TagField(CharField):
             self.create_synonyms = kwargs.pop('create_synonyms')
         else:
             self.create_synonyms = None
+        self.defer_synonyms = kwargs.pop('defer_synonyms', False)
+        self.generic_relation_attr = kwargs.pop('generic_relation_attr', None)
         super(TagField, self).__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name):
@@ -31,6 +35,10 @@ class TagField(CharField):
         # Make this object the descriptor for field access.
         setattr(cls, self.name, self)
 
+        if self.generic_relation_attr is not None:
+            from tagging.generic import add_tagged_items_relation
+            add_tagged_items_relation(cls, self.generic_relation_attr)
+
         # Save tags back to the database post-save
         signals.post_save.connect(self._post_save, cls, True)
         signals.pre_save.connect(self._pre_save, cls, True)
@@ -99,17 +107,14 @@ class TagField(CharField):
 
         if self.create_synonyms is not None:
             tags = parse_tag_input(tags)
-            for tag in tags:
-                synonyms = self.create_synonyms(tag)
-                try:
-                    tag = Tag.objects.get(name=tag)
-                    for synonym in synonyms:
-                        try:
-                            synonym = Synonym.objects.create(name=synonym, tag=tag)
-                        except IntegrityError:
-                            pass
-                except Tag.DoesNotExist:
-                    pass
+            if self.defer_synonyms:
+                _pending_synonyms().append((self.create_synonyms, tags))
+                if not getattr(_deferred, 'in_request', False):
+                    # Nothing else would flush them outside of requests.
+                    flush_synonyms()
+            else:
+                Synonym.objects.add_synonyms(
+                    _synonym_candidates([(self.create_synonyms, tags)]))
 
     def __delete__(self, instance):
         """
@@ -137,3 +142,80 @@ class TagField(CharField):
         defaults = {'form_class': forms.TagField}
         defaults.update(kwargs)
         return super(TagField, self).formfield(**defaults)
+
+class TagIdsField(TextField):
+    """
+    A denormalized copy of the ids of an instance's tags, stored as a
+    sorted, comma-delimited list. It's kept up to date whenever the
+    instance's tags change and is never edited directly.
+
+    On PostgreSQL, ``TaggedItemManager`` filters models having such a
+    field with array containment on this column instead of joining
+    them with tagged items, which is much faster with a GIN index on::
+
+       (string_to_array(trim(both ',' from tag_ids), ',')::integer[])
+
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs['editable'] = False
+        kwargs['blank'] = True
+        kwargs['default'] = ''
+        super(TagIdsField, self).__init__(*args, **kwargs)
+
+    def contribute_to_class(self, cls, name):
+        super(TagIdsField, self).contribute_to_class(cls, name)
+        from tagging.models import tag_ids_fields
+        tag_ids_fields[cls] = self.name
+
+    def get_internal_type(self):
+        return 'TextField'
+
+_deferred = threading.local()
+
+def _pending_synonyms():
+    if not hasattr(_deferred, 'synonyms'):
+        _deferred.synonyms = []
+    return _deferred.synonyms
+
+def _synonym_candidates(pending):
+    """
+    Maps tag names to the synonyms proposed for them by the
+    ``create_synonyms`` callables in the given list of ``(callable,
+    tag names)`` pairs.
+    """
+    candidates = {}
+    for create_synonyms, tag_names in pending:
+        for tag_name in tag_names:
+            names = candidates.setdefault(tag_name, [])
+            for name in create_synonyms(tag_name):
+                if name not in names:
+                    names.append(name)
+    return candidates
+
+def flush_synonyms(**kwargs):
+    """
+    Creates the synonyms deferred by the ``TagField``s with
+    ``defer_synonyms`` saved in the current thread, in a background
+    worker if there are any (see ``TAG_JOB_WORKERS``).
+
+    This is called at the end of every request, after its transaction
+    has been committed, and right after saving such a field outside of
+    requests, for example in management commands.
+    """
+    pending = _pending_synonyms()
+    if not pending:
+        return
+    candidates = _synonym_candidates(pending)
+    del pending[:]
+    from tagging.jobs import defer
+    defer(Synonym.objects.add_synonyms, candidates)
+
+def _request_started(**kwargs):
+    _deferred.in_request = True
+
+def _request_finished(**kwargs):
+    _deferred.in_request = False
+    flush_synonyms()
+
+request_started.connect(_request_started)
+request_finished.connect(_request_finished)
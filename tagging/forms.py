@@ -2,10 +2,13 @@
 Tagging components for Django's form library.
 """
 from django import forms
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
 from tagging import settings
 from tagging.models import Tag
+from tagging.suggest import suggest_tags
 from tagging.utils import parse_tag_input
 
 class TagAdminForm(forms.ModelForm):
@@ -39,3 +42,38 @@ class TagField(forms.CharField):
                     _('Each tag may be no more than %s characters long.') %
                         settings.MAX_TAG_LENGTH)
         return value
+
+class TagSuggestionWidget(forms.TextInput):
+    """
+    A text input followed by a list of the names of suggested tags,
+    which are set by ``add_tag_suggestions``.
+    """
+    def __init__(self, attrs=None, suggestions=()):
+        super(TagSuggestionWidget, self).__init__(attrs)
+        self.suggestions = list(suggestions)
+
+    def render(self, name, value, attrs=None):
+        output = super(TagSuggestionWidget, self).render(name, value, attrs)
+        if not self.suggestions:
+            return output
+        items = [u'<li>%s</li>' % conditional_escape(tag.name or tag.name_any)
+                 for tag in self.suggestions]
+        return mark_safe(u'%s<ul class="tag-suggestions">%s</ul>' % (
+            output, u''.join(items)))
+
+def add_tag_suggestions(form, field_name, text, limit=10):
+    """
+    Suggests up to ``limit`` existing tags found in ``text`` for the
+    field of the given form named ``field_name``, leaving out the tags
+    it already holds. The field's widget is replaced by a
+    ``TagSuggestionWidget`` if needed. Returns the suggested tags.
+    """
+    field = form.fields[field_name]
+    value = form[field_name].data
+    if value is None:
+        value = form.initial.get(field_name, field.initial)
+    suggestions = suggest_tags(text, limit, parse_tag_input(value or u''))
+    if not isinstance(field.widget, TagSuggestionWidget):
+        field.widget = TagSuggestionWidget(field.widget.attrs)
+    field.widget.suggestions = suggestions
+    return suggestions
@@ -1,6 +1,21 @@
+import sys
+import threading
+import Queue
+
+from django.conf import settings as django_settings
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+from tagging import settings
 
-def fetch_content_objects(tagged_items, select_related_for=None):
+try:
+    from django.db import connections, router
+except ImportError:
+    # Django before 1.2 only supports a single database.
+    connections = router = None
+
+def fetch_content_objects(tagged_items, select_related_for=None, only=None,
+                          defer=None, chunk_size=None, threads=None):
     """
     Retrieves ``ContentType`` and content objects for the given list of
     ``TaggedItems``, grouping the retrieval of content objects by model
@@ -14,27 +29,284 @@ def fetch_content_objects(tagged_items, select_related_for=None):
     of model names (corresponding to the ``model`` field of a
     ``ContentType``) for which ``select_related`` should be used when
     retrieving model instances.
+
+    ``only`` and ``defer`` may be dictionaries mapping model names to
+    lists of field names, which will be passed to the ``only`` and
+    ``defer`` methods of the ``QuerySet`` retrieving instances of that
+    model.
+
+    The primary keys of each model are looked up in chunks of at most
+    ``chunk_size`` (by default, the ``TAG_FETCH_CHUNK_SIZE`` setting), to
+    keep the ``IN`` lists within the limits of the database backend.
+
+    If ``threads`` is greater than one, up to that many content types
+    are retrieved concurrently, each thread using its own database
+    connection. As those connections don't see uncommitted changes of
+    the current transaction, and as SQLite in-memory databases can't
+    be shared between threads, this falls back to retrieving content
+    types one after another within managed or dirty transactions and
+    for such databases.
+
+    Items whose content objects no longer exist will have their
+    ``object`` set to ``None``.
     """
     if select_related_for is None: select_related_for = []
+    if only is None: only = {}
+    if defer is None: defer = {}
+    if chunk_size is None: chunk_size = settings.TAG_FETCH_CHUNK_SIZE
 
     # Group content object pks by their content type pks
     objects = {}
     for item in tagged_items:
-        objects.setdefault(item.content_type_id, []).append(item.object_id)
+        objects.setdefault(item.content_type_id, set()).add(item.object_id)
 
     # Retrieve content types and content objects in bulk
     content_types = ContentType._default_manager.in_bulk(objects.keys())
+    loads = []
     for content_type_pk, object_pks in objects.iteritems():
-        model = content_types[content_type_pk].model_class()
-        if content_types[content_type_pk].model in select_related_for:
-            objects[content_type_pk] = model._default_manager.select_related().in_bulk(object_pks)
-        else:
-            objects[content_type_pk] = model._default_manager.in_bulk(object_pks)
+        content_type = content_types[content_type_pk]
+        loads.append((content_type_pk, (content_type.model_class(),
+            list(object_pks), content_type.model in select_related_for,
+            only.get(content_type.model), defer.get(content_type.model),
+            chunk_size)))
+    aliases = set([_db_for(args[0]) for key, args in loads])
+    if threads is not None and threads > 1 and len(loads) > 1 \
+            and _threads_can_load(aliases):
+        objects = _load_in_threads(loads, threads, aliases)
+    else:
+        objects = dict([(key, _load_objects(*args)) for key, args in loads])
 
     # Set content types and content objects in the appropriate cache
     # attributes, so accessing the 'content_type' and 'object'
     # attributes on each tagged item won't result in further database
     # hits.
     for item in tagged_items:
-        item._object_cache = objects[item.content_type_id][item.object_id]
+        item._object_cache = objects[item.content_type_id].get(item.object_id)
         item._content_type_cache = content_types[item.content_type_id]
+
+def _load_objects(model, object_pks, select_related, only, defer, chunk_size):
+    queryset = model._default_manager.all()
+    if select_related:
+        queryset = queryset.select_related()
+    if only:
+        queryset = queryset.only(*only)
+    if defer:
+        queryset = queryset.defer(*defer)
+    objects = {}
+    for start in range(0, len(object_pks), chunk_size):
+        objects.update(queryset.in_bulk(object_pks[start:start + chunk_size]))
+    return objects
+
+def _db_for(model):
+    """
+    Returns the alias of the database instances of ``model`` are read
+    from, or ``None`` if there is only one database.
+    """
+    if router is None:
+        return None
+    return router.db_for_read(model)
+
+def _threads_have_connections(db=None):
+    """
+    Tells whether threads other than the current one may open their own
+    connections to the database with the given alias.
+    """
+    if connections is not None and getattr(django_settings, 'DATABASES', None):
+        settings_dict = connections[db or 'default'].settings_dict
+        engine = settings_dict.get('ENGINE', '')
+        name = settings_dict.get('NAME', '')
+    else:
+        engine = getattr(django_settings, 'DATABASE_ENGINE', '')
+        name = getattr(django_settings, 'DATABASE_NAME', '')
+    return not (engine.endswith('sqlite3') and name in ('', ':memory:'))
+
+def _threads_can_load(aliases):
+    """
+    Tells whether the databases with the given aliases may be read by
+    other threads, which don't see the changes of the current thread's
+    transactions.
+    """
+    for db in aliases:
+        if not _threads_have_connections(db):
+            return False
+        if db is None:
+            in_transaction = transaction.is_managed() or transaction.is_dirty()
+        else:
+            in_transaction = (transaction.is_managed(using=db)
+                              or transaction.is_dirty(using=db))
+        if in_transaction:
+            return False
+    return True
+
+def _load_in_threads(loads, threads, aliases=(None,)):
+    queue = Queue.Queue()
+    for load in loads:
+        queue.put(load)
+    objects, errors = {}, []
+
+    def work():
+        try:
+            while True:
+                try:
+                    key, args = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    objects[key] = _load_objects(*args)
+                except Exception:
+                    errors.append(sys.exc_info())
+        finally:
+            # Each thread has its own connections.
+            for db in aliases:
+                if db is None or connections is None:
+                    connection.close()
+                else:
+                    connections[db].close()
+
+    workers = [threading.Thread(target=work)
+               for i in range(min(threads, len(loads)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return objects
+
+def add_tagged_items_relation(model, name):
+    """
+    Adds a ``GenericRelation`` to ``TaggedItem`` named ``name`` to the
+    given model, so that querysets of the model can be filtered by tags
+    through it, and prefetch the tags of their instances with
+    ``prefetch_related('<name>__tag')`` on Django 1.4 and later.
+
+    Deleting an instance also deletes its tagged items, without sending
+    their signals.
+    """
+    from django.contrib.contenttypes.generic import GenericRelation
+    from tagging.models import TaggedItem
+
+    GenericRelation(TaggedItem).contribute_to_class(model, name)
+
+def fetch_tags(objects, chunk_size=None):
+    """
+    Retrieves the tags of all the given model instances with a single
+    query per content type (and chunk of ``chunk_size`` primary keys),
+    sorting them by name into the ``tags_cache`` attribute of each
+    instance, which the tag descriptor of registered models returns.
+    """
+    from tagging.models import TaggedItem, preload_translations
+
+    if chunk_size is None: chunk_size = settings.TAG_FETCH_CHUNK_SIZE
+    instances = {}
+    for obj in objects:
+        obj.tags_cache = []
+        content_type = ContentType.objects.get_for_model(obj)
+        instances.setdefault(content_type.pk, {}).setdefault(obj.pk, []).append(obj)
+
+    tags = []
+    for content_type_id, by_pk in instances.iteritems():
+        object_ids = by_pk.keys()
+        for start in range(0, len(object_ids), chunk_size):
+            for item in TaggedItem.objects.filter(content_type__pk=content_type_id,
+                    object_id__in=object_ids[start:start + chunk_size]
+                    ).select_related('tag'):
+                tags.append(item.tag)
+                for obj in by_pk[item.object_id]:
+                    obj.tags_cache.append(item.tag)
+    preload_translations(tags)
+    for by_pk in instances.itervalues():
+        for objs in by_pk.itervalues():
+            for obj in objs:
+                obj.tags_cache.sort()
+
+def fetch_synonyms(tags):
+    """
+    Retrieves the synonyms of all the given tags in a single query and
+    stores them in each tag's ``synonyms_cache`` attribute.
+    """
+    from tagging.models import Synonym
+
+    tags = dict([(tag.pk, tag) for tag in tags])
+    for tag in tags.itervalues():
+        tag.synonyms_cache = []
+    if tags:
+        for synonym in Synonym.objects.filter(tag__pk__in=tags.keys()):
+            tag = tags[synonym.tag_id]
+            synonym._tag_cache = tag
+            tag.synonyms_cache.append(synonym)
+
+def fetch_translations(tags, languages=None):
+    """
+    Retrieves the translations of all the given multilingual tags in a
+    single query, filling the translation cache of each tag, so that
+    reading its names in any language won't result in further
+    database hits. The translations are also stored in each tag's
+    ``translations_cache`` attribute.
+
+    If a list of language ids is given as ``languages``, only the
+    translations to these languages are retrieved. Translations which
+    don't exist are marked as missing in the cache, so that looking
+    them up doesn't hit the database either.
+    """
+    from tagging.models import Tag
+
+    tags = dict([(tag.pk, tag) for tag in tags])
+    for tag in tags.itervalues():
+        tag._translation_cache = {}
+        tag.translations_cache = []
+    if tags:
+        translation_model = Tag._meta.translation_model
+        translations = translation_model._default_manager.filter(
+            master__pk__in=tags.keys())
+        if languages is not None:
+            translations = translations.filter(language_id__in=languages)
+        else:
+            from multilingual.languages import get_language_id_list
+            languages = get_language_id_list()
+        for translation in translations:
+            tag = tags[translation.master_id]
+            tag._translation_cache[translation.language_id] = translation
+            tag.translations_cache.append(translation)
+        for tag in tags.itervalues():
+            for language_id in languages:
+                tag._translation_cache.setdefault(language_id, None)
+
+class _PrefetchingQuerySet(object):
+    """
+    A ``QuerySet`` mixin which passes the results of each evaluation to
+    its ``prefetch_callbacks``.
+    """
+    prefetch_callbacks = ()
+
+    def iterator(self):
+        objects = list(super(_PrefetchingQuerySet, self).iterator())
+        for callback in self.prefetch_callbacks:
+            callback(objects)
+        return iter(objects)
+
+_prefetching_classes = {}
+
+def prefetch_queryset(queryset, *callbacks):
+    """
+    Returns a clone of the given ``QuerySet``, which calls each of the
+    given callbacks with the list of its results whenever it's
+    evaluated. Callbacks such as ``fetch_content_objects`` or
+    ``fetch_synonyms`` can so load related data for a whole page of
+    results in bulk.
+
+    The returned ``QuerySet`` keeps its callbacks when it's filtered,
+    sliced or cloned in any other way.
+    """
+    cls = queryset.__class__
+    klass = _prefetching_classes.get((cls, callbacks))
+    if klass is None:
+        if isinstance(queryset, _PrefetchingQuerySet):
+            bases = (cls,)
+        else:
+            bases = (_PrefetchingQuerySet, cls)
+        klass = _prefetching_classes[(cls, callbacks)] = type(
+            'Prefetching%s' % cls.__name__, bases, {
+                'prefetch_callbacks': getattr(cls, 'prefetch_callbacks', ()) + callbacks,
+            })
+    return queryset._clone(klass=klass)
@@ -0,0 +1,225 @@
+"""
+Background jobs for bulk operations on tags.
+
+Merging, deleting or renaming a heavily used tag touches every object
+tagged with it, which takes too long to be done within a request.
+Instead, the admin records a ``TagJob`` and queues it to a worker
+thread, which processes the tagged items in chunks and records its
+progress after each one. Jobs which are left pending, for example when
+``TAG_JOB_WORKERS`` is ``0``, are run by the ``run_tag_jobs``
+management command.
+"""
+import logging
+import Queue
+import threading
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction, IntegrityError
+
+from tagging import settings
+from tagging.generic import fetch_content_objects
+from tagging.models import Synonym, Tag, TaggedItem, TagJob, TagStamp, sync_tag_ids, update_buckets
+from tagging.utils import _update_objects_tags
+
+logger = logging.getLogger('tagging.jobs')
+
+_queue = Queue.Queue()
+_workers = []
+_workers_lock = threading.Lock()
+
+def enqueue(job):
+    """
+    Queues the given ``TagJob`` to a local worker thread, starting the
+    workers if needed.
+    """
+    if not settings.TAG_JOB_WORKERS:
+        return
+    _start_workers()
+    _queue.put(job.pk)
+
+def defer(function, *args):
+    """
+    Calls ``function`` with the given arguments in a local worker
+    thread, or right away if there are no workers.
+    """
+    if not settings.TAG_JOB_WORKERS:
+        function(*args)
+        return
+    _start_workers()
+    _queue.put((function, args))
+
+def _start_workers():
+    _workers_lock.acquire()
+    try:
+        while len(_workers) < settings.TAG_JOB_WORKERS:
+            worker = threading.Thread(target=_work,
+                                      name='tagging-job-%d' % len(_workers))
+            worker.setDaemon(True)
+            worker.start()
+            _workers.append(worker)
+    finally:
+        _workers_lock.release()
+
+def _work():
+    while True:
+        task = _queue.get()
+        try:
+            if isinstance(task, tuple):
+                function, args = task
+                try:
+                    function(*args)
+                except Exception:
+                    logger.exception('deferred call to %r failed' % function)
+                    transaction.rollback_unless_managed()
+            else:
+                run_job(task)
+        finally:
+            # Each thread has its own connection.
+            connection.close()
+
+def run_pending():
+    """
+    Runs all pending jobs in the current thread, returning the number
+    of jobs which were run.
+    """
+    count = 0
+    for job_id in TagJob.objects.filter(status=TagJob.PENDING).order_by(
+            'created').values_list('pk', flat=True):
+        if run_job(job_id):
+            count += 1
+    return count
+
+def run_job(job_id):
+    """
+    Runs the pending job with the given id. Returns ``False`` if the
+    job wasn't pending, which includes jobs claimed by another worker.
+    """
+    jobs = TagJob.objects.filter(pk=job_id)
+    if not jobs.filter(status=TagJob.PENDING).update(
+            status=TagJob.RUNNING, modified=datetime.now()):
+        return False
+    job = jobs.get()
+    logger.info('running job "%s"' % job)
+    try:
+        _runners[job.action](job)
+    except Exception, e:
+        logger.exception('job "%s" failed' % job)
+        transaction.rollback_unless_managed()
+        jobs.update(status=TagJob.FAILED, error=unicode(e),
+                    modified=datetime.now())
+    else:
+        jobs.update(status=TagJob.DONE, modified=datetime.now())
+    return True
+
+def _progress(job, done, total=None):
+    values = {'done': done, 'modified': datetime.now()}
+    if total is not None:
+        values['total'] = total
+    TagJob.objects.filter(pk=job.pk).update(**values)
+
+def _chunks(items):
+    """
+    Yields chunks of the given ``TaggedItem`` queryset, ordered by
+    primary key. Items may be deleted or moved to another tag while
+    their chunk is being processed.
+    """
+    last_pk = 0
+    while True:
+        chunk = list(items.filter(pk__gt=last_pk).order_by('pk')[
+            :settings.TAG_JOB_CHUNK_SIZE])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+def _update_linked_objects(items):
+    """
+    Refreshes the ``TagField``s, ``TagIdsField``s and MinHash buckets
+    of the objects of the given items.
+    """
+    fetch_content_objects(items)
+    seen = set()
+    object_ids = {}
+    for item in items:
+        key = (item.content_type_id, item.object_id)
+        if key not in seen:
+            seen.add(key)
+            _update_objects_tags(item.object)
+            object_ids.setdefault(item.content_type.model_class(), []).append(
+                item.object_id)
+    for model, ids in object_ids.iteritems():
+        sync_tag_ids(model, ids)
+        update_buckets(ContentType.objects.get_for_model(model), ids)
+
+def _merge(job):
+    from_tag = Tag.objects.get(pk=job.tag_pk)
+    to_tag = Tag.objects.get(pk=job.target_pk)
+    items = TaggedItem.objects.filter(tag__pk=from_tag.pk)
+    done = 0
+    _progress(job, done, items.count())
+    for chunk in _chunks(items):
+        existing = set(TaggedItem.objects.filter(tag__pk=to_tag.pk,
+            object_id__in=[item.object_id for item in chunk]).values_list(
+                'content_type', 'object_id'))
+        duplicates, moved = [], []
+        for item in chunk:
+            if (item.content_type_id, item.object_id) in existing:
+                duplicates.append(item.pk)
+            else:
+                moved.append(item.pk)
+        if duplicates:
+            TaggedItem.objects.filter(pk__in=duplicates).delete()
+        if moved:
+            TaggedItem.objects.filter(pk__in=moved).update(tag=to_tag)
+        for content_type_id in set([item.content_type_id for item in chunk]):
+            TagStamp.objects.touch(from_tag, content_type_id, create=False)
+            TagStamp.objects.touch(to_tag, content_type_id)
+        _update_linked_objects(chunk)
+        done += len(chunk)
+        _progress(job, done)
+
+    if from_tag.items.count() == 0:
+        # The synonyms of the merged tag would be deleted along with it.
+        synonyms = Synonym.objects.filter(tag__pk=from_tag.pk)
+        synonyms.filter(name__in=list(
+            to_tag.synonyms.values_list('name', flat=True))).delete()
+        if synonyms.update(tag=to_tag):
+            # No signals were sent.
+            from tagging import suggest
+            suggest.tag_changed(to_tag.pk)
+        from_tag.delete(update=False)
+        try:
+            to_tag.synonyms.create(name=from_tag.name)
+        except IntegrityError:
+            pass
+
+def _delete(job):
+    tag = Tag.objects.get(pk=job.tag_pk)
+    items = TaggedItem.objects.filter(tag__pk=tag.pk)
+    done = 0
+    _progress(job, done, items.count())
+    for chunk in _chunks(items):
+        TaggedItem.objects.filter(pk__in=[item.pk for item in chunk]).delete()
+        _update_linked_objects(chunk)
+        done += len(chunk)
+        _progress(job, done)
+    tag.delete(update=False)
+
+def _rename(job):
+    tag = Tag.objects.get(pk=job.tag_pk)
+    tag.name = job.new_name
+    tag.save(update=False)
+    items = TaggedItem.objects.filter(tag__pk=tag.pk)
+    done = 0
+    _progress(job, done, items.count())
+    for chunk in _chunks(items):
+        _update_linked_objects(chunk)
+        done += len(chunk)
+        _progress(job, done)
+
+_runners = {
+    TagJob.MERGE: _merge,
+    TagJob.DELETE: _delete,
+    TagJob.RENAME: _rename,
+}
@@ -0,0 +1,47 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='The number of objects read and tagged at a time.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+            help='The number of processes matching tag names. Defaults to '
+                 'the number of CPUs.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+            help='A file holding the primary key of the last tagged object, '
+                 'to resume from.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False,
+            help='Only count the tags which would be added.'),
+    )
+    help = ('Tags the objects of a model with the existing tags whose names '
+            'or synonyms occur in the given text fields.')
+    args = '<app_label.model> <field> [field ...]'
+
+    def handle(self, *args, **options):
+        from tagging.autotag import autotag
+
+        if len(args) < 2:
+            raise CommandError('Give a model and at least one field.')
+        try:
+            app_label, model_name = args[0].split('.')
+        except ValueError:
+            raise CommandError('The model must be given as app_label.model.')
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+
+        verbosity = int(options.get('verbosity', 1))
+        def report(progress):
+            if verbosity > 0:
+                sys.stdout.write('\r%s' % progress)
+                sys.stdout.flush()
+        progress = autotag(model, args[1:], options['chunk_size'],
+                           options['processes'], options['dry_run'],
+                           options['checkpoint'], report)
+        if verbosity > 0:
+            print '\r%s in %.1f s' % (progress, progress.elapsed())
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = ('Rolls old hourly counters of tag additions up into daily ones, '
+            'and deletes expired daily counters.')
+
+    def handle_noargs(self, **options):
+        from tagging.models import TagCounter
+
+        count = TagCounter.objects.compact()
+        if int(options.get('verbosity', 1)) > 0:
+            print '%d hourly counter(s) were compacted.' % count
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--max-distance', type='int', dest='max_distance', default=1,
+            help='The largest number of edits between duplicate names, once '
+                 'normalized.'),
+        make_option('--min-length', type='int', dest='min_length', default=4,
+            help='The length below which normalized names must be equal to '
+                 'be duplicates.'),
+    )
+    help = ('Prints rules joining near-duplicate tags, most similar first, '
+            'to be reviewed and applied with Tag.objects.process_rules.')
+
+    def handle_noargs(self, **options):
+        from tagging.duplicates import duplicate_rules, find_duplicates
+
+        groups = find_duplicates(max_distance=options['max_distance'],
+                                 min_length=options['min_length'])
+        if groups:
+            print duplicate_rules(groups).encode('utf-8')
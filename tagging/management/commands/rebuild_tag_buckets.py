@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the MinHash buckets of all tagged objects, used to find '
+            'related objects approximately.')
+
+    def handle_noargs(self, **options):
+        from tagging import minhash
+
+        count = minhash.rebuild()
+        if int(options.get('verbosity', 1)) > 0:
+            print 'The buckets of %d object(s) were rebuilt.' % count
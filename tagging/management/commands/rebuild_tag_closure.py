@@ -0,0 +1,11 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = 'Adds the missing rows of the tag hierarchy, for tags created before it was installed.'
+
+    def handle_noargs(self, **options):
+        from tagging.models import TagClosure
+
+        count = TagClosure.objects.rebuild()
+        if int(options.get('verbosity', 1)) > 0:
+            print '%d tag(s) were added to the hierarchy.' % count
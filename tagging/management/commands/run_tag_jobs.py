@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requeue-running', action='store_true', dest='requeue',
+            default=False,
+            help='Restart jobs left running by a worker which has died.'),
+    )
+    help = 'Runs pending bulk jobs on tags, which were queued from the admin.'
+
+    def handle_noargs(self, **options):
+        from tagging.jobs import run_pending
+        from tagging.models import TagJob
+
+        if options.get('requeue'):
+            TagJob.objects.filter(status=TagJob.RUNNING).update(
+                status=TagJob.PENDING)
+        count = run_pending()
+        if int(options.get('verbosity', 1)) > 0:
+            print '%d job(s) were run.' % count
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+class Command(NoArgsCommand):
+    help = ('Stores the number of objects associated with each tag in its '
+            'stamps, for IDF-weighted related objects.')
+
+    def handle_noargs(self, **options):
+        from tagging.models import TagStamp
+
+        count = TagStamp.objects.update_counts()
+        if int(options.get('verbosity', 1)) > 0:
+            print '%d tag stamp(s) were updated.' % count
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+    help = ('Writes a memory-mapped snapshot of all tagged items, to be read '
+            'by tagging.snapshot.get_snapshot.')
+    args = '[path]'
+
+    def handle(self, *args, **options):
+        from tagging import settings
+        from tagging.snapshot import write_snapshot
+
+        if len(args) > 1:
+            raise CommandError('Give at most one path.')
+        path = args and args[0] or settings.TAG_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('Give a path or set TAG_SNAPSHOT_PATH.')
+        version = write_snapshot(path)
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Version %d of the snapshot was written to %s.' % (version, path)
@@ -4,8 +4,10 @@ application.
 """
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
+from django.db.models.query import QuerySet
 
-from tagging.models import Tag, TaggedItem
+from tagging.models import Tag, TaggedItem, Synonym, _connection, _pk_subquery, _tag_names_table
+from tagging.utils import get_tag_list, get_tag_names
 
 class ModelTagManager(models.Manager):
     """
@@ -25,10 +27,144 @@ class ModelTagManager(models.Manager):
     def usage(self, *args, **kwargs):
         return Tag.objects.usage_for_model(self.model, *args, **kwargs)
 
+class TaggedQuerySetMixin(object):
+    """
+    A ``QuerySet`` mixin with lazy methods filtering instances by tags,
+    which may be chained with each other and with any other filters.
+    Each of them adds ``EXISTS`` subqueries on tagged items to the
+    ``WHERE`` clause, so the result is still a single statement.
+    """
+    def tagged_with_all(self, tags):
+        """
+        Restricts the queryset to instances having all the given tags.
+        """
+        return self._filter_tags(tags, True, False)
+
+    def tagged_with_any(self, tags):
+        """
+        Restricts the queryset to instances having any of the given tags.
+        """
+        return self._filter_tags(tags, False, False)
+
+    def not_tagged_with(self, tags):
+        """
+        Excludes the instances having any of the given tags.
+        """
+        return self._filter_tags(tags, False, True)
+
+    def _filter_tags(self, tags, require_all, negate):
+        # Nothing is read before the queryset is evaluated: names,
+        # synonyms and querysets of tags are matched by the subqueries.
+        names = get_tag_names(tags)
+        tag_queryset = None
+        if names is not None:
+            values = names
+        else:
+            tag_list = get_tag_list(tags)
+            if isinstance(tag_list, QuerySet):
+                tag_queryset = tag_list
+            else:
+                values = [tag.pk for tag in tag_list]
+        if tag_queryset is None and not values:
+            if negate:
+                return self._clone()
+            # Unlike none(), this keeps the methods of this class.
+            return self._clone().extra(where=['1 = 0'])
+
+        db = getattr(self, 'db', None)
+        qn = _connection(db).ops.quote_name
+        opts = self.model._meta
+        model_pk = '%s.%s' % (qn(opts.db_table), qn(opts.pk.column))
+        exists = """EXISTS (
+            SELECT 1 FROM %(tagged_item)s ti
+            WHERE ti.content_type_id = %%s
+              AND ti.object_id = %(model_pk)s
+              AND (%%s))""" % {
+            'tagged_item': qn(TaggedItem._meta.db_table),
+            'model_pk': model_pk,
+        }
+        content_type_id = ContentType.objects.get_for_model(self.model).pk
+        if tag_queryset is not None:
+            subquery, subquery_params = _pk_subquery(tag_queryset, db)
+            where = exists % ('ti.tag_id IN (%s)' % subquery)
+            params = [content_type_id] + list(subquery_params)
+            if require_all:
+                # No tag of the queryset may be missing.
+                where = """%(exists)s AND NOT EXISTS (
+            SELECT 1 FROM %(tag)s t
+            WHERE t.id IN (%(subquery)s)
+              AND NOT %(tag_exists)s)""" % {
+                    'exists': where,
+                    'tag': qn(Tag._meta.db_table),
+                    'subquery': subquery,
+                    'tag_exists': exists % 'ti.tag_id = t.id',
+                }
+                params += list(subquery_params) + [content_type_id]
+        else:
+            if names is not None:
+                names_table, names_tag_id = _tag_names_table()
+                tag_criteria = """ti.tag_id IN (
+                SELECT n.%s FROM %s n WHERE n.%s = %%s
+                UNION
+                SELECT s.tag_id FROM %s s WHERE s.%s = %%s)""" % (
+                    qn(names_tag_id), qn(names_table), qn('name'),
+                    qn(Synonym._meta.db_table), qn('name'))
+                values = [(value, value) for value in values]
+            else:
+                tag_criteria = 'ti.tag_id = %s'
+                values = [(value,) for value in values]
+            if require_all:
+                # One subquery per tag, each using the unique index of
+                # tagged items.
+                where = ' AND '.join([exists % tag_criteria] * len(values))
+                params = []
+                for value in values:
+                    params.append(content_type_id)
+                    params.extend(value)
+            else:
+                where = exists % ' OR '.join([tag_criteria] * len(values))
+                params = [content_type_id]
+                for value in values:
+                    params.extend(value)
+        if negate:
+            where = 'NOT (%s)' % where
+        return self.extra(where=[where], params=params)
+
+_tagged_classes = {}
+
+def tagged_queryset(queryset):
+    """
+    Returns a clone of the given ``QuerySet`` which has the methods of
+    ``TaggedQuerySetMixin``.
+    """
+    if isinstance(queryset, TaggedQuerySetMixin):
+        return queryset
+    cls = queryset.__class__
+    klass = _tagged_classes.get(cls)
+    if klass is None:
+        klass = _tagged_classes[cls] = type('Tagged%s' % cls.__name__,
+                                            (TaggedQuerySetMixin, cls), {})
+    return queryset._clone(klass=klass)
+
 class ModelTaggedItemManager(models.Manager):
     """
     A manager for retrieving model instances based on their tags.
+
+    Its querysets have the lazy ``tagged_with_all``, ``tagged_with_any``
+    and ``not_tagged_with`` methods of ``TaggedQuerySetMixin``.
     """
+    def get_query_set(self):
+        return tagged_queryset(super(ModelTaggedItemManager, self).get_query_set())
+
+    def tagged_with_all(self, tags):
+        return self.get_query_set().tagged_with_all(tags)
+
+    def tagged_with_any(self, tags):
+        return self.get_query_set().tagged_with_any(tags)
+
+    def not_tagged_with(self, tags):
+        return self.get_query_set().not_tagged_with(tags)
+
     def related_to(self, obj, queryset=None, num=None):
         if queryset is None:
             return TaggedItem.objects.get_related(obj, self.model, num=num)
@@ -41,28 +177,68 @@ class ModelTaggedItemManager(models.Manager):
         else:
             return TaggedItem.objects.get_by_model(queryset, tags)
 
+    def with_all_page(self, tags, after=None, per_page=None, queryset=None,
+                      descending=False, count=True):
+        """
+        Returns a ``tagging.pagination.KeysetPage`` with up to
+        ``per_page`` instances tagged with *all* the given tags, ordered
+        by primary key and following the instance whose primary key is
+        ``after``. See ``tagging.pagination.tagged_keyset_page``.
+        """
+        from tagging.pagination import tagged_keyset_page
+        if queryset is None:
+            queryset = self.model
+        return tagged_keyset_page(queryset, tags, after, per_page,
+                                  descending, count)
+
     def with_any(self, tags, queryset=None):
         if queryset is None:
             return TaggedItem.objects.get_union_by_model(self.model, tags)
         else:
             return TaggedItem.objects.get_union_by_model(queryset, tags)
 
+    def with_any_ranked(self, tags, weights=None, num=None, offset=0,
+                        queryset=None):
+        if queryset is None:
+            queryset = self.model
+        return TaggedItem.objects.get_ranked_union_by_model(queryset, tags,
+            weights, num, offset)
+
 class TagDescriptor(object):
     """
     A descriptor which provides access to a ``ModelTagManager`` for
     model classes and simple retrieval, updating and deletion of tags
     for model instances.
     """
+    def __init__(self, relation_attr=None):
+        self.relation_attr = relation_attr
+
     def __get__(self, instance, owner):
         if not instance:
             tag_manager = ModelTagManager()
             tag_manager.model = owner
             return tag_manager
-        else:
-            return Tag.objects.get_for_object(instance)
+        # Tags loaded in bulk by ``tagging.generic.fetch_tags`` or by
+        # prefetching the generic relation are returned as a list.
+        tags = getattr(instance, 'tags_cache', None)
+        if tags is not None:
+            return tags
+        prefetched = getattr(instance, '_prefetched_objects_cache', {})
+        if self.relation_attr in prefetched:
+            tags = [item.tag for item in prefetched[self.relation_attr]]
+            tags.sort()
+            return tags
+        return Tag.objects.get_for_object(instance)
 
     def __set__(self, instance, value):
         Tag.objects.update_tags(instance, value)
+        self._clear_cache(instance)
 
     def __delete__(self, instance):
         Tag.objects.update_tags(instance, None)
+        self._clear_cache(instance)
+
+    def _clear_cache(self, instance):
+        # Tags loaded in bulk are out of date once the tags are updated.
+        instance.__dict__.pop('tags_cache', None)
+        getattr(instance, '_prefetched_objects_cache', {}).pop(self.relation_attr, None)
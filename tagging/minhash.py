@@ -0,0 +1,163 @@
+"""
+Approximate related objects, using MinHash signatures of the objects'
+sets of tags and locality-sensitive hashing.
+
+The signature of a set of tags holds, for each of ``TAG_MINHASH_BANDS *
+TAG_MINHASH_ROWS`` hash functions, the smallest hash of the tags' ids.
+Two sets have the same value at any position with a probability equal
+to their Jaccard similarity. Signatures are cut into bands of
+``TAG_MINHASH_ROWS`` values, and each band is hashed into a bucket,
+stored as a ``TagBucket``. Objects sharing a bucket with an object are
+likely to share many of its tags, so they are the only candidates
+considered by ``TaggedItem.objects.get_related(..., approximate=True)``,
+which ranks them exactly.
+
+More bands find more of the related objects, at the cost of more
+buckets per object; more rows per band make buckets more selective and
+lookups faster, but miss objects sharing fewer tags.
+"""
+import random
+import zlib
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from tagging import settings
+
+# A Mersenne prime larger than any tag id.
+_PRIME = (1 << 31) - 1
+_hash_functions = {}
+
+def _get_hash_functions(count):
+    """
+    Returns ``count`` pairs of coefficients of universal hash functions,
+    which are the same in every process.
+    """
+    functions = _hash_functions.get(count)
+    if functions is None:
+        generator = random.Random(count)
+        functions = _hash_functions[count] = [
+            (generator.randint(1, _PRIME - 1), generator.randint(0, _PRIME - 1))
+            for i in range(count)]
+    return functions
+
+def signature(tag_ids):
+    """
+    Returns the MinHash signature of a set of tag ids, as a list of
+    ``TAG_MINHASH_BANDS * TAG_MINHASH_ROWS`` integers, or ``None`` for an
+    empty set.
+    """
+    tag_ids = set(tag_ids)
+    if not tag_ids:
+        return None
+    return [min([(a * tag_id + b) % _PRIME for tag_id in tag_ids])
+            for a, b in _get_hash_functions(
+                settings.TAG_MINHASH_BANDS * settings.TAG_MINHASH_ROWS)]
+
+def buckets(tag_ids):
+    """
+    Returns the list of ``(band, bucket)`` pairs of a set of tag ids.
+    """
+    values = signature(tag_ids)
+    if values is None:
+        return []
+    rows = settings.TAG_MINHASH_ROWS
+    result = []
+    for band in range(settings.TAG_MINHASH_BANDS):
+        key = ','.join([str(value) for value in values[band * rows:(band + 1) * rows]])
+        result.append((band, zlib.crc32(key) & 0x7fffffff))
+    return result
+
+def update_buckets(content_type, object_ids):
+    """
+    Replaces the buckets of the objects of the given content type with
+    the given ids by those of their current tags.
+    """
+    from tagging.models import TagBucket, TaggedItem, _insert_ignore, _write_db
+
+    content_type_id = getattr(content_type, 'pk', content_type)
+    object_ids = list(object_ids)
+    if not object_ids:
+        return
+    tag_ids = {}
+    for object_id, tag_id in TaggedItem._default_manager.filter(
+            content_type__pk=content_type_id, object_id__in=object_ids).values_list(
+                'object_id', 'tag'):
+        tag_ids.setdefault(object_id, []).append(tag_id)
+    rows = []
+    for object_id, ids in tag_ids.iteritems():
+        rows.extend([(content_type_id, object_id, band, bucket)
+                     for band, bucket in buckets(ids)])
+
+    db = _write_db(TagBucket)
+    try:
+        TagBucket._default_manager.filter(content_type__pk=content_type_id,
+                                          object_id__in=object_ids).delete()
+        _insert_ignore(db, TagBucket,
+                       ('content_type_id', 'object_id', 'band', 'bucket'), rows)
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    transaction.commit_unless_managed()
+
+def rebuild(model=None, chunk_size=1000):
+    """
+    Rebuilds the buckets of all tagged objects, or only of the tagged
+    instances of ``model``, ``chunk_size`` objects at a time. Returns
+    the number of objects.
+    """
+    from tagging.models import TagBucket, TaggedItem
+
+    items = TaggedItem._default_manager.all()
+    stale = TagBucket._default_manager.all()
+    if model is not None:
+        content_type = ContentType.objects.get_for_model(model)
+        items = items.filter(content_type__pk=content_type.pk)
+        stale = stale.filter(content_type__pk=content_type.pk)
+    stale.delete()
+    transaction.commit_unless_managed()
+
+    count = 0
+    for content_type_id in items.values_list('content_type', flat=True).distinct().order_by():
+        object_ids = list(items.filter(content_type__pk=content_type_id).values_list(
+            'object_id', flat=True).distinct().order_by('object_id'))
+        for start in range(0, len(object_ids), chunk_size):
+            update_buckets(content_type_id, object_ids[start:start + chunk_size])
+        count += len(object_ids)
+    return count
+
+def candidates(tag_ids, content_type, num, db=None, exclude_id=None):
+    """
+    Returns the ids of up to ``num`` objects of the given content type
+    sharing buckets with a set of tag ids, those sharing most buckets
+    first.
+    """
+    from tagging.models import TagBucket, _connection
+
+    pairs = buckets(tag_ids)
+    if not pairs:
+        return []
+    conn = _connection(db)
+    qn = conn.ops.quote_name
+    query = """
+    SELECT object_id FROM %(bucket)s
+    WHERE content_type_id = %%s
+      AND (%(pairs)s)""" % {
+        'bucket': qn(TagBucket._meta.db_table),
+        'pairs': ' OR '.join(['(band = %s AND bucket = %s)'] * len(pairs)),
+    }
+    params = [getattr(content_type, 'pk', content_type)]
+    for band, bucket in pairs:
+        params.extend([band, bucket])
+    if exclude_id is not None:
+        query += """
+      AND object_id != %s"""
+        params.append(exclude_id)
+    query += """
+    GROUP BY object_id
+    ORDER BY COUNT(*) DESC, object_id
+    LIMIT %s"""
+    params.append(num)
+    cursor = conn.cursor()
+    cursor.execute(query, params)
+    return [row[0] for row in cursor.fetchall()]
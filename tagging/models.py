@@ -8,20 +8,288 @@ except NameError:
     from sets import Set as set
 
 import logging
+import math
+from datetime import datetime, timedelta
 
 logger = logging.getLogger('tagging.models')
 
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models, IntegrityError
+from django.core.cache import cache
+from django.db import connection, models, transaction, IntegrityError
+from django.db.models import signals, Count
 from django.db.models.query import QuerySet
 from django.utils.translation import ugettext_lazy as _
 
 from tagging import settings
-from tagging.utils import calculate_cloud, get_tag_list, get_queryset_and_model, parse_tag_input
+from tagging.utils import calculate_cloud, edit_string_for_tags, format_tag_ids, get_tag_list, get_tag_names, get_queryset_and_model, parse_tag_input
 from tagging.utils import LOGARITHMIC
 
-qn = connection.ops.quote_name
+try:
+    from django.db import connections, router
+except ImportError:
+    # Django before 1.2 only supports a single database.
+    connections = router = None
+
+def _read_db(manager, model):
+    """
+    Returns the alias of the database which read-only aggregate queries
+    about instances of ``model`` should be sent to: the one selected
+    with ``using()`` or ``db_manager()``, the ``TAG_READ_DATABASE``
+    setting or the one chosen by the database routers, in that order.
+    ``None`` means the only database.
+    """
+    db = getattr(manager, '_db', None)
+    if db is not None:
+        return db
+    if settings.TAG_READ_DATABASE is not None:
+        return settings.TAG_READ_DATABASE
+    if router is not None:
+        return router.db_for_read(model)
+    return None
+
+def _write_db(model):
+    """
+    Returns the alias of the database which writes to tagging tables
+    about instances of ``model`` should be sent to, or ``None`` if
+    there is only one database.
+    """
+    if router is not None:
+        return router.db_for_write(model)
+    return None
+
+def _connection(db):
+    if db is None or connections is None:
+        return connection
+    return connections[db]
+
+def _commit_unless_managed(db):
+    if db is None:
+        transaction.commit_unless_managed()
+    else:
+        transaction.commit_unless_managed(using=db)
+
+def _rollback_unless_managed(db):
+    if db is None:
+        transaction.rollback_unless_managed()
+    else:
+        transaction.rollback_unless_managed(using=db)
+
+def _using(queryset, db):
+    if db is None or not hasattr(queryset, 'using'):
+        return queryset
+    return queryset.using(db)
+
+def _is_postgresql(db):
+    return 'postgresql' in _connection(db).__class__.__module__
+
+# Models having a ``tagging.fields.TagIdsField``, mapped to its name.
+tag_ids_fields = {}
+
+def sync_tag_ids(model, object_ids):
+    """
+    Rewrites the ``TagIdsField`` of the instances of ``model`` with the
+    given primary keys, if the model has one.
+    """
+    name = tag_ids_fields.get(model)
+    if name is None or not object_ids:
+        return
+    content_type = ContentType.objects.get_for_model(model)
+    tag_ids = dict([(object_id, []) for object_id in object_ids])
+    for object_id, tag_id in TaggedItem._default_manager.filter(
+            content_type__pk=content_type.pk,
+            object_id__in=object_ids).values_list('object_id', 'tag'):
+        tag_ids[object_id].append(tag_id)
+    # Objects with the same tags are updated together
+    objects = {}
+    for object_id, ids in tag_ids.iteritems():
+        objects.setdefault(format_tag_ids(ids), []).append(object_id)
+    for value, object_ids in objects.iteritems():
+        model._default_manager.filter(pk__in=object_ids).update(**{name: value})
+
+def sync_tag_fields(model, object_ids):
+    """
+    Rewrites the ``TagField``s of the instances of ``model`` with the
+    given primary keys, if the model has any, without loading or saving
+    the instances themselves.
+    """
+    from tagging.fields import TagField
+
+    names = [field.attname for field in model._meta.fields
+             if isinstance(field, TagField)]
+    if not names or not object_ids:
+        return
+    content_type = ContentType.objects.get_for_model(model)
+    object_tags = dict([(object_id, []) for object_id in object_ids])
+    pairs = list(TaggedItem._default_manager.filter(
+        content_type__pk=content_type.pk,
+        object_id__in=object_ids).values_list('object_id', 'tag'))
+    tags = Tag.objects._in_bulk(set([tag_id for object_id, tag_id in pairs]))
+    for object_id, tag_id in pairs:
+        if tag_id in tags:
+            object_tags[object_id].append(tags[tag_id])
+    # Objects with the same tags are updated together
+    objects = {}
+    for object_id, object_tag_list in object_tags.iteritems():
+        object_tag_list.sort()
+        value = edit_string_for_tags([tag.name or tag.name_any
+                                      for tag in object_tag_list])
+        objects.setdefault(value, []).append(object_id)
+    for value, object_ids in objects.iteritems():
+        model._default_manager.filter(pk__in=object_ids).update(
+            **dict([(name, value) for name in names]))
+
+def update_buckets(content_type, object_ids):
+    """
+    Rebuilds the MinHash buckets of the given objects after their tags
+    were changed, if ``TAG_MINHASH`` is on.
+    """
+    if settings.TAG_MINHASH and object_ids:
+        from tagging import minhash
+        minhash.update_buckets(content_type, object_ids)
+
+def _syncs_objects(model):
+    """
+    Tells whether instances of ``model`` hold copies of their tags, or
+    have MinHash buckets, which must be rewritten when tags are added or
+    removed in bulk.
+    """
+    from tagging.fields import TagField
+
+    if model in tag_ids_fields or settings.TAG_MINHASH:
+        return True
+    for field in model._meta.fields:
+        if isinstance(field, TagField):
+            return True
+    return False
+
+def _insert_ignore(db, model, columns, rows):
+    """
+    Inserts the given rows of values for ``columns`` into the table of
+    ``model`` with as few statements as possible, skipping the rows
+    which would violate a unique constraint. Returns the number of
+    inserted rows, or of rows if it isn't known.
+
+    This uses ``INSERT OR IGNORE`` on SQLite, ``INSERT IGNORE`` on MySQL
+    and ``ON CONFLICT DO NOTHING`` on PostgreSQL 9.5 and later. Other
+    databases fall back to inserting each row in a savepoint. Either way,
+    no signals are sent.
+    """
+    conn = _connection(db)
+    module = conn.__class__.__module__
+    qn = conn.ops.quote_name
+    table = qn(model._meta.db_table)
+    column_list = ', '.join([qn(column) for column in columns])
+    row_placeholders = '(%s)' % ', '.join(['%s'] * len(columns))
+    cursor = conn.cursor()
+    query = None
+    if 'sqlite3' in module:
+        query = 'INSERT OR IGNORE INTO %s (%s) VALUES %s'
+    elif 'mysql' in module:
+        query = 'INSERT IGNORE INTO %s (%s) VALUES %s'
+    elif 'postgresql' in module:
+        # Connect, so that the server version is known.
+        conn.cursor()
+        if getattr(conn.connection, 'server_version', 0) >= 90500:
+            query = 'INSERT INTO %s (%s) VALUES %s ON CONFLICT DO NOTHING'
+
+    if query is None:
+        added = 0
+        for row in rows:
+            sid = transaction.savepoint()
+            try:
+                cursor.execute('INSERT INTO %s (%s) VALUES %s' % (
+                    table, column_list, row_placeholders), list(row))
+                transaction.savepoint_commit(sid)
+                added += 1
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+        return added
+
+    added = 0
+    # Some databases limit the number of parameters of a statement.
+    for start in range(0, len(rows), 100):
+        chunk = rows[start:start + 100]
+        params = []
+        for row in chunk:
+            params.extend(row)
+        cursor.execute(query % (table, column_list,
+                                ', '.join([row_placeholders] * len(chunk))), params)
+        if cursor.rowcount < 0:
+            added += len(chunk)
+        else:
+            added += cursor.rowcount
+    return added
+
+def _tag_names_table():
+    """
+    Returns the name of the table holding tag names and of its column
+    holding tag ids. Multilingual tags have their names, in any
+    language, in the table of their translations.
+    """
+    if settings.MULTILINGUAL_TAGS:
+        return Tag._meta.translation_model._meta.db_table, 'master_id'
+    return Tag._meta.db_table, 'id'
+
+def _tag_weight(weights, tag):
+    """
+    Returns the weight of the given tag in a dictionary keyed by tags,
+    tag ids or tag names, defaulting to ``1``.
+    """
+    for key in (tag, tag.pk, tag.name):
+        if key in weights:
+            return weights[key]
+    return 1
+
+def _in_bulk_ordered(queryset, object_ids):
+    """
+    Returns the instances of ``queryset`` with the given ids, in the
+    order of the ids.
+    """
+    if not object_ids:
+        return []
+    # in_bulk keeps the ordering, which a pk__in lookup would lose.
+    object_dict = queryset.in_bulk(object_ids)
+    return [object_dict[object_id] for object_id in object_ids
+            if object_id in object_dict]
+
+def _content_types_for(models):
+    """
+    Returns a dictionary mapping the ids of the content types of the
+    given models, or of all registered models if ``models`` is ``None``,
+    to the models.
+    """
+    if models is None:
+        import tagging
+        models = tagging.registry
+    return dict([(ContentType.objects.get_for_model(model).pk, model)
+                 for model in models])
+
+def _pk_subquery(queryset, db):
+    """
+    Returns the SQL and parameters of a query selecting the primary
+    keys of the objects in ``queryset``.
+    """
+    query = queryset.order_by().values('pk').query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(using=db or queryset.db).as_sql()
+    return query.as_sql()
+
+def _restrict_to_queryset(queryset, db, column, criteria, params):
+    """
+    Adds a criterion restricting ``column`` to the primary keys of the
+    objects in ``queryset``, unless it's unfiltered.
+    """
+    if queryset.query.where:
+        subquery, subquery_params = _pk_subquery(queryset, db)
+        criteria.append('%s IN (%s)' % (column, subquery))
+        params.extend(subquery_params)
+
+def _tag_ids_model(content_type_id):
+    for model in tag_ids_fields:
+        if ContentType.objects.get_for_model(model).pk == content_type_id:
+            return model
+    return None
 
 if settings.MULTILINGUAL_TAGS:
     import multilingual
@@ -29,6 +297,21 @@ if settings.MULTILINGUAL_TAGS:
 else:
     BaseManager = models.Manager
 
+def preload_translations(tags):
+    """
+    Retrieves the names of the given multilingual tags in the current
+    and the fallback languages with a single query, so that displaying
+    them, including through the fallback of ``get_name``, doesn't hit
+    the database once per tag. Does nothing for monolingual tags.
+    """
+    if not settings.MULTILINGUAL_TAGS or not tags:
+        return
+    from tagging.generic import fetch_translations
+    languages = [multilingual.languages.get_default_language()]
+    if settings.FALLBACK_LANGUAGE not in languages:
+        languages.append(settings.FALLBACK_LANGUAGE)
+    fetch_translations(tags, languages)
+
 ############
 # Managers #
 ############
@@ -37,44 +320,186 @@ class TagManager(BaseManager):
     def update_tags(self, obj, tag_names):
         """
         Update tags associated with an object.
+
+        Missing tags are created, and associations are removed and added
+        with a single statement each, which are committed together.
+        Associations or tags created concurrently by another process are
+        tolerated.
         """
         ctype = ContentType.objects.get_for_model(obj)
         current_tags = list(self.filter(items__content_type__pk=ctype.pk,
                                         items__object_id=obj.pk))
-        updated_tag_names = parse_tag_input(tag_names)
-        if settings.FORCE_LOWERCASE_TAGS:
-            updated_tag_names = [t.lower() for t in updated_tag_names]
+        updated_tag_names = self._parse_names(tag_names)
 
         # Remove tags which no longer apply
         tags_for_removal = [tag for tag in current_tags \
                             if tag.name not in updated_tag_names]
-        if len(tags_for_removal):
-            TaggedItem._default_manager.filter(content_type__pk=ctype.pk,
-                                               object_id=obj.pk,
-                                               tag__in=tags_for_removal).delete()
         # Add new tags
         current_tag_names = [tag.name or tag.name_any for tag in current_tags]
-        for tag_name in updated_tag_names:
-            if tag_name not in current_tag_names:
-                tag, created = self.get_or_create(name=tag_name)
-                TaggedItem._default_manager.create(tag=tag, object=obj)
+        tags_for_addition = self._get_or_create_tags(
+            [tag_name for tag_name in updated_tag_names
+             if tag_name not in current_tag_names])
+        TaggedItem._default_manager._replace_tags(ctype, obj.pk,
+            [tag.pk for tag in tags_for_addition],
+            [tag.pk for tag in tags_for_removal])
 
     def add_tag(self, obj, tag_name):
         """
         Associates the given object with a tag.
         """
-        tag_names = parse_tag_input(tag_name)
+        tag_names = self._parse_names(tag_name)
         if not len(tag_names):
             raise AttributeError(_('No tags were given: "%s".') % tag_name)
         if len(tag_names) > 1:
             raise AttributeError(_('Multiple tags were given: "%s".') % tag_name)
-        tag_name = tag_names[0]
-        if settings.FORCE_LOWERCASE_TAGS:
-            tag_name = tag_name.lower()
-        tag, created = self.get_or_create(name=tag_name)
+        tag = self._get_or_create_tags(tag_names)[0]
         ctype = ContentType.objects.get_for_model(obj)
-        TaggedItem._default_manager.get_or_create(
-            tag=tag, content_type=ctype, object_id=obj.pk)
+        TaggedItem._default_manager._replace_tags(ctype, obj.pk, [tag.pk])
+
+    def add_tag_to_queryset(self, queryset_or_model, tag_names):
+        """
+        Associates all the objects in the given queryset or model with
+        the given tags, using a single ``INSERT ... SELECT`` statement
+        per tag. Objects which already have a tag are skipped.
+
+        ``TagField``s and ``TagIdsField``s of the objects are updated in
+        bulk, without saving the objects. Returns the number of new
+        associations.
+        """
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        tags = self._get_or_create_tags(self._parse_names(tag_names))
+        content_type = ContentType.objects.get_for_model(model)
+        db = _write_db(TaggedItem)
+        qn = _connection(db).ops.quote_name
+        model_pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+        subquery, subquery_params = _pk_subquery(queryset, db)
+        query = """
+        INSERT INTO %(tagged_item)s (tag_id, content_type_id, object_id)
+        SELECT %%s, %%s, %(model_pk)s
+        FROM %(model)s
+        WHERE %(model_pk)s IN (%(subquery)s)
+          AND NOT EXISTS (
+            SELECT 1 FROM %(tagged_item)s existing
+            WHERE existing.tag_id = %%s
+              AND existing.content_type_id = %%s
+              AND existing.object_id = %(model_pk)s)""" % {
+            'tagged_item': qn(TaggedItem._meta.db_table),
+            'model': qn(model._meta.db_table),
+            'model_pk': model_pk,
+            'subquery': subquery,
+        }
+
+        sync = _syncs_objects(model)
+        affected = set()
+        added = 0
+        cursor = _connection(db).cursor()
+        for tag in tags:
+            if sync:
+                # Objects which are about to get the tag, whose fields
+                # must be rewritten.
+                affected.update(queryset.exclude(pk__in=TaggedItem._default_manager.filter(
+                    tag__pk=tag.pk, content_type__pk=content_type.pk).values(
+                        'object_id')).values_list('pk', flat=True))
+            cursor.execute(query, [tag.pk, content_type.pk] + list(subquery_params)
+                                  + [tag.pk, content_type.pk])
+            if cursor.rowcount > 0:
+                added += cursor.rowcount
+                TagStamp.objects.touch(tag, content_type)
+                TagCounter.objects.record(tag, content_type, count=cursor.rowcount)
+        transaction.commit_unless_managed()
+        self._sync_objects(model, affected)
+        return added
+
+    def remove_tag_from_queryset(self, queryset_or_model, tag_names):
+        """
+        Removes the given tags from all the objects in the given
+        queryset or model, using a single ``DELETE`` statement.
+
+        ``TagField``s and ``TagIdsField``s of the objects are updated in
+        bulk, without saving the objects. Returns the number of removed
+        associations.
+        """
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        tags = get_tag_list(tag_names)
+        if not tags:
+            return 0
+        content_type = ContentType.objects.get_for_model(model)
+        tag_ids = [tag.pk for tag in tags]
+        affected = set()
+        if _syncs_objects(model):
+            affected.update(TaggedItem._default_manager.filter(
+                tag__pk__in=tag_ids, content_type__pk=content_type.pk,
+                object_id__in=queryset.values('pk')).values_list('object_id', flat=True))
+
+        db = _write_db(TaggedItem)
+        qn = _connection(db).ops.quote_name
+        subquery, subquery_params = _pk_subquery(queryset, db)
+        tagged_item_table = qn(TaggedItem._meta.db_table)
+        cursor = _connection(db).cursor()
+        # The derived table is materialized first, so that MySQL accepts
+        # a queryset which itself joins the tagged items.
+        cursor.execute("""
+        DELETE FROM %(tagged_item)s
+        WHERE %(tagged_item)s.content_type_id = %%s
+          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
+          AND %(tagged_item)s.object_id IN (
+            SELECT * FROM (%(subquery)s) selected_objects)""" % {
+            'tagged_item': tagged_item_table,
+            'tag_id_placeholders': ','.join(['%s'] * len(tag_ids)),
+            'subquery': subquery,
+        }, [content_type.pk] + tag_ids + list(subquery_params))
+        removed = cursor.rowcount
+        transaction.commit_unless_managed()
+        if not removed:
+            return 0
+        for tag in tags:
+            TagStamp.objects.touch(tag, content_type, create=False)
+        self._sync_objects(model, affected)
+        return removed
+
+    def _parse_names(self, tag_names):
+        names = parse_tag_input(tag_names)
+        if settings.FORCE_LOWERCASE_TAGS:
+            names = [name.lower() for name in names]
+        return names
+
+    def _get_or_create_tags(self, names):
+        """
+        Returns the tags with the given names, creating the missing
+        ones. Existing tags are looked up with a single query.
+        """
+        if not names:
+            return []
+        existing = {}
+        for tag in self.filter(name__in=names):
+            existing[tag.name or tag.name_any] = tag
+        tags = []
+        for name in names:
+            tag = existing.get(name)
+            if tag is None:
+                tag = self._get_or_create_tag(name)
+            tags.append(tag)
+        return tags
+
+    def _get_or_create_tag(self, name):
+        sid = transaction.savepoint()
+        try:
+            tag, created = self.get_or_create(name=name)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Somebody else has created the tag in the meantime.
+            transaction.savepoint_rollback(sid)
+            tag = self.get(name=name)
+        return tag
+
+    def _sync_objects(self, model, object_ids):
+        object_ids = list(object_ids)
+        chunk_size = settings.TAG_FETCH_CHUNK_SIZE
+        for start in range(0, len(object_ids), chunk_size):
+            chunk = object_ids[start:start + chunk_size]
+            sync_tag_fields(model, chunk)
+            sync_tag_ids(model, chunk)
+            update_buckets(ContentType.objects.get_for_model(model), chunk)
 
     def get_for_object(self, obj):
         """
@@ -82,24 +507,59 @@ class TagManager(BaseManager):
         object.
         """
         ctype = ContentType.objects.get_for_model(obj)
-        return self.filter(items__content_type__pk=ctype.pk,
-                           items__object_id=obj.pk)
+        queryset = self.filter(items__content_type__pk=ctype.pk,
+                               items__object_id=obj.pk)
+        if settings.MULTILINGUAL_TAGS:
+            from tagging.generic import prefetch_queryset
+            queryset = prefetch_queryset(queryset, preload_translations)
+        return queryset
+
+    def _in_bulk(self, tag_ids, db=None):
+        """
+        Returns a dictionary of the tags with the given ids, with the
+        names of multilingual tags preloaded.
+        """
+        tags = _using(self.all(), db).in_bulk(tag_ids)
+        preload_translations(tags.values())
+        return tags
 
-    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None):
+    def _get_usage(self, model, counts=False, min_count=None, extra_joins=None, extra_criteria=None, params=None, db=None, include_descendants=False):
         """
         Perform the custom SQL query for ``usage_for_model`` and
         ``usage_for_queryset``.
         """
         if min_count is not None: counts = True
 
+        qn = _connection(db).ops.quote_name
         model_table = qn(model._meta.db_table)
         model_pk = '%s.%s' % (model_table, qn(model._meta.pk.column))
+        tag_table = qn(self.model._meta.db_table)
+        tagged_item_table = qn(TaggedItem._meta.db_table)
+        if include_descendants:
+            # Each tag is counted for the items of all its descendants,
+            # counting an object having several of them only once.
+            closure_table = qn(TagClosure._meta.db_table)
+            tag_join = """INNER JOIN %(closure)s
+                ON %(tag)s.id = %(closure)s.ancestor_id
+            INNER JOIN %(tagged_item)s
+                ON %(closure)s.descendant_id = %(tagged_item)s.tag_id""" % {
+                'closure': closure_table,
+                'tag': tag_table,
+                'tagged_item': tagged_item_table,
+            }
+            count_expression = 'COUNT(DISTINCT %s)' % model_pk
+        else:
+            tag_join = """INNER JOIN %(tagged_item)s
+                ON %(tag)s.id = %(tagged_item)s.tag_id""" % {
+                'tag': tag_table,
+                'tagged_item': tagged_item_table,
+            }
+            count_expression = 'COUNT(%s)' % model_pk
         query = """
         SELECT DISTINCT %(tag)s.id%(count_sql)s
         FROM
             %(tag)s
-            INNER JOIN %(tagged_item)s
-                ON %(tag)s.id = %(tagged_item)s.tag_id
+            %(tag_join)s
             INNER JOIN %(model)s
                 ON %(tagged_item)s.object_id = %(model_pk)s
             %%s
@@ -107,9 +567,10 @@ class TagManager(BaseManager):
             %%s
         GROUP BY %(tag)s.id
         %%s""" % {
-            'tag': qn(self.model._meta.db_table),
-            'count_sql': counts and (', COUNT(%s)' % model_pk) or '',
-            'tagged_item': qn(TaggedItem._meta.db_table),
+            'tag': tag_table,
+            'tag_join': tag_join,
+            'count_sql': counts and (', %s' % count_expression) or '',
+            'tagged_item': tagged_item_table,
             'model': model_table,
             'model_pk': model_pk,
             'content_type_id': ContentType.objects.get_for_model(model).pk,
@@ -117,22 +578,26 @@ class TagManager(BaseManager):
 
         min_count_sql = ''
         if min_count is not None:
-            min_count_sql = 'HAVING COUNT(%s) >= %%s' % model_pk
+            min_count_sql = 'HAVING %s >= %%s' % count_expression
             params.append(min_count)
 
-        cursor = connection.cursor()
+        cursor = _connection(db).cursor()
         cursor.execute(query % (extra_joins, extra_criteria, min_count_sql), params)
+        rows = cursor.fetchall()
+        tags_by_id = self._in_bulk([row[0] for row in rows], db)
         tags = []
         # TODO add ordering by name right here
-        for row in cursor.fetchall():
-            t = self.model.objects.get(pk = row[0])
+        for row in rows:
+            t = tags_by_id.get(row[0])
+            if t is None:
+                continue
             if counts:
                 t.count = row[1]
             tags.append(t)
         tags.sort()
         return tags
 
-    def usage_for_model(self, model, counts=False, min_count=None, filters=None):
+    def usage_for_model(self, model, counts=False, min_count=None, filters=None, include_descendants=False):
         """
         Obtain a list of tags associated with instances of the given
         Model class.
@@ -149,17 +614,21 @@ class TagManager(BaseManager):
         used by a subset of the Model's instances, pass a dictionary
         of field lookups to be applied to the given Model as the
         ``filters`` argument.
+
+        If ``include_descendants`` is ``True``, each tag is considered
+        to be used by all instances having any of its descendants in
+        the tag hierarchy (see ``TagClosure``).
         """
         if filters is None: filters = {}
 
         queryset = model._default_manager.filter()
         for f in filters.items():
             queryset.query.add_filter(f)
-        usage = self.usage_for_queryset(queryset, counts, min_count)
+        usage = self.usage_for_queryset(queryset, counts, min_count, include_descendants)
 
         return usage
 
-    def usage_for_queryset(self, queryset, counts=False, min_count=None):
+    def usage_for_queryset(self, queryset, counts=False, min_count=None, include_descendants=False):
         """
         Obtain a list of tags associated with instances of a model
         contained in the given queryset.
@@ -171,15 +640,88 @@ class TagManager(BaseManager):
         If ``min_count`` is given, only tags which have a ``count``
         greater than or equal to ``min_count`` will be returned.
         Passing a value for ``min_count`` implies ``counts=True``.
-        """
 
-        extra_joins = ' '.join(queryset.query.get_from_clause()[0][1:])
-        where, params = queryset.query.where.as_sql()
+        If ``include_descendants`` is ``True``, each tag is considered
+        to be used by all instances having any of its descendants in
+        the tag hierarchy (see ``TagClosure``).
+        """
+        db = _read_db(self, queryset.model)
+        if hasattr(queryset.query, 'get_compiler'):
+            # Django 1.2 and later build SQL with per-database compilers.
+            compiler = queryset.query.get_compiler(using=db or queryset.db)
+            extra_joins = ' '.join(compiler.get_from_clause()[0][1:])
+            where, params = queryset.query.where.as_sql(
+                compiler.quote_name_unless_alias, compiler.connection)
+        else:
+            extra_joins = ' '.join(queryset.query.get_from_clause()[0][1:])
+            where, params = queryset.query.where.as_sql()
         if where:
             extra_criteria = 'AND %s' % where
         else:
             extra_criteria = ''
-        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params)
+        return self._get_usage(queryset.model, counts, min_count, extra_joins, extra_criteria, params, db, include_descendants)
+
+    def usage_for_models(self, models=None, counts=False, min_count=None):
+        """
+        Obtain a list of tags associated with instances of any of the
+        given Model classes, or of any registered model if ``models`` is
+        ``None``, with a single query grouping tagged items by tag and
+        content type. As in ``usage_for_model``, tagged items are joined
+        with the tables of the models, so items of deleted instances
+        aren't counted.
+
+        If ``counts`` is True, a ``count`` attribute will be added to
+        each tag, indicating how many times it has been used against
+        all the models, and a ``model_counts`` attribute, mapping each
+        of those models to the number of times it has been used against
+        it.
+
+        If ``min_count`` is given, only tags which have a ``count``
+        greater than or equal to ``min_count`` will be returned.
+        Passing a value for ``min_count`` implies ``counts=True``.
+        """
+        if min_count is not None: counts = True
+        content_types = _content_types_for(models)
+        if not content_types:
+            return []
+        db = _read_db(self, content_types.values()[0])
+        qn = _connection(db).ops.quote_name
+        tagged_item_table = qn(TaggedItem._meta.db_table)
+        # Each model's table is joined by its own part of the query.
+        parts = []
+        for model in content_types.values():
+            model_table = qn(model._meta.db_table)
+            parts.append("""
+        SELECT %(tagged_item)s.tag_id, %(tagged_item)s.content_type_id, COUNT(%(model_pk)s)
+        FROM %(tagged_item)s
+            INNER JOIN %(model)s
+                ON %(tagged_item)s.object_id = %(model_pk)s
+        WHERE %(tagged_item)s.content_type_id = %%s
+        GROUP BY %(tagged_item)s.tag_id, %(tagged_item)s.content_type_id""" % {
+                'tagged_item': tagged_item_table,
+                'model': model_table,
+                'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
+            })
+        cursor = _connection(db).cursor()
+        cursor.execute('\n        UNION ALL'.join(parts), content_types.keys())
+        model_counts = {}
+        for tag_id, content_type_id, count in cursor.fetchall():
+            model_counts.setdefault(tag_id, {})[content_types[content_type_id]] = count
+
+        tags_by_id = self._in_bulk(model_counts.keys(), db)
+        tags = []
+        for tag_id, by_model in model_counts.iteritems():
+            t = tags_by_id.get(tag_id)
+            if t is None:
+                continue
+            if counts:
+                t.count = sum(by_model.values())
+                if min_count is not None and t.count < min_count:
+                    continue
+                t.model_counts = by_model
+            tags.append(t)
+        tags.sort()
+        return tags
 
     def related_for_model(self, tags, model, counts=False, min_count=None):
         """
@@ -197,6 +739,8 @@ class TagManager(BaseManager):
         if min_count is not None: counts = True
         tags = get_tag_list(tags)
         tag_count = len(tags)
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
         tagged_item_table = qn(TaggedItem._meta.db_table)
         query = """
         SELECT %(tag)s.id%(count_sql)s
@@ -228,11 +772,15 @@ class TagManager(BaseManager):
         if min_count is not None:
             params.append(min_count)
 
-        cursor = connection.cursor()
+        cursor = _connection(db).cursor()
         cursor.execute(query, params)
+        rows = cursor.fetchall()
+        tags = self._in_bulk([row[0] for row in rows], db)
         related = []
-        for row in cursor.fetchall():
-            tag = self.model.objects.get(pk = row[0])
+        for row in rows:
+            tag = tags.get(row[0])
+            if tag is None:
+                continue
             if counts is True:
                 tag.count = row[1]
             related.append(tag)
@@ -268,6 +816,38 @@ class TagManager(BaseManager):
                                          min_count=min_count))
         return calculate_cloud(tags, steps, distribution)
 
+    def trending(self, model, window=None, limit=10):
+        """
+        Obtain a list of the tags which were most often added to
+        instances of the given Model during the last ``window`` (a
+        ``timedelta``, one week by default), giving each tag a ``count``
+        attribute with the number of times it was added.
+
+        Counts are read from the hourly and daily ``TagCounter``
+        buckets, so the window is only as precise as the buckets which
+        remain after compaction. At most ``limit`` tags are returned,
+        unless it is ``None``.
+        """
+        if window is None:
+            window = timedelta(days=7)
+        db = _read_db(self, model)
+        content_type = ContentType.objects.get_for_model(model)
+        since = TagCounter.bucket_start(datetime.now() - window, TagCounter.HOUR)
+        scores = _using(TagCounter.objects.all(), db).filter(
+            content_type__pk=content_type.pk, start__gte=since).values(
+                'tag').annotate(score=models.Sum('count')).order_by('-score')
+        if limit is not None:
+            scores = scores[:limit]
+        scores = list(scores)
+        tags = self._in_bulk([row['tag'] for row in scores], db)
+        trending = []
+        for row in scores:
+            tag = tags.get(row['tag'])
+            if tag is not None:
+                tag.count = row['score']
+                trending.append(tag)
+        return trending
+
     def process_rules(self, rules):
         for line in rules.split('\n'):
             self._process_line(line)
@@ -327,7 +907,10 @@ class TagManager(BaseManager):
                     tag.save()
 
     def dumpAsText(self):
-        tags = self.all()
+        from tagging.generic import fetch_synonyms, fetch_translations
+        tags = list(self.all())
+        fetch_synonyms(tags)
+        fetch_translations(tags)
         return '\n'.join(filter(lambda x: x, \
                 [self.dumpSynonymsAsText(t) for t in tags] + \
                 [self.dumpTagAsText(t) for t in tags]))
@@ -342,7 +925,9 @@ class TagManager(BaseManager):
         return '; '.join(parts)
 
     def dumpSynonymsAsText(self, tag):
-        synonyms = tag.synonyms.all()
+        synonyms = getattr(tag, 'synonyms_cache', None)
+        if synonyms is None:
+            synonyms = tag.synonyms.all()
         if len(synonyms) > 0:
             return ' == '.join([tag.name, ] + [s.name for s in synonyms])
         return ''
@@ -375,11 +960,119 @@ class TaggedItemManager(models.Manager):
           Now that the queryset-refactor branch is in the trunk, this can be
           tidied up significantly.
     """
-    def get_by_model(self, queryset_or_model, tags):
+    def _replace_tags(self, content_type, object_id, add_ids=(), remove_ids=()):
+        """
+        Adds and removes the associations of an object with the tags
+        with the given ids, with a single statement each, and commits
+        them together.
+
+        Associations which already exist are ignored instead of
+        violating the unique constraint (see ``_insert_ignore``).
+
+        Since signals aren't sent, this updates stamps, trending
+        counters and ``TagIdsField``s itself.
+        """
+        add_ids, remove_ids = list(add_ids), list(remove_ids)
+        if not add_ids and not remove_ids:
+            return
+        db = _write_db(self.model)
+        conn = _connection(db)
+        qn = conn.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        cursor = conn.cursor()
+        try:
+            if remove_ids:
+                cursor.execute("""
+                DELETE FROM %s
+                WHERE content_type_id = %%s AND object_id = %%s
+                  AND tag_id IN (%s)""" % (table, ','.join(['%s'] * len(remove_ids))),
+                    [content_type.pk, object_id] + remove_ids)
+            added = 0
+            if add_ids:
+                added = _insert_ignore(db, self.model,
+                    ('tag_id', 'content_type_id', 'object_id'),
+                    [(tag_id, content_type.pk, object_id) for tag_id in add_ids])
+        except:
+            transaction.rollback_unless_managed()
+            raise
+        transaction.commit_unless_managed()
+
+        if added:
+            TagStamp.objects.touch_all(add_ids, content_type)
+            # When some associations were added concurrently by another
+            # writer, which counts them, the ones added here can't be
+            # told apart on every database, so none are counted rather
+            # than counting any twice.
+            if added == len(add_ids):
+                TagCounter.objects.record_all(add_ids, content_type)
+        if remove_ids:
+            TagStamp.objects.touch_all(remove_ids, content_type, create=False)
+        if added or remove_ids:
+            sync_tag_ids(_tag_ids_model(content_type.pk), [object_id])
+            update_buckets(content_type, [object_id])
+
+    def _filter_by_names(self, queryset_or_model, names, require_all):
+        """
+        Restricts the given queryset or model to the instances associated
+        with all (or, unless ``require_all``, any) of the tags with the
+        given names or synonyms, resolving the names in the same SQL
+        statement.
+        """
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        if not names:
+            return model._default_manager.none()
+        qn = _connection(getattr(queryset, 'db', None)).ops.quote_name
+        names_table, names_tag_id = _tag_names_table()
+        name_placeholders = ','.join(['%s'] * len(names))
+        # Each matched tag id is paired with the name it was matched by.
+        subquery = """
+            SELECT %(tagged_item)s.object_id
+            FROM %(tagged_item)s INNER JOIN (
+                SELECT n.%(name)s AS name, n.%(names_tag_id)s AS tag_id
+                FROM %(names)s n WHERE n.%(name)s IN (%(name_placeholders)s)
+                UNION
+                SELECT s.%(name)s AS name, s.tag_id AS tag_id
+                FROM %(synonym)s s WHERE s.%(name)s IN (%(name_placeholders)s)
+            ) matched ON %(tagged_item)s.tag_id = matched.tag_id
+            WHERE %(tagged_item)s.content_type_id = %%s""" % {
+            'tagged_item': qn(self.model._meta.db_table),
+            'name': qn('name'),
+            'names': qn(names_table),
+            'names_tag_id': qn(names_tag_id),
+            'synonym': qn(Synonym._meta.db_table),
+            'name_placeholders': name_placeholders,
+        }
+        if require_all:
+            subquery += """
+            GROUP BY %s.object_id
+            HAVING COUNT(DISTINCT matched.name) = %d""" % (
+                qn(self.model._meta.db_table), len(names))
+        model_pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+        return queryset.extra(
+            where=['%s IN (%s)' % (model_pk, subquery)],
+            params=list(names) + list(names)
+                   + [ContentType.objects.get_for_model(model).pk],
+        )
+
+    def get_by_model(self, queryset_or_model, tags, include_descendants=False,
+                     resolve_synonyms=False):
         """
         Create a ``QuerySet`` containing instances of the specified
         model associated with a given tag or list of tags.
+
+        If ``include_descendants`` is ``True``, instances associated
+        with any descendant of a tag in the tag hierarchy are considered
+        to be associated with the tag itself.
+
+        If ``resolve_synonyms`` is ``True`` and tags are given by name,
+        the names may also be synonyms, and are looked up by the same
+        SQL statement as the instances. Names matching neither a tag
+        nor a synonym match no instances.
         """
+        if resolve_synonyms and not include_descendants:
+            names = get_tag_names(tags)
+            if names is not None:
+                return self._filter_by_names(queryset_or_model, names, True)
         tags = get_tag_list(tags)
         tag_count = len(tags)
         if tag_count == 0:
@@ -391,12 +1084,33 @@ class TaggedItemManager(models.Manager):
             # query below.
             tag = tags[0]
         else:
-            return self.get_intersection_by_model(queryset_or_model, tags)
+            return self.get_intersection_by_model(queryset_or_model, tags,
+                                                  include_descendants)
 
         queryset, model = get_queryset_and_model(queryset_or_model)
         content_type = ContentType.objects.get_for_model(model)
+        qn = _connection(getattr(queryset, 'db', None)).ops.quote_name
         opts = self.model._meta
         tagged_item_table = qn(opts.db_table)
+        if include_descendants:
+            closure_table = qn(TagClosure._meta.db_table)
+            return queryset.extra(
+                where=["""%(model_pk)s IN (
+                    SELECT %(tagged_item)s.object_id
+                    FROM %(tagged_item)s INNER JOIN %(closure)s
+                        ON %(tagged_item)s.tag_id = %(closure)s.descendant_id
+                    WHERE %(tagged_item)s.content_type_id = %%s
+                      AND %(closure)s.ancestor_id = %%s)""" % {
+                    'model_pk': '%s.%s' % (qn(model._meta.db_table),
+                                           qn(model._meta.pk.column)),
+                    'tagged_item': tagged_item_table,
+                    'closure': closure_table,
+                }],
+                params=[content_type.pk, tag.pk],
+            )
+        contained = self._filter_tag_ids(queryset, model, [tag], '@>')
+        if contained is not None:
+            return contained
         return queryset.extra(
             tables=[opts.db_table],
             where=[
@@ -409,11 +1123,48 @@ class TaggedItemManager(models.Manager):
             params=[content_type.pk, tag.pk],
         )
 
-    def get_intersection_by_model(self, queryset_or_model, tags):
+    def _filter_tag_ids(self, queryset, model, tags, operator):
+        """
+        Filters the given queryset with an array operator applied to the
+        model's ``TagIdsField`` and the ids of the given tags, avoiding
+        joins with tagged items.
+
+        Returns ``None`` if the model has no such field or the database
+        doesn't support arrays, in which case joins must be used.
+        """
+        name = tag_ids_fields.get(model)
+        db = getattr(queryset, 'db', None)
+        if name is None or not settings.TAG_IDS_LOOKUPS or not _is_postgresql(db):
+            return None
+        qn = _connection(db).ops.quote_name
+        column = '%s.%s' % (qn(model._meta.db_table),
+                            qn(model._meta.get_field(name).column))
+        # An index on this very expression makes the lookup fast:
+        # CREATE INDEX ... USING gin ((string_to_array(...)::integer[]))
+        return queryset.extra(
+            where=["string_to_array(trim(both ',' from %s), ',')::integer[] %s ARRAY[%s]::integer[]" % (
+                column, operator, ','.join(['%s'] * len(tags)))],
+            params=[tag.pk for tag in tags],
+        )
+
+    def get_intersection_by_model(self, queryset_or_model, tags, include_descendants=False,
+                                  resolve_synonyms=False):
         """
         Create a ``QuerySet`` containing instances of the specified
         model associated with *all* of the given list of tags.
+
+        If ``include_descendants`` is ``True``, an instance is
+        considered to be associated with a tag if it is associated with
+        the tag or any of its descendants in the tag hierarchy.
+
+        If ``resolve_synonyms`` is ``True`` and tags are given by name,
+        the names may also be synonyms, and are looked up by the same
+        SQL statement as the instances.
         """
+        if resolve_synonyms and not include_descendants:
+            names = get_tag_names(tags)
+            if names is not None:
+                return self._filter_by_names(queryset_or_model, names, True)
         tags = get_tag_list(tags)
         tag_count = len(tags)
         queryset, model = get_queryset_and_model(queryset_or_model)
@@ -421,38 +1172,146 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
+        if not include_descendants:
+            contained = self._filter_tag_ids(queryset, model, tags, '@>')
+            if contained is not None:
+                return contained
+
+        db = _read_db(self, model)
+        query = self._intersection_query(db, model, tags, include_descendants)
+        object_ids = self._object_ids(db, model, tags, query,
+                                      not include_descendants and 'all' or None)
+        if len(object_ids) > 0:
+            return queryset.filter(pk__in=object_ids)
+        else:
+            return model._default_manager.none()
+
+    def _intersection_query(self, db, model, tags, include_descendants=False,
+                            criteria=()):
+        """
+        Returns a query selecting the ids of the instances of ``model``
+        having all the given tags and matching the given SQL
+        ``criteria``. Its parameters are the ids of the tags, followed
+        by those of the criteria.
+        """
+        qn = _connection(db).ops.quote_name
         model_table = qn(model._meta.db_table)
+        model_pk = '%s.%s' % (model_table, qn(model._meta.pk.column))
+        tagged_item_table = qn(self.model._meta.db_table)
+        if include_descendants:
+            closure_table = qn(TagClosure._meta.db_table)
+            tables = '%s, %s, %s' % (model_table, tagged_item_table, closure_table)
+            tag_criteria = """%(closure)s.descendant_id = %(tagged_item)s.tag_id
+          AND %(closure)s.ancestor_id""" % {
+                'closure': closure_table,
+                'tagged_item': tagged_item_table,
+            }
+            count_expression = 'COUNT(DISTINCT %s.ancestor_id)' % closure_table
+        else:
+            tables = '%s, %s' % (model_table, tagged_item_table)
+            tag_criteria = '%s.tag_id' % tagged_item_table
+            count_expression = 'COUNT(%s)' % model_pk
         # This query selects the ids of all objects which have all the
         # given tags.
-        query = """
+        return """
         SELECT %(model_pk)s
-        FROM %(model)s, %(tagged_item)s
+        FROM %(tables)s
         WHERE %(tagged_item)s.content_type_id = %(content_type_id)s
-          AND %(tagged_item)s.tag_id IN (%(tag_id_placeholders)s)
-          AND %(model_pk)s = %(tagged_item)s.object_id
+          AND %(tag_criteria)s IN (%(tag_id_placeholders)s)
+          AND %(model_pk)s = %(tagged_item)s.object_id%(criteria)s
         GROUP BY %(model_pk)s
-        HAVING COUNT(%(model_pk)s) = %(tag_count)s""" % {
-            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
-            'model': model_table,
-            'tagged_item': qn(self.model._meta.db_table),
+        HAVING %(count)s = %(tag_count)s""" % {
+            'model_pk': model_pk,
+            'tables': tables,
+            'tagged_item': tagged_item_table,
+            'tag_criteria': tag_criteria,
+            'criteria': ''.join(['\n          AND %s' % criterion
+                                 for criterion in criteria]),
+            'count': count_expression,
             'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
-            'tag_count': tag_count,
+            'tag_id_placeholders': ','.join(['%s'] * len(tags)),
+            'tag_count': len(tags),
         }
 
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
-        if len(object_ids) > 0:
-            return queryset.filter(pk__in=object_ids)
-        else:
-            return model._default_manager.none()
+    def _intersection_page_ids(self, queryset, model, tags, after=None,
+                               limit=None, descending=False):
+        """
+        Returns the ids of up to ``limit`` instances of ``model`` in
+        ``queryset`` having all the given tags, ordered by primary key
+        and following the one whose primary key is ``after``.
+
+        The keyset condition and the limit are part of the intersection
+        query, so only the ids of the page are selected.
+        """
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
+        model_pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+        criteria, params = [], [tag.pk for tag in tags]
+        if after is not None:
+            criteria.append('%s %s %%s' % (model_pk, descending and '<' or '>'))
+            params.append(after)
+        _restrict_to_queryset(queryset, db, model_pk, criteria, params)
+        query = self._intersection_query(db, model, tags, criteria=criteria)
+        query += """
+        ORDER BY %s %s""" % (model_pk, descending and 'DESC' or 'ASC')
+        if limit is not None:
+            query += """
+        LIMIT %s"""
+            params.append(limit)
+        cursor = _connection(db).cursor()
+        cursor.execute(query, params)
+        return [row[0] for row in cursor.fetchall()]
 
-    def get_union_by_model(self, queryset_or_model, tags):
+    def _intersection_count(self, queryset, model, tags):
+        """
+        Returns the number of instances of ``model`` in ``queryset``
+        having all the given tags, without selecting their ids.
+        """
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
+        model_pk = '%s.%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+        criteria, params = [], [tag.pk for tag in tags]
+        _restrict_to_queryset(queryset, db, model_pk, criteria, params)
+        query = 'SELECT COUNT(*) FROM (%s) matched' % self._intersection_query(
+            db, model, tags, criteria=criteria)
+        cursor = _connection(db).cursor()
+        cursor.execute(query, params)
+        return cursor.fetchone()[0]
+
+    def _object_ids(self, db, model, tags, query, mode=None):
+        """
+        Returns the ids selected by ``query`` for the given tags. If a
+        ``mode`` is given, they go through the result cache when it's
+        enabled (see ``tagging.results``).
+        """
+        def fetch():
+            cursor = _connection(db).cursor()
+            cursor.execute(query, [tag.pk for tag in tags])
+            return [row[0] for row in cursor.fetchall()]
+        if mode is None or not settings.TAG_RESULT_CACHE:
+            return fetch()
+        from tagging.results import cached_object_ids
+        return cached_object_ids(ContentType.objects.get_for_model(model),
+                                 tags, mode, fetch, db)
+
+    def get_union_by_model(self, queryset_or_model, tags, include_descendants=False,
+                           resolve_synonyms=False):
         """
         Create a ``QuerySet`` containing instances of the specified
         model associated with *any* of the given list of tags.
+
+        If ``include_descendants`` is ``True``, instances associated
+        with any descendant of the given tags in the tag hierarchy are
+        included as well.
+
+        If ``resolve_synonyms`` is ``True`` and tags are given by name,
+        the names may also be synonyms, and are looked up by the same
+        SQL statement as the instances.
         """
+        if resolve_synonyms and not include_descendants:
+            names = get_tag_names(tags)
+            if names is not None:
+                return self._filter_by_names(queryset_or_model, names, False)
         tags = get_tag_list(tags)
         tag_count = len(tags)
         queryset, model = get_queryset_and_model(queryset_or_model)
@@ -460,7 +1319,22 @@ class TaggedItemManager(models.Manager):
         if not tag_count:
             return model._default_manager.none()
 
+        if not include_descendants:
+            overlapping = self._filter_tag_ids(queryset, model, tags, '&&')
+            if overlapping is not None:
+                return overlapping
+
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
         model_table = qn(model._meta.db_table)
+        tag_id_placeholders = ','.join(['%s'] * tag_count)
+        if include_descendants:
+            tag_id_placeholders = """
+              SELECT %(closure)s.descendant_id FROM %(closure)s
+              WHERE %(closure)s.ancestor_id IN (%(tag_id_placeholders)s)""" % {
+                'closure': qn(TagClosure._meta.db_table),
+                'tag_id_placeholders': tag_id_placeholders,
+            }
         # This query selects the ids of all objects which have any of
         # the given tags.
         query = """
@@ -474,18 +1348,130 @@ class TaggedItemManager(models.Manager):
             'model': model_table,
             'tagged_item': qn(self.model._meta.db_table),
             'content_type_id': ContentType.objects.get_for_model(model).pk,
-            'tag_id_placeholders': ','.join(['%s'] * tag_count),
+            'tag_id_placeholders': tag_id_placeholders,
         }
 
-        cursor = connection.cursor()
-        cursor.execute(query, [tag.pk for tag in tags])
-        object_ids = [row[0] for row in cursor.fetchall()]
+        object_ids = self._object_ids(db, model, tags, query,
+                                      not include_descendants and 'any' or None)
         if len(object_ids) > 0:
             return queryset.filter(pk__in=object_ids)
         else:
             return model._default_manager.none()
 
-    def get_related(self, obj, queryset_or_model, num=None):
+    def get_ranked_union_by_model(self, queryset_or_model, tags, weights=None,
+                                  num=None, offset=0, include_descendants=False):
+        """
+        Retrieve a list of instances of the specified model associated
+        with *any* of the given list of tags, ordered by the number of
+        tags they are associated with in descending order, then by
+        primary key.
+
+        ``weights`` may map tags, given as ``Tag`` objects, ids or
+        names, to the number each of them adds to the rank of an
+        instance instead of ``1``.
+
+        If ``num`` is given, a maximum of ``num`` instances, starting
+        from the one at ``offset``, will be returned. Both are applied
+        by the database, as are the filters of a given queryset, so
+        only the returned instances are loaded.
+
+        If ``include_descendants`` is ``True``, an instance associated
+        with descendants of a given tag ranks as if it was associated
+        with the tag itself, once.
+        """
+        tags = get_tag_list(tags)
+        if not tags:
+            return []
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        if weights:
+            weights = [(tag.pk, _tag_weight(weights, tag)) for tag in tags]
+        object_ids = self._ranked_object_ids(queryset, model,
+            [tag.pk for tag in tags], weights, num, offset, include_descendants)
+        return _in_bulk_ordered(queryset, object_ids)
+
+    def _ranked_object_ids(self, queryset, model, tag_ids, weights=None,
+                           num=None, offset=0, include_descendants=False,
+                           exclude_id=None):
+        """
+        Returns the ids of the instances of ``model`` in ``queryset``
+        associated with any of the given tags, ordered by the number of
+        those tags or, if given, by the sum of their ``(tag_id, weight)``
+        pairs in ``weights``.
+        """
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
+        tagged_item_table = qn(self.model._meta.db_table)
+        tag_id_placeholders = ','.join(['%s'] * len(tag_ids))
+        params = [ContentType.objects.get_for_model(model).pk] + list(tag_ids)
+
+        if include_descendants:
+            # Several descendants of a tag only match it once.
+            matched = """(
+            SELECT DISTINCT %(tagged_item)s.object_id, %(closure)s.ancestor_id AS tag_id
+            FROM %(tagged_item)s INNER JOIN %(closure)s
+                ON %(tagged_item)s.tag_id = %(closure)s.descendant_id
+            WHERE %(tagged_item)s.content_type_id = %%s
+              AND %(closure)s.ancestor_id IN (%(tag_id_placeholders)s)
+            ) matched""" % {
+                'tagged_item': tagged_item_table,
+                'closure': qn(TagClosure._meta.db_table),
+                'tag_id_placeholders': tag_id_placeholders,
+            }
+            criteria = []
+        else:
+            matched = '%s matched' % tagged_item_table
+            criteria = ['matched.content_type_id = %s',
+                        'matched.tag_id IN (%s)' % tag_id_placeholders]
+
+        if exclude_id is not None:
+            criteria.append('matched.object_id != %s')
+            params.append(exclude_id)
+        if queryset.query.where:
+            subquery, subquery_params = _pk_subquery(queryset, db)
+            criteria.append('matched.object_id IN (%s)' % subquery)
+            params.extend(subquery_params)
+
+        if weights:
+            rank = 'SUM(CASE matched.tag_id %s ELSE 0 END)' % ' '.join(
+                ['WHEN %s THEN %s'] * len(weights))
+            rank_params = []
+            for tag_id, weight in weights:
+                rank_params.extend([tag_id, weight])
+            params = rank_params + params
+        else:
+            rank = 'COUNT(*)'
+
+        # Joining the model's table keeps items of instances deleted
+        # without signals from taking up places.
+        model_table = qn(model._meta.db_table)
+        query = """
+        SELECT matched.object_id, %(rank)s AS %(rank_name)s
+        FROM %(matched)s
+            INNER JOIN %(model)s ON %(model_pk)s = matched.object_id
+        %(where)s
+        GROUP BY matched.object_id
+        ORDER BY %(rank_name)s DESC, matched.object_id""" % {
+            'rank': rank,
+            'rank_name': qn('rank'),
+            'matched': matched,
+            'model': model_table,
+            'model_pk': '%s.%s' % (model_table, qn(model._meta.pk.column)),
+            'where': criteria and 'WHERE %s' % ' AND '.join(criteria) or '',
+        }
+        if num is not None:
+            query += """
+        LIMIT %s OFFSET %s"""
+            params.extend([num, offset])
+
+        cursor = _connection(db).cursor()
+        cursor.execute(query, params)
+        object_ids = [row[0] for row in cursor.fetchall()]
+        if num is None:
+            object_ids = object_ids[offset:]
+        return object_ids
+
+    def get_related(self, obj, queryset_or_model, num=None, idf=False,
+                    max_frequency=None, approximate=False, candidates=None):
         """
         Retrieve a list of instances of the specified model which share
         tags with the model instance ``obj``, ordered by the number of
@@ -493,8 +1479,28 @@ class TaggedItemManager(models.Manager):
 
         If ``num`` is given, a maximum of ``num`` instances will be
         returned.
+
+        If ``idf`` is ``True``, each shared tag counts for its inverse
+        document frequency among instances of the specified model
+        instead of ``1``, so rare tags weigh more than common ones.
+        Frequencies are taken from the counts stored in ``TagStamp``s by
+        ``TagStamp.objects.update_counts``. Tags used by more than the
+        ``max_frequency`` fraction of the instances are then ignored.
+
+        If ``approximate`` is ``True``, only the ``candidates`` instances
+        (``TAG_MINHASH_CANDIDATES`` by default) sharing most MinHash
+        buckets with ``obj`` are ranked, so some related instances may
+        be missed. See ``tagging.minhash``.
         """
         queryset, model = get_queryset_and_model(queryset_or_model)
+        if approximate:
+            return self._get_related_approximately(obj, queryset, model, num,
+                                                   candidates)
+        if idf:
+            return self._get_related_by_idf(obj, queryset, model, num,
+                                            max_frequency)
+        db = _read_db(self, model)
+        qn = _connection(db).ops.quote_name
         model_table = qn(model._meta.db_table)
         content_type = ContentType.objects.get_for_model(obj)
         related_content_type = ContentType.objects.get_for_model(model)
@@ -529,7 +1535,7 @@ class TaggedItemManager(models.Manager):
             'limit_offset': num is not None and 'LIMIT %s' or '',
         }
 
-        cursor = connection.cursor()
+        cursor = _connection(db).cursor()
         params = [obj.pk]
         if num is not None:
             params.append(num)
@@ -544,6 +1550,540 @@ class TaggedItemManager(models.Manager):
         else:
             return []
 
+    def get_related_across(self, obj, models=None, num=None):
+        """
+        Retrieve a list of instances of any of the given models, or of
+        any registered model if ``models`` is ``None``, which share tags
+        with the model instance ``obj``, ordered by the number of shared
+        tags in descending order.
+
+        Instances of all models are ranked by a single query, and then
+        retrieved with one query per model by ``fetch_content_objects``.
+        Each instance gets a ``shared_tags`` attribute holding the
+        number of its tags shared with ``obj``.
+
+        If ``num`` is given, a maximum of ``num`` instances will be
+        returned.
+        """
+        from tagging.generic import fetch_content_objects
+
+        content_types = _content_types_for(models)
+        if not content_types:
+            return []
+        content_type = ContentType.objects.get_for_model(obj)
+        db = _read_db(self, content_types.values()[0])
+        qn = _connection(db).ops.quote_name
+        # Items are matched with the table of their model, so items of
+        # instances deleted without signals don't take up places.
+        live = []
+        for model in content_types.values():
+            live.append("""(related.content_type_id = %%s AND EXISTS (
+                SELECT 1 FROM %(model)s WHERE %(model_pk)s = related.object_id))""" % {
+                'model': qn(model._meta.db_table),
+                'model_pk': '%s.%s' % (qn(model._meta.db_table),
+                                       qn(model._meta.pk.column)),
+            })
+        query = """
+        SELECT related.content_type_id, related.object_id, COUNT(*) AS %(count)s
+        FROM %(tagged_item)s item INNER JOIN %(tagged_item)s related
+            ON related.tag_id = item.tag_id
+        WHERE item.content_type_id = %%s
+          AND item.object_id = %%s
+          AND (%(live)s)
+          AND NOT (related.content_type_id = item.content_type_id
+                   AND related.object_id = item.object_id)
+        GROUP BY related.content_type_id, related.object_id
+        ORDER BY %(count)s DESC, related.content_type_id, related.object_id""" % {
+            'count': qn('count'),
+            'tagged_item': qn(self.model._meta.db_table),
+            'live': '\n            OR '.join(live),
+        }
+        params = [content_type.pk, obj.pk] + content_types.keys()
+        if num is not None:
+            query += """
+        LIMIT %s"""
+            params.append(num)
+        cursor = _connection(db).cursor()
+        cursor.execute(query, params)
+        items = []
+        for content_type_id, object_id, count in cursor.fetchall():
+            item = self.model(content_type_id=content_type_id, object_id=object_id)
+            item.shared_tags = count
+            items.append(item)
+        fetch_content_objects(items)
+        related = []
+        for item in items:
+            if item.object is not None:
+                item.object.shared_tags = item.shared_tags
+                related.append(item.object)
+        return related
+
+    def _get_related_approximately(self, obj, queryset, model, num, candidates):
+        from tagging import minhash
+
+        content_type = ContentType.objects.get_for_model(obj)
+        related_content_type = ContentType.objects.get_for_model(model)
+        tag_ids = list(self.filter(content_type__pk=content_type.pk,
+                                   object_id=obj.pk).values_list('tag', flat=True))
+        exclude_id = None
+        if content_type.pk == related_content_type.pk:
+            exclude_id = obj.pk
+        if candidates is None:
+            candidates = settings.TAG_MINHASH_CANDIDATES
+        object_ids = minhash.candidates(tag_ids, related_content_type,
+            max(candidates, num or 0), _read_db(self, model), exclude_id)
+        if not object_ids:
+            return []
+        # The candidates are ranked exactly, by the number of shared tags.
+        queryset = queryset.filter(pk__in=object_ids)
+        object_ids = self._ranked_object_ids(queryset, model, tag_ids, num=num)
+        return _in_bulk_ordered(queryset, object_ids)
+
+    def _get_related_by_idf(self, obj, queryset, model, num, max_frequency):
+        content_type = ContentType.objects.get_for_model(obj)
+        related_content_type = ContentType.objects.get_for_model(model)
+        tag_ids = list(self.filter(content_type__pk=content_type.pk,
+                                   object_id=obj.pk).values_list('tag', flat=True))
+        if not tag_ids:
+            return []
+        counts = dict([(tag_id, 0) for tag_id in tag_ids])
+        counts.update(TagStamp.objects.filter(
+            content_type__pk=related_content_type.pk,
+            tag__pk__in=tag_ids).values_list('tag', 'count'))
+        # Tags without stamps, or whose stamps were created since the
+        # last update_counts, have no count yet, which must not be
+        # mistaken for the rarest of tags.
+        unknown = [tag_id for tag_id, count in counts.iteritems() if not count]
+        if unknown:
+            for tag_id, count in self.filter(content_type__pk=related_content_type.pk,
+                    tag__pk__in=unknown).values('tag').annotate(
+                        count=Count('id')).values_list('tag', 'count'):
+                counts[tag_id] = count
+        total = TagStamp.objects.total(model)
+        weights = []
+        for tag_id, count in counts.iteritems():
+            if max_frequency is not None and count > max_frequency * total:
+                # Too common to tell instances apart, and the most
+                # expensive tags to join.
+                continue
+            weights.append((tag_id, math.log((total + 1.0) / (count + 1.0))))
+        if not weights:
+            return []
+        exclude_id = None
+        if content_type.pk == related_content_type.pk:
+            exclude_id = obj.pk
+        object_ids = self._ranked_object_ids(queryset, model,
+            [tag_id for tag_id, weight in weights], weights, num,
+            exclude_id=exclude_id)
+        return _in_bulk_ordered(queryset, object_ids)
+
+class SynonymManager(models.Manager):
+    def add_synonyms(self, synonyms):
+        """
+        Creates synonyms for tags, given as a dictionary mapping tag
+        names to lists of synonym names, with one query looking the
+        tags up, one looking existing synonyms up and one statement
+        inserting the new ones. Synonym names which are already used,
+        by any tag, and tags which don't exist are skipped.
+
+        Returns the number of created synonyms.
+        """
+        if not synonyms:
+            return 0
+        tags = {}
+        for tag in Tag.objects.filter(name__in=synonyms.keys()):
+            tags[tag.name or tag.name_any] = tag
+        rows = []
+        seen = set()
+        for tag_name, names in synonyms.iteritems():
+            tag = tags.get(tag_name)
+            if tag is None:
+                continue
+            for name in names:
+                if name not in seen:
+                    seen.add(name)
+                    rows.append((name, tag.pk))
+        if not rows:
+            return 0
+        existing = set(self.filter(name__in=[name for name, tag_id in rows]
+                                   ).values_list('name', flat=True))
+        rows = [row for row in rows if row[0] not in existing]
+        if not rows:
+            return 0
+        added = _insert_ignore(_write_db(self.model), self.model,
+                               ('name', 'tag_id'), rows)
+        transaction.commit_unless_managed()
+        # No signals were sent.
+        from tagging import suggest
+        for tag_id in set([tag_id for name, tag_id in rows]):
+            suggest.tag_changed(tag_id)
+        return added
+
+# The numbers of instances of content types, stored by
+# ``TagStampManager.update_counts`` along with the counts of the tags.
+TOTAL_KEY = 'tagging.total.%s'
+TOTAL_TIMEOUT = 60 * 60 * 24 * 30
+
+class TagStampManager(models.Manager):
+    def touch(self, tag, content_type, create=True):
+        """
+        Bumps the version of the ``(tag, content_type)`` pair, which
+        marks every listing of that tag for that content type as
+        modified.
+
+        If ``create`` is ``False``, a missing stamp won't be created.
+        """
+        tag_id = getattr(tag, 'pk', tag)
+        content_type_id = getattr(content_type, 'pk', content_type)
+        now = datetime.now()
+        stamps = self.filter(tag__pk=tag_id, content_type__pk=content_type_id)
+        if stamps.update(version=models.F('version') + 1, modified=now) or not create:
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(tag_id=tag_id, content_type_id=content_type_id,
+                        version=1, modified=now)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Somebody else has created the stamp in the meantime.
+            transaction.savepoint_rollback(sid)
+            stamps.update(version=models.F('version') + 1, modified=now)
+
+    def touch_all(self, tags, content_type, create=True):
+        """
+        Bumps the versions of the given tags for the content type with a
+        single update, creating the missing stamps unless ``create`` is
+        ``False``.
+        """
+        tag_ids = [getattr(tag, 'pk', tag) for tag in tags]
+        content_type_id = getattr(content_type, 'pk', content_type)
+        if not tag_ids:
+            return
+        stamps = self.filter(tag__pk__in=tag_ids, content_type__pk=content_type_id)
+        if stamps.update(version=models.F('version') + 1,
+                         modified=datetime.now()) >= len(tag_ids) or not create:
+            return
+        existing = set(stamps.values_list('tag', flat=True))
+        for tag_id in tag_ids:
+            if tag_id not in existing:
+                self.touch(tag_id, content_type_id)
+
+    def create_missing(self, content_type=None):
+        """
+        Creates the stamps of the tags associated with instances of all
+        content types, or only of the given one, which have none, such
+        as the ones tagged before stamps existed, with a single insert.
+        Returns the number of created stamps.
+        """
+        db = _write_db(self.model)
+        conn = _connection(db)
+        qn = conn.ops.quote_name
+        query = """
+        INSERT INTO %(stamp)s (tag_id, content_type_id, %(version)s, %(modified)s, %(count)s)
+        SELECT DISTINCT t.tag_id, t.content_type_id, 1, %%s, 0
+        FROM %(tagged_item)s t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM %(stamp)s s
+            WHERE s.tag_id = t.tag_id AND s.content_type_id = t.content_type_id)""" % {
+            'stamp': qn(self.model._meta.db_table),
+            'version': qn('version'),
+            'modified': qn('modified'),
+            'count': qn('count'),
+            'tagged_item': qn(TaggedItem._meta.db_table),
+        }
+        params = [conn.ops.value_to_db_datetime(datetime.now())]
+        if content_type is not None:
+            query += """
+          AND t.content_type_id = %s"""
+            params.append(getattr(content_type, 'pk', content_type))
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        transaction.commit_unless_managed()
+        return cursor.rowcount
+
+    def update_counts(self, content_type=None):
+        """
+        Stores the number of instances associated with each tag in the
+        ``count`` of its stamps, for all content types or only the given
+        one, with a single update, after creating the missing stamps.
+        Returns the number of updated stamps.
+        """
+        self.create_missing(content_type)
+        db = _write_db(self.model)
+        qn = _connection(db).ops.quote_name
+        query = """
+        UPDATE %(stamp)s SET %(count)s = (
+            SELECT COUNT(*) FROM %(tagged_item)s
+            WHERE %(tagged_item)s.tag_id = %(stamp)s.tag_id
+              AND %(tagged_item)s.content_type_id = %(stamp)s.content_type_id)""" % {
+            'stamp': qn(self.model._meta.db_table),
+            'count': qn('count'),
+            'tagged_item': qn(TaggedItem._meta.db_table),
+        }
+        params = []
+        if content_type is not None:
+            query += """
+        WHERE %s.content_type_id = %%s""" % qn(self.model._meta.db_table)
+            params.append(getattr(content_type, 'pk', content_type))
+        cursor = _connection(db).cursor()
+        cursor.execute(query, params)
+        transaction.commit_unless_managed()
+        updated = cursor.rowcount
+
+        if content_type is not None:
+            content_type_ids = [getattr(content_type, 'pk', content_type)]
+        else:
+            content_type_ids = set(self.values_list('content_type', flat=True))
+        for content_type_id in content_type_ids:
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if model is not None:
+                self._store_total(content_type_id, model._default_manager.count())
+        return updated
+
+    def _store_total(self, content_type_id, total):
+        cache.set(TOTAL_KEY % content_type_id, total, TOTAL_TIMEOUT)
+
+    def total(self, model):
+        """
+        Returns the number of instances of ``model`` as of the last
+        ``update_counts``, counting them if the cache has lost it.
+        """
+        content_type_id = ContentType.objects.get_for_model(model).pk
+        total = cache.get(TOTAL_KEY % content_type_id)
+        if total is None:
+            total = model._default_manager.count()
+            self._store_total(content_type_id, total)
+        return total
+
+    def get_for(self, tag, queryset_or_model):
+        """
+        Returns the ``TagStamp`` for the given tag and the model of the
+        given queryset or model, or ``None`` if the tag has never been
+        associated with instances of that model.
+        """
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        content_type = ContentType.objects.get_for_model(model)
+        try:
+            return self.get(tag__pk=getattr(tag, 'pk', tag),
+                            content_type__pk=content_type.pk)
+        except self.model.DoesNotExist:
+            return None
+
+    def versions(self, tags, content_type, db=None, default=0):
+        """
+        Returns a dictionary mapping the ids of the given tags to the
+        versions of their stamps for the content type, ``default`` for
+        tags which have none.
+        """
+        tag_ids = [getattr(tag, 'pk', tag) for tag in tags]
+        versions = dict(_using(self.filter(
+            tag__pk__in=tag_ids,
+            content_type__pk=getattr(content_type, 'pk', content_type)), db
+        ).values_list('tag', 'version'))
+        return dict([(tag_id, versions.get(tag_id, default)) for tag_id in tag_ids])
+
+class TagCounterManager(models.Manager):
+    def record(self, tag, content_type, when=None, count=1):
+        """
+        Counts ``count`` additions of the tag to instances of the content
+        type in the hourly bucket containing ``when`` (now by default).
+        """
+        tag_id = getattr(tag, 'pk', tag)
+        content_type_id = getattr(content_type, 'pk', content_type)
+        self._add(tag_id, content_type_id, self.model.HOUR,
+                  self.model.bucket_start(when or datetime.now(), self.model.HOUR), count)
+
+    def record_all(self, tags, content_type, when=None):
+        """
+        Counts one addition of each of the given tags, with a single
+        update for the tags which already have a counter.
+        """
+        tag_ids = [getattr(tag, 'pk', tag) for tag in tags]
+        content_type_id = getattr(content_type, 'pk', content_type)
+        if not tag_ids:
+            return
+        start = self.model.bucket_start(when or datetime.now(), self.model.HOUR)
+        counters = self.filter(tag__pk__in=tag_ids, content_type__pk=content_type_id,
+                               period=self.model.HOUR, start=start)
+        if counters.update(count=models.F('count') + 1) >= len(tag_ids):
+            return
+        existing = set(counters.values_list('tag', flat=True))
+        for tag_id in tag_ids:
+            if tag_id not in existing:
+                self._add(tag_id, content_type_id, self.model.HOUR, start, 1)
+
+    def _add(self, tag_id, content_type_id, period, start, count):
+        counters = self.filter(tag__pk=tag_id, content_type__pk=content_type_id,
+                               period=period, start=start)
+        if counters.update(count=models.F('count') + count):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(tag_id=tag_id, content_type_id=content_type_id,
+                        period=period, start=start, count=count)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Somebody else has created the counter in the meantime.
+            transaction.savepoint_rollback(sid)
+            counters.update(count=models.F('count') + count)
+
+    def compact(self, hourly_before=None, daily_before=None):
+        """
+        Rolls the hourly buckets older than ``hourly_before`` up into
+        daily buckets, and deletes the daily buckets older than
+        ``daily_before``. Both default to the ``TAG_TRENDING_HOURS``
+        and ``TAG_TRENDING_DAYS`` settings.
+
+        Returns the number of hourly buckets which were compacted.
+        """
+        now = datetime.now()
+        if hourly_before is None:
+            hourly_before = now - timedelta(hours=settings.TAG_TRENDING_HOURS)
+        if daily_before is None:
+            daily_before = now - timedelta(days=settings.TAG_TRENDING_DAYS)
+        hourly = self.filter(period=self.model.HOUR, start__lt=hourly_before)
+        daily = {}
+        compacted = 0
+        for tag_id, content_type_id, start, count in hourly.values_list(
+                'tag', 'content_type', 'start', 'count').iterator():
+            key = (tag_id, content_type_id,
+                   self.model.bucket_start(start, self.model.DAY))
+            daily[key] = daily.get(key, 0) + count
+            compacted += 1
+        for (tag_id, content_type_id, start), count in daily.iteritems():
+            self._add(tag_id, content_type_id, self.model.DAY, start, count)
+        hourly.delete()
+        self.filter(period=self.model.DAY, start__lt=daily_before).delete()
+        transaction.commit_unless_managed()
+        return compacted
+
+class TagClosureManager(models.Manager):
+    """
+    Maintains the closure table of the tag hierarchy, which holds a row
+    for every (ancestor, descendant) pair of tags, including a row of
+    depth 0 linking every tag to itself.
+    """
+    def add_tag(self, tag):
+        """
+        Adds the row linking the given tag to itself, if it's missing.
+        """
+        tag_id = getattr(tag, 'pk', tag)
+        if self.filter(ancestor__pk=tag_id, descendant__pk=tag_id).count():
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(ancestor_id=tag_id, descendant_id=tag_id, depth=0)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+
+    def rebuild(self):
+        """
+        Adds the rows linking tags to themselves for all tags which
+        don't have one, such as the tags created before the hierarchy
+        was introduced. Returns the number of rows added.
+        """
+        db = _write_db(self.model)
+        conn = _connection(db)
+        qn = conn.ops.quote_name
+        closure_table = qn(self.model._meta.db_table)
+        cursor = conn.cursor()
+        cursor.execute("""
+        INSERT INTO %(closure)s (ancestor_id, descendant_id, depth)
+        SELECT %(tag)s.id, %(tag)s.id, 0
+        FROM %(tag)s
+        WHERE %(tag)s.id NOT IN (
+            SELECT %(closure)s.descendant_id FROM %(closure)s
+            WHERE %(closure)s.depth = 0)""" % {
+            'closure': closure_table,
+            'tag': qn(Tag._meta.db_table),
+        })
+        _commit_unless_managed(db)
+        return cursor.rowcount
+
+    def set_parent(self, tag, parent):
+        """
+        Moves the given tag, along with all its descendants, under
+        ``parent``. If ``parent`` is ``None``, the tag becomes a root.
+
+        Raises ``ValueError`` if ``parent`` is the tag itself or one of
+        its descendants.
+        """
+        tag_id = getattr(tag, 'pk', tag)
+        parent_id = getattr(parent, 'pk', parent)
+        self.add_tag(tag_id)
+        if parent_id is not None:
+            self.add_tag(parent_id)
+            if self.filter(ancestor__pk=tag_id, descendant__pk=parent_id).count():
+                raise ValueError('A tag cannot be moved under itself or one of its descendants.')
+
+        subtree = list(self.filter(ancestor__pk=tag_id).values_list(
+            'descendant', flat=True))
+        db = _write_db(self.model)
+        conn = _connection(db)
+        qn = conn.ops.quote_name
+        closure_table = qn(self.model._meta.db_table)
+        subtree_placeholders = ','.join(['%s'] * len(subtree))
+        # Both statements are committed together, so the subtree is
+        # never left detached from all ancestors.
+        cursor = conn.cursor()
+        try:
+            # Detach the subtree from its current ancestors...
+            cursor.execute("""
+            DELETE FROM %(closure)s
+            WHERE descendant_id IN (%(subtree)s)
+              AND ancestor_id NOT IN (%(subtree)s)""" % {
+                'closure': closure_table,
+                'subtree': subtree_placeholders,
+            }, subtree + subtree)
+            if parent_id is not None:
+                # ...and link every ancestor of the new parent to every
+                # tag in it.
+                cursor.execute("""
+                INSERT INTO %(closure)s (ancestor_id, descendant_id, depth)
+                SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+                FROM %(closure)s a, %(closure)s d
+                WHERE a.descendant_id = %%s
+                  AND d.ancestor_id = %%s""" % {
+                    'closure': closure_table,
+                }, [parent_id, tag_id])
+        except:
+            _rollback_unless_managed(db)
+            raise
+        _commit_unless_managed(db)
+
+    def get_parent(self, tag):
+        """
+        Returns the parent of the given tag, or ``None`` for a root.
+        """
+        try:
+            return self.select_related('ancestor').get(
+                descendant__pk=getattr(tag, 'pk', tag), depth=1).ancestor
+        except self.model.DoesNotExist:
+            return None
+
+    def get_ancestors(self, tag):
+        """
+        Returns a list of the ancestors of the given tag, starting with
+        its root.
+        """
+        return [link.ancestor for link in self.select_related('ancestor').filter(
+            descendant__pk=getattr(tag, 'pk', tag), depth__gt=0).order_by('-depth')]
+
+    def get_children(self, tag):
+        """
+        Returns a ``QuerySet`` of the direct children of the given tag.
+        """
+        return Tag.objects.filter(ancestor_links__ancestor__pk=getattr(tag, 'pk', tag),
+                                  ancestor_links__depth=1)
+
+    def get_descendants(self, tag):
+        """
+        Returns a ``QuerySet`` of all the descendants of the given tag.
+        """
+        return Tag.objects.filter(ancestor_links__ancestor__pk=getattr(tag, 'pk', tag),
+                                  ancestor_links__depth__gt=0)
+
 ##########
 # Models #
 ##########
@@ -578,8 +2118,10 @@ class Tag(models.Model):
         return super(Tag, self).delete()
 
     def save(self, *args, **kwargs):
+        update = kwargs.pop('update', True)
         result = super(Tag, self).save(*args, **kwargs)
-        self._updateLinkedObjects()
+        if update:
+            self._updateLinkedObjects()
         return result
 
     def _updateLinkedObjects(self, remove_this = False):
@@ -645,11 +2187,220 @@ class Synonym(models.Model):
     name = models.CharField(max_length=50, unique=True, db_index=True)
     tag = models.ForeignKey(Tag, related_name='synonyms')
 
+    objects = SynonymManager()
+
     def __unicode__(self):
         return u'%s, synonym for %s' % (self.name, self.tag)
 
     class Meta:
+        # Also an index covering lookups of tags by synonym names
+        unique_together = (('name', 'tag'),)
         verbose_name = _("Tag's synonym")
         verbose_name_plural = _("Tags' synonyms")
         ordering = ('name',)
 
+class TagStamp(models.Model):
+    """
+    Holds a version and a modification time of the list of objects of
+    some content type, which have the given tag, and the number of those
+    objects as of the last ``TagStamp.objects.update_counts``.
+    """
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='stamps')
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    version      = models.PositiveIntegerField(_('version'), default=0)
+    modified     = models.DateTimeField(_('modified'), default=datetime.now)
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = TagStampManager()
+
+    class Meta:
+        unique_together = (('tag', 'content_type'),)
+        verbose_name = _('tag stamp')
+        verbose_name_plural = _('tag stamps')
+
+    def __unicode__(self):
+        return u'%s [%s] v%d' % (self.tag, self.content_type, self.version)
+
+    def etag(self, *extra):
+        """
+        Returns an entity tag for this version of the list, mixed with
+        ``extra`` values, such as the page number.
+        """
+        from django.utils.hashcompat import md5_constructor
+        parts = [self.tag_id, self.content_type_id, self.version,
+                 self.modified.isoformat()] + list(extra)
+        return md5_constructor(
+            '|'.join([unicode(part) for part in parts]).encode('utf-8')).hexdigest()
+
+class TagCounter(models.Model):
+    """
+    Counts how many times a tag was added to instances of a content type
+    during an hour or a day, starting at ``start``. See
+    ``TagManager.trending``.
+    """
+    HOUR, DAY = 'hour', 'day'
+    PERIOD_CHOICES = (
+        (HOUR, _('hour')),
+        (DAY, _('day')),
+    )
+
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='counters')
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    period       = models.CharField(_('period'), max_length=4, choices=PERIOD_CHOICES)
+    start        = models.DateTimeField(_('start'), db_index=True)
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    objects = TagCounterManager()
+
+    class Meta:
+        unique_together = (('tag', 'content_type', 'period', 'start'),)
+        verbose_name = _('tag counter')
+        verbose_name_plural = _('tag counters')
+
+    def __unicode__(self):
+        return u'%s [%s] %s: %d' % (self.tag, self.content_type, self.start, self.count)
+
+    def bucket_start(cls, when, period):
+        """
+        Returns the start of the bucket of the given period containing
+        the datetime ``when``.
+        """
+        when = when.replace(minute=0, second=0, microsecond=0)
+        if period == cls.DAY:
+            when = when.replace(hour=0)
+        return when
+    bucket_start = classmethod(bucket_start)
+
+class TagClosure(models.Model):
+    """
+    Links a tag to each of its descendants in the tag hierarchy, and to
+    itself with a ``depth`` of 0. See ``TagClosureManager``.
+    """
+    ancestor   = models.ForeignKey(Tag, verbose_name=_('ancestor'), related_name='descendant_links')
+    descendant = models.ForeignKey(Tag, verbose_name=_('descendant'), related_name='ancestor_links')
+    depth      = models.PositiveIntegerField(_('depth'), default=0)
+
+    objects = TagClosureManager()
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+        verbose_name = _('tag closure')
+        verbose_name_plural = _('tag closures')
+
+    def __unicode__(self):
+        return u'%s > %s (%d)' % (self.ancestor, self.descendant, self.depth)
+
+class TagBucket(models.Model):
+    """
+    A band of the MinHash signature of the set of tags of an object,
+    hashed into a bucket. See ``tagging.minhash``.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    object_id    = models.PositiveIntegerField(_('object id'))
+    band         = models.PositiveSmallIntegerField(_('band'))
+    bucket       = models.IntegerField(_('bucket'), db_index=True)
+
+    class Meta:
+        unique_together = (('content_type', 'object_id', 'band'),)
+        verbose_name = _('tag bucket')
+        verbose_name_plural = _('tag buckets')
+
+    def __unicode__(self):
+        return u'%s [%s] %d:%d' % (self.object_id, self.content_type,
+                                   self.band, self.bucket)
+
+class TagJob(models.Model):
+    """
+    A bulk operation on a tag, which is run in chunks by a background
+    worker. See ``tagging.jobs``.
+    """
+    MERGE, DELETE, RENAME = 'merge', 'delete', 'rename'
+    ACTION_CHOICES = (
+        (MERGE, _('merge')),
+        (DELETE, _('delete')),
+        (RENAME, _('rename')),
+    )
+    PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+    STATUS_CHOICES = (
+        (PENDING, _('pending')),
+        (RUNNING, _('running')),
+        (DONE, _('done')),
+        (FAILED, _('failed')),
+    )
+
+    action    = models.CharField(_('action'), max_length=10, choices=ACTION_CHOICES)
+    # Plain ids, because the job must outlive the tags it deletes
+    tag_pk    = models.PositiveIntegerField(_('tag id'))
+    tag_name  = models.CharField(_('tag'), max_length=50)
+    target_pk = models.PositiveIntegerField(_('target tag id'), null=True, blank=True)
+    new_name  = models.CharField(_('new name'), max_length=50, blank=True)
+    status    = models.CharField(_('status'), max_length=10, choices=STATUS_CHOICES,
+                                 default=PENDING, db_index=True)
+    done      = models.PositiveIntegerField(_('done'), default=0)
+    total     = models.PositiveIntegerField(_('total'), null=True, blank=True)
+    error     = models.TextField(_('error'), blank=True)
+    created   = models.DateTimeField(_('created'), default=datetime.now)
+    modified  = models.DateTimeField(_('modified'), default=datetime.now)
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = _('tag job')
+        verbose_name_plural = _('tag jobs')
+
+    def __unicode__(self):
+        return u'%s %s' % (self.get_action_display(), self.tag_name)
+
+    def progress(self):
+        if not self.total:
+            return self.status == self.DONE and 100 or 0
+        return min(100, self.done * 100 / self.total)
+
+def _tagged_item_saved(sender, instance, **kwargs):
+    TagStamp.objects.touch(instance.tag_id, instance.content_type_id)
+    if kwargs.get('created'):
+        TagCounter.objects.record(instance.tag_id, instance.content_type_id)
+    sync_tag_ids(_tag_ids_model(instance.content_type_id), [instance.object_id])
+    update_buckets(instance.content_type_id, [instance.object_id])
+
+def _tagged_item_deleted(sender, instance, **kwargs):
+    # Stamps are never created here: the tag itself may be in the
+    # middle of being deleted.
+    TagStamp.objects.touch(instance.tag_id, instance.content_type_id,
+                           create=False)
+    sync_tag_ids(_tag_ids_model(instance.content_type_id), [instance.object_id])
+    update_buckets(instance.content_type_id, [instance.object_id])
+
+def _tag_saved(sender, instance, created, **kwargs):
+    if created:
+        TagClosure.objects.add_tag(instance)
+    _tag_names_changed(instance.pk)
+
+def _tag_names_changed(tag_id, deleted=False):
+    from tagging import suggest
+    suggest.tag_changed(tag_id, deleted)
+
+def _tag_deleted(sender, instance, **kwargs):
+    _tag_names_changed(instance.pk, True)
+
+def _translation_saved(sender, instance, **kwargs):
+    _tag_names_changed(instance.master_id)
+
+def _synonym_changed(sender, instance, **kwargs):
+    _tag_names_changed(instance.tag_id)
+
+def _tag_deleting(sender, instance, **kwargs):
+    # Children of a deleted tag are moved up to its parent.
+    parent = TagClosure.objects.get_parent(instance)
+    for child in list(TagClosure.objects.get_children(instance)):
+        TagClosure.objects.set_parent(child, parent)
+
+signals.post_save.connect(_tag_saved, sender=Tag)
+signals.pre_delete.connect(_tag_deleting, sender=Tag)
+signals.post_delete.connect(_tag_deleted, sender=Tag)
+signals.post_save.connect(_synonym_changed, sender=Synonym)
+signals.post_delete.connect(_synonym_changed, sender=Synonym)
+if settings.MULTILINGUAL_TAGS:
+    signals.post_save.connect(_translation_saved,
+                              sender=Tag._meta.translation_model)
+signals.post_save.connect(_tagged_item_saved, sender=TaggedItem)
+signals.post_delete.connect(_tagged_item_deleted, sender=TaggedItem)
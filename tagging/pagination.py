@@ -0,0 +1,154 @@
+"""
+Keyset pagination for lists of tagged objects.
+
+Instead of ``OFFSET``, each page is selected with a ``pk > last seen pk``
+condition, so deep pages cost the same as the first one. Total counts
+are cached, keyed by the ``TagStamp`` versions of the tags involved.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+from tagging import settings
+from tagging.utils import get_queryset_and_model, get_tag_list
+
+class KeysetPage(object):
+    """
+    A page of objects, which provides the parts of the
+    ``django.core.paginator.Page`` interface that make sense without
+    page numbers.
+
+    ``next_after`` is the value to be passed as ``after`` to get the
+    next page, or ``None`` if this is the last page.
+    """
+    def __init__(self, object_list, after, next_after, per_page, count=None):
+        self.object_list = object_list
+        self.after = after
+        self.next_after = next_after
+        self.per_page = per_page
+        self.count = count
+
+    def __repr__(self):
+        return '<Page after %s>' % self.after
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_after is not None
+
+    def has_previous(self):
+        return self.after is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+def keyset_page(queryset, after=None, per_page=None, descending=False,
+                count_key=None):
+    """
+    Returns a ``KeysetPage`` with up to ``per_page`` objects from the
+    given ``queryset``, ordered by primary key and starting right after
+    the object with the primary key ``after``.
+
+    If ``count_key`` is given, the total number of objects in the
+    queryset is looked up in the cache under that key, and is only
+    counted if it isn't there.
+    """
+    if per_page is None:
+        per_page = settings.KEYSET_PAGE_SIZE
+    pk_name = queryset.model._meta.pk.name
+    if descending:
+        queryset = queryset.order_by('-%s' % pk_name)
+        lookup = '%s__lt' % pk_name
+    else:
+        queryset = queryset.order_by(pk_name)
+        lookup = '%s__gt' % pk_name
+    if after is not None:
+        page_queryset = queryset.filter(**{lookup: after})
+    else:
+        page_queryset = queryset
+
+    # One extra object tells whether there is a next page.
+    object_list = list(page_queryset[:per_page + 1])
+    next_after = None
+    if len(object_list) > per_page:
+        object_list = object_list[:per_page]
+        next_after = object_list[-1].pk
+    count = _cached_count(count_key, queryset.count)
+    return KeysetPage(object_list, after, next_after, per_page, count)
+
+def _cached_count(count_key, count):
+    """
+    Returns the count cached under ``count_key``, calling ``count`` and
+    caching its result if it isn't there, or ``None`` without a key.
+    """
+    if count_key is None:
+        return None
+    value = cache.get(count_key)
+    if value is None:
+        value = count()
+        cache.set(count_key, value, settings.KEYSET_COUNT_TIMEOUT)
+    return value
+
+def tagged_count_key(queryset_or_model, tags):
+    """
+    Builds a cache key for the number of objects in the given queryset
+    or model which have all the given tags. The key changes whenever
+    any of the tags is added to or removed from an instance of the
+    model, so cached counts never outlive the associations they were
+    counted for.
+    """
+    from tagging.models import TagStamp
+
+    queryset, model = get_queryset_and_model(queryset_or_model)
+    content_type = ContentType.objects.get_for_model(model)
+    tag_ids = sorted([tag.pk for tag in get_tag_list(tags)])
+    versions = TagStamp.objects.versions(tag_ids, content_type)
+    parts = ['%s:%s' % (tag_id, versions[tag_id]) for tag_id in tag_ids]
+    return 'tagging.count.%s.%s' % (content_type.pk, md5_constructor(
+        smart_str(u'%s|%s' % (','.join(parts), queryset.query))).hexdigest())
+
+def tagged_keyset_page(queryset_or_model, tags, after=None, per_page=None,
+                       descending=False, count=True):
+    """
+    Returns a ``KeysetPage`` of instances of the given queryset or
+    model which have all the given tags.
+
+    If ``count`` is ``True``, the page will have a ``count`` attribute
+    containing the total number of such instances, which is cached
+    until the tags are next added to or removed from an instance.
+
+    For several tags, the keyset condition and the page size are
+    applied by the query intersecting the tags, and only the instances
+    of the page are fetched.
+    """
+    from tagging.models import TaggedItem, _in_bulk_ordered
+
+    count_key = None
+    if count:
+        count_key = tagged_count_key(queryset_or_model, tags)
+    queryset, model = get_queryset_and_model(queryset_or_model)
+    tags = get_tag_list(tags)
+    if len(tags) < 2 or TaggedItem.objects._filter_tag_ids(
+            queryset, model, tags, '@>') is not None:
+        # A single join or an array lookup, which can be filtered.
+        return keyset_page(TaggedItem.objects.get_by_model(queryset, tags),
+                           after, per_page, descending, count_key)
+
+    if per_page is None:
+        per_page = settings.KEYSET_PAGE_SIZE
+    # One extra id tells whether there is a next page.
+    object_ids = TaggedItem.objects._intersection_page_ids(
+        queryset, model, tags, after, per_page + 1, descending)
+    next_after = None
+    if len(object_ids) > per_page:
+        object_ids = object_ids[:per_page]
+        next_after = object_ids[-1]
+    count = _cached_count(count_key, lambda: TaggedItem.objects._intersection_count(
+        queryset, model, tags))
+    return KeysetPage(_in_bulk_ordered(queryset, object_ids), after,
+                      next_after, per_page, count)
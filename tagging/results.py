@@ -0,0 +1,53 @@
+"""
+A cache of the ids of the objects having all or any of some tags.
+
+Entries are keyed by the content type, the sorted ids of the tags, the
+mode of the lookup and the versions of the tags' stamps for the content
+type. A stamp's version is bumped whenever its tag is added to or
+removed from an instance of the content type, so an entry is never read
+again once an association involving one of its tags has changed, while
+entries for other tags stay valid. Outdated entries are left for the
+cache backend to evict.
+
+Associations made before stamps existed may have none, and removing
+them doesn't create one, so lookups involving a tag without a stamp
+aren't cached. ``TagStamp.objects.create_missing``, also run by the
+``update_tag_counts`` management command, creates those stamps.
+"""
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+from tagging import settings
+
+def result_key(content_type, tags, mode, db=None):
+    """
+    Builds the cache key of the ids of the instances of ``content_type``
+    having all (``mode`` being ``'all'``) or any (``'any'``) of the
+    given tags, for the current versions of the tags, or ``None`` if a
+    tag has no stamp for the content type.
+    """
+    from tagging.models import TagStamp
+
+    tag_ids = sorted([getattr(tag, 'pk', tag) for tag in tags])
+    versions = TagStamp.objects.versions(tag_ids, content_type, db, None)
+    if None in versions.values():
+        return None
+    parts = ['%s:%s' % (tag_id, versions[tag_id]) for tag_id in tag_ids]
+    return 'tagging.results.%s.%s.%s' % (getattr(content_type, 'pk', content_type),
+        mode, md5_constructor(','.join(parts)).hexdigest())
+
+def cached_object_ids(content_type, tags, mode, fetch, db=None):
+    """
+    Returns the list of ids cached for the given lookup, or the one
+    returned by calling ``fetch``, which is cached unless it has more
+    than ``TAG_RESULT_CACHE_MAX_IDS`` ids.
+    """
+    key = result_key(content_type, tags, mode, db)
+    if key is None:
+        return fetch()
+    object_ids = cache.get(key)
+    if object_ids is None:
+        object_ids = fetch()
+        if len(object_ids) <= settings.TAG_RESULT_CACHE_MAX_IDS:
+            cache.set(key, object_ids, settings.TAG_RESULT_CACHE_TIMEOUT)
+    return object_ids
@@ -15,6 +15,75 @@ FORCE_TAG_DELIMITER = getattr(settings, 'FORCE_TAG_DELIMITER', None)
 # The maximum length of a tag's name.
 MAX_TAG_LENGTH = getattr(settings, 'MAX_TAG_LENGTH', 50)
 
+# The default number of objects on a page of keyset pagination.
+KEYSET_PAGE_SIZE = getattr(settings, 'KEYSET_PAGE_SIZE', 20)
+
+# How many seconds cached counts of tagged objects are kept. They are
+# versioned by the tags' stamps, so this only bounds the cache size.
+KEYSET_COUNT_TIMEOUT = getattr(settings, 'KEYSET_COUNT_TIMEOUT', 60 * 60 * 24)
+
+# Whether the ids of objects having all or any of some tags are cached
+# by ``get_intersection_by_model``, ``get_union_by_model`` and
+# ``get_by_model``.
+TAG_RESULT_CACHE = getattr(settings, 'TAG_RESULT_CACHE', False)
+
+# How many seconds cached ids are kept. Like counts, they are versioned
+# by the tags' stamps, so this only bounds the cache size.
+TAG_RESULT_CACHE_TIMEOUT = getattr(settings, 'TAG_RESULT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+# The largest number of ids cached for a lookup. Larger results are
+# queried every time.
+TAG_RESULT_CACHE_MAX_IDS = getattr(settings, 'TAG_RESULT_CACHE_MAX_IDS', 10000)
+
+# The number of worker threads which run bulk jobs on tags, queued from
+# the admin. If 0, jobs are only run by the ``run_tag_jobs`` command.
+TAG_JOB_WORKERS = getattr(settings, 'TAG_JOB_WORKERS', 1)
+
+# The number of tagged items processed by a job between two progress
+# updates.
+TAG_JOB_CHUNK_SIZE = getattr(settings, 'TAG_JOB_CHUNK_SIZE', 500)
+
+# The maximum number of primary keys looked up with a single query by
+# ``tagging.generic.fetch_content_objects``.
+TAG_FETCH_CHUNK_SIZE = getattr(settings, 'TAG_FETCH_CHUNK_SIZE', 500)
+
+# The alias of a database, such as a read replica, which read-only
+# aggregate queries (usage, related tags and objects, intersections and
+# unions) are sent to. If None, the database routers decide.
+TAG_READ_DATABASE = getattr(settings, 'TAG_READ_DATABASE', None)
+
+# Whether to filter models having a ``TagIdsField`` by that column,
+# instead of joining them with tagged items, where the database supports
+# it.
+TAG_IDS_LOOKUPS = getattr(settings, 'TAG_IDS_LOOKUPS', True)
+
+# How many hours the hourly counters of tag additions are kept before
+# the ``compact_tag_counters`` command rolls them up into daily ones.
+TAG_TRENDING_HOURS = getattr(settings, 'TAG_TRENDING_HOURS', 48)
+
+# How many days the daily counters of tag additions are kept.
+TAG_TRENDING_DAYS = getattr(settings, 'TAG_TRENDING_DAYS', 90)
+
+# Whether ``TagBucket``s, used to find related objects approximately,
+# are kept up to date when tags are updated.
+TAG_MINHASH = getattr(settings, 'TAG_MINHASH', False)
+
+# The number of bands of MinHash signatures, each stored as a bucket per
+# object. More bands find more of the related objects.
+TAG_MINHASH_BANDS = getattr(settings, 'TAG_MINHASH_BANDS', 20)
+
+# The number of signature values hashed into a bucket. More rows make
+# buckets smaller, but miss objects sharing fewer tags.
+TAG_MINHASH_ROWS = getattr(settings, 'TAG_MINHASH_ROWS', 2)
+
+# The number of candidates which approximate related objects are
+# ranked among.
+TAG_MINHASH_CANDIDATES = getattr(settings, 'TAG_MINHASH_CANDIDATES', 200)
+
+# The path of the memory-mapped snapshot of tagged items written by the
+# ``write_tag_snapshot`` command.
+TAG_SNAPSHOT_PATH = getattr(settings, 'TAG_SNAPSHOT_PATH', None)
+
 # Whether to use multilingual tags
 MULTILINGUAL_TAGS = getattr(settings, 'MULTILINGUAL_TAGS', False)
 if MULTILINGUAL_TAGS:
@@ -0,0 +1,405 @@
+"""
+A read-only snapshot of the associations between tags and objects,
+memory-mapped by every process which reads it.
+
+``write_snapshot`` exports the tagged items into a file holding, for
+each content type, two compressed sparse row (CSR) structures of
+unsigned 32-bit integers: the sorted ids of the objects having each tag,
+and the sorted ids of the tags of each object. The file also holds the
+names of the tags. It is written to a temporary file which then replaces
+the previous snapshot, so readers never see it half written.
+
+``TagSnapshot`` maps the file into memory without reading or copying
+it: the processes of a server reading the same snapshot share a single
+copy in the page cache. Usage counts, intersections, unions and
+co-occurring tags are then computed in-process, from sorted arrays,
+without querying the database. ``get_snapshot`` returns the current
+snapshot of a process, reopening it when the file was replaced, for
+example by the ``write_tag_snapshot`` management command run from cron.
+
+Snapshots are only as fresh as their last export.
+"""
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from itertools import groupby
+
+from django.contrib.contenttypes.models import ContentType
+
+from tagging import settings
+
+MAGIC = 'TAGSNAP\x01'
+_HEADER = struct.Struct('<8sQI')
+_SECTION = struct.Struct('<32sQQ')
+_ITEM_SIZE = 4
+
+class _Section(object):
+    """
+    A read-only view of an array of unsigned 32-bit integers in a
+    memory map. Values are only unpacked when they are accessed.
+    """
+    def __init__(self, data, offset, length):
+        self.data = data
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            values = self.slice(start, stop)
+            if step != 1:
+                values = values[::step]
+            return values
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return struct.unpack_from('<I', self.data,
+                                  self.offset + index * _ITEM_SIZE)[0]
+
+    def slice(self, start, stop):
+        """
+        Returns the values from ``start`` to ``stop`` as a tuple, with a
+        single unpacking.
+        """
+        if stop <= start:
+            return ()
+        return struct.unpack_from('<%dI' % (stop - start), self.data,
+                                  self.offset + start * _ITEM_SIZE)
+
+    def view(self, start, stop):
+        return _Section(self.data, self.offset + start * _ITEM_SIZE,
+                        max(0, stop - start))
+
+    def __iter__(self):
+        return iter(self.slice(0, self.length))
+
+class _CSR(object):
+    """
+    Sorted keys, each having the sorted values between two offsets.
+    """
+    def __init__(self, keys, offsets, values):
+        self.keys = keys
+        self.offsets = offsets
+        self.values = values
+
+    def get(self, key):
+        index = bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return ()
+        start, stop = self.offsets.slice(index, index + 2)
+        return self.values.view(start, stop)
+
+    def counts(self):
+        """
+        Returns the list of ``(key, number of values)`` pairs.
+        """
+        offsets = self.offsets.slice(0, len(self.offsets))
+        return [(key, offsets[i + 1] - offsets[i])
+                for i, key in enumerate(self.keys.slice(0, len(self.keys)))]
+
+def _contains(values, value):
+    index = bisect_left(values, value)
+    return index < len(values) and values[index] == value
+
+class TagSnapshot(object):
+    """
+    A memory-mapped snapshot written by ``write_snapshot``.
+    """
+    def __init__(self, path):
+        self.path = path
+        input = open(path, 'rb')
+        try:
+            self.stat = os.fstat(input.fileno())
+            self.data = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            input.close()
+        magic, self.version, count = _HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a tag snapshot.' % path)
+        self.sections = {}
+        for i in range(count):
+            name, offset, length = _SECTION.unpack_from(
+                self.data, _HEADER.size + i * _SECTION.size)
+            self.sections[name.rstrip('\0')] = (offset, length)
+        self._ids_by_name = None
+        self._csrs = {}
+
+    def close(self):
+        self.data.close()
+
+    def _section(self, name):
+        offset, length = self.sections[name]
+        return _Section(self.data, offset, length)
+
+    def _csr(self, content_type, by):
+        content_type_id = getattr(content_type, 'pk', content_type)
+        if not isinstance(content_type_id, (int, long)):
+            content_type_id = ContentType.objects.get_for_model(content_type).pk
+        key = (content_type_id, by)
+        csr = self._csrs.get(key)
+        if csr is None:
+            prefix = 'ct%d.%s' % key
+            if '%s.keys' % prefix not in self.sections:
+                empty = _Section(self.data, 0, 0)
+                return _CSR(empty, empty, empty)
+            csr = self._csrs[key] = _CSR(self._section('%s.keys' % prefix),
+                                         self._section('%s.offsets' % prefix),
+                                         self._section('%s.values' % prefix))
+        return csr
+
+    def name(self, tag_id):
+        """
+        Returns the name of the tag with the given id, or ``None``.
+        """
+        ids = self._section('names.ids')
+        index = bisect_left(ids, tag_id)
+        if index == len(ids) or ids[index] != tag_id:
+            return None
+        start, stop = self._section('names.offsets').slice(index, index + 2)
+        offset = self.sections['names.blob'][0]
+        return self.data[offset + start:offset + stop].decode('utf-8')
+
+    def tag_id(self, name):
+        """
+        Returns the id of the tag with the given name, or ``None``.
+        """
+        if self._ids_by_name is None:
+            ids = self._section('names.ids')
+            offsets = self._section('names.offsets')
+            offsets = offsets.slice(0, len(offsets))
+            start = self.sections['names.blob'][0]
+            self._ids_by_name = dict([
+                (self.data[start + offsets[i]:start + offsets[i + 1]].decode('utf-8'), tag_id)
+                for i, tag_id in enumerate(ids)])
+        return self._ids_by_name.get(name)
+
+    def _tag_ids(self, tags):
+        tag_ids = []
+        for tag in tags:
+            if isinstance(tag, basestring):
+                tag = self.tag_id(tag)
+            else:
+                tag = getattr(tag, 'pk', tag)
+            if tag is not None:
+                tag_ids.append(tag)
+        return tag_ids
+
+    def objects(self, model, tag):
+        """
+        Returns the sorted ids of the instances of ``model`` (a model, a
+        ``ContentType`` or its id) having the given tag, given as a
+        ``Tag``, an id or a name.
+        """
+        tag_ids = self._tag_ids([tag])
+        if not tag_ids:
+            return ()
+        return self._csr(model, 'tag').get(tag_ids[0])
+
+    def usage(self, model, min_count=None):
+        """
+        Returns the list of ``(tag id, count)`` pairs of the tags used
+        by instances of ``model``, by tag id.
+        """
+        counts = self._csr(model, 'tag').counts()
+        if min_count is not None:
+            counts = [(tag_id, count) for tag_id, count in counts
+                      if count >= min_count]
+        return counts
+
+    def intersection(self, model, tags):
+        """
+        Returns the sorted ids of the instances of ``model`` having all
+        the given tags.
+        """
+        tags = list(tags)
+        tag_ids = self._tag_ids(tags)
+        if not tag_ids or len(tag_ids) < len(tags):
+            return []
+        csr = self._csr(model, 'tag')
+        postings = [csr.get(tag_id) for tag_id in tag_ids]
+        postings.sort(key=len)
+        # Each object of the shortest list is looked up in the others.
+        result = list(iter(postings[0]))
+        for other in postings[1:]:
+            result = [object_id for object_id in result if _contains(other, object_id)]
+            if not result:
+                break
+        return result
+
+    def union(self, model, tags):
+        """
+        Returns the sorted ids of the instances of ``model`` having any
+        of the given tags.
+        """
+        csr = self._csr(model, 'tag')
+        object_ids = set()
+        for tag_id in self._tag_ids(tags):
+            object_ids.update(iter(csr.get(tag_id)))
+        return sorted(object_ids)
+
+    def related(self, model, tags, min_count=None):
+        """
+        Returns the list of ``(tag id, count)`` pairs of the other tags
+        of the instances of ``model`` having all the given tags, most
+        frequent first.
+        """
+        tag_ids = set(self._tag_ids(tags))
+        csr = self._csr(model, 'object')
+        counts = {}
+        for object_id in self.intersection(model, tags):
+            for tag_id in csr.get(object_id):
+                if tag_id not in tag_ids:
+                    counts[tag_id] = counts.get(tag_id, 0) + 1
+        related = [(tag_id, count) for tag_id, count in counts.iteritems()
+                   if min_count is None or count >= min_count]
+        related.sort(key=lambda pair: (-pair[1], pair[0]))
+        return related
+
+class _Writer(object):
+    """
+    Writes the sections of a snapshot to ``output`` as soon as they are
+    built, then the table of sections, for which room is left after the
+    header.
+    """
+    def __init__(self, output, version, names):
+        self.output = output
+        self.names = names
+        self.wanted = set(names)
+        self.sections = {}
+        output.write(_HEADER.pack(MAGIC, version, len(names)))
+        output.write('\0' * (len(names) * _SECTION.size))
+
+    def write(self, name, data):
+        if name not in self.wanted:
+            # A content type tagged since the sections were listed.
+            return
+        length = len(data)
+        if isinstance(data, array):
+            if sys.byteorder == 'big':
+                data.byteswap()
+            data = data.tostring()
+        # Sections are aligned for faster unpacking.
+        self.output.write('\0' * (-self.output.tell() % 8))
+        self.sections[name] = (self.output.tell(), length)
+        self.output.write(data)
+
+    def close(self):
+        self.output.seek(_HEADER.size)
+        for name in self.names:
+            # Sections left unwritten are empty.
+            offset, length = self.sections.get(name, (0, 0))
+            self.output.write(_SECTION.pack(name, offset, length))
+
+def _write_csr(writer, prefix, rows):
+    """
+    Writes the sections of a CSR structure built from ``(content type
+    id, key, value)`` rows sorted by key, then by value.
+    """
+    keys, offsets, values = array('I'), array('I'), array('I')
+    previous = None
+    for content_type_id, key, value in rows:
+        if key != previous:
+            keys.append(key)
+            offsets.append(len(values))
+            previous = key
+        values.append(value)
+    offsets.append(len(values))
+    writer.write('%s.keys' % prefix, keys)
+    writer.write('%s.offsets' % prefix, offsets)
+    writer.write('%s.values' % prefix, values)
+
+def _rows(cursor, query, batch=10000):
+    cursor.execute(query)
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+def write_snapshot(path=None):
+    """
+    Exports all tagged items and tag names to a snapshot file at
+    ``path`` (``TAG_SNAPSHOT_PATH`` by default), replacing it atomically.
+    Returns the version of the snapshot.
+    """
+    from tagging.models import Tag, TaggedItem, _connection, _read_db, preload_translations
+
+    if path is None:
+        path = settings.TAG_SNAPSHOT_PATH
+    db = _read_db(TaggedItem.objects, TaggedItem)
+    conn = _connection(db)
+    qn = conn.ops.quote_name
+    table = qn(TaggedItem._meta.db_table)
+    bys = (('tag', 'tag_id', 'object_id'), ('object', 'object_id', 'tag_id'))
+    content_type_ids = [row[0] for row in _rows(conn.cursor(),
+        'SELECT DISTINCT content_type_id FROM %s ORDER BY content_type_id' % table)]
+    names = []
+    for by, first, second in bys:
+        for content_type_id in content_type_ids:
+            for part in ('keys', 'offsets', 'values'):
+                names.append('ct%d.%s.%s' % (content_type_id, by, part))
+    names.extend(['names.ids', 'names.offsets', 'names.blob'])
+
+    version = int(time.time() * 1000)
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    output = open(temporary, 'wb')
+    try:
+        writer = _Writer(output, version, names)
+        for by, first, second in bys:
+            rows = _rows(conn.cursor(),
+                'SELECT content_type_id, %s, %s FROM %s ORDER BY content_type_id, %s, %s'
+                % (first, second, table, first, second))
+            # Only the arrays of one content type are in memory at a
+            # time: each is written as soon as it's built.
+            for content_type_id, content_type_rows in groupby(rows, lambda row: row[0]):
+                _write_csr(writer, 'ct%d.%s' % (content_type_id, by),
+                           content_type_rows)
+
+        tags = list(Tag.objects.order_by('pk'))
+        preload_translations(tags)
+        ids, offsets, blob = array('I'), array('I'), []
+        size = 0
+        for tag in tags:
+            name = (tag.name or tag.name_any or u'').encode('utf-8')
+            ids.append(tag.pk)
+            offsets.append(size)
+            blob.append(name)
+            size += len(name)
+        offsets.append(size)
+        writer.write('names.ids', ids)
+        writer.write('names.offsets', offsets)
+        writer.write('names.blob', ''.join(blob))
+        writer.close()
+    finally:
+        output.close()
+    os.rename(temporary, path)
+    return version
+
+_snapshots = {}
+
+def get_snapshot(path=None):
+    """
+    Returns the ``TagSnapshot`` at ``path`` (``TAG_SNAPSHOT_PATH`` by
+    default), mapped once per process and reopened when the file has
+    been replaced. Returns ``None`` if there is no snapshot.
+    """
+    if path is None:
+        path = settings.TAG_SNAPSHOT_PATH
+    snapshot = _snapshots.get(path)
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if snapshot is None or (stat.st_ino, stat.st_mtime) != (
+            snapshot.stat.st_ino, snapshot.stat.st_mtime):
+        snapshot = _snapshots[path] = TagSnapshot(path)
+    return snapshot
@@ -0,0 +1,312 @@
+"""
+Suggestion of existing tags for a text.
+
+The names of all tags and synonyms are compiled into an Aho-Corasick
+automaton: a trie of the names with failure links, which finds every
+occurrence of every name in a single pass over the text, however many
+names there are. Names only match whole words, case-insensitively.
+
+The automaton is built once per process, the first time it's used, and
+updated in place whenever a tag or synonym is saved or deleted. Other
+processes learn about changes through a version number kept in the
+cache, along with the id of the tag changed by each version. They
+refresh the names of these tags only, and rebuild their automaton when
+some of these changes were lost, so the cache must be shared between
+processes for them to see each other's changes.
+"""
+import threading
+import time
+
+from django.core.cache import cache
+from django.utils.encoding import force_unicode
+
+VERSION_KEY = 'tagging.suggest.version'
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+CHANGE_KEY = 'tagging.suggest.change.%s'
+# Beyond this many changes, rebuilding is cheaper than refreshing.
+MAX_CHANGES = 1000
+
+class Automaton(object):
+    """
+    An Aho-Corasick automaton, mapping string patterns to values.
+
+    Patterns may be added and removed at any time. Failure links are
+    recomputed, without looking patterns up again, by the first search
+    following a change.
+    """
+    def __init__(self):
+        self.goto = [{}]
+        self.outputs = [{}]
+        self.fail = [0]
+        self.output_link = [None]
+        self.dirty = False
+
+    def add(self, pattern, value):
+        """
+        Adds ``pattern``, which will match as ``value``.
+        """
+        node = 0
+        for char in pattern:
+            next = self.goto[node].get(char)
+            if next is None:
+                next = len(self.goto)
+                self.goto[node][char] = next
+                self.goto.append({})
+                self.outputs.append({})
+                self.fail.append(0)
+                self.output_link.append(None)
+            node = next
+        self.outputs[node][value] = len(pattern)
+        self.dirty = True
+
+    def remove(self, pattern, value):
+        """
+        Stops ``pattern`` from matching as ``value``.
+        """
+        node = 0
+        for char in pattern:
+            node = self.goto[node].get(char)
+            if node is None:
+                return
+        if self.outputs[node].pop(value, None) is not None:
+            self.dirty = True
+
+    def _link(self):
+        # Breadth first, so that the failure link of a node's parent is
+        # known before the node's.
+        queue = []
+        for node in self.goto[0].itervalues():
+            self.fail[node] = 0
+            self.output_link[node] = None
+            queue.append(node)
+        for parent in queue:
+            for char, node in self.goto[parent].iteritems():
+                fail = self.fail[parent]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[node] = fail
+                # The nearest suffix node which completes a pattern.
+                if self.outputs[fail]:
+                    self.output_link[node] = fail
+                else:
+                    self.output_link[node] = self.output_link[fail]
+                queue.append(node)
+        self.dirty = False
+
+    def search(self, text):
+        """
+        Yields ``(start, end, value)`` for each occurrence of a pattern
+        in ``text``, ``text[start:end]`` being the occurrence.
+        """
+        if self.dirty:
+            self._link()
+        goto, fail, outputs, output_link = (self.goto, self.fail,
+                                            self.outputs, self.output_link)
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            match = outputs[node] and node or output_link[node]
+            while match is not None:
+                for value, length in outputs[match].iteritems():
+                    yield end + 1 - length, end + 1, value
+                match = output_link[match]
+
+def _normalize(name):
+    return name.strip().lower()
+
+def _is_boundary(text, index):
+    return index < 0 or index >= len(text) or not text[index].isalnum()
+
+class TagMatcher(object):
+    """
+    Finds the names of tags and of their synonyms in texts.
+    """
+    def __init__(self, version=None):
+        self.version = version
+        self.automaton = Automaton()
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Adds the names of all tags and synonyms, with two queries.
+        """
+        for tag_id, name in _load_names():
+            self._add(tag_id, name)
+
+    def _add(self, tag_id, name):
+        name = _normalize(name)
+        if name:
+            self.names.setdefault(tag_id, set()).add(name)
+            self.automaton.add(name, tag_id)
+
+    def refresh(self, tag_id, deleted=False):
+        """
+        Replaces the names of the tag with the given id by the ones in
+        the database, or removes them if ``deleted``.
+        """
+        self.lock.acquire()
+        try:
+            for name in self.names.pop(tag_id, ()):
+                self.automaton.remove(name, tag_id)
+            if not deleted:
+                for name in _load_names(tag_id):
+                    self._add(tag_id, name[1])
+        finally:
+            self.lock.release()
+
+    def catch_up(self, version):
+        """
+        Applies the changes made by other processes up to ``version``,
+        as recorded in the cache. Returns ``False``, leaving the matcher
+        untouched, if some of them are missing.
+        """
+        if self.version is None or not 0 < version - self.version <= MAX_CHANGES:
+            return False
+        keys = [CHANGE_KEY % v for v in range(self.version + 1, version + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            return False
+        # Names are reloaded from the database, so only the last change
+        # of each tag matters.
+        deleted = {}
+        for key in keys:
+            tag_id, tag_deleted = changes[key]
+            deleted[tag_id] = tag_deleted
+        for tag_id, tag_deleted in deleted.iteritems():
+            self.refresh(tag_id, tag_deleted)
+        self.version = version
+        return True
+
+    def count(self, text):
+        """
+        Returns a dictionary mapping the ids of the tags whose names or
+        synonyms occur in ``text`` to their number of occurrences.
+        """
+        text = force_unicode(text).lower()
+        counts = {}
+        self.lock.acquire()
+        try:
+            for start, end, tag_id in self.automaton.search(text):
+                if _is_boundary(text, start - 1) and _is_boundary(text, end):
+                    counts[tag_id] = counts.get(tag_id, 0) + 1
+        finally:
+            self.lock.release()
+        return counts
+
+def _load_names(tag_id=None):
+    """
+    Returns a list of ``(tag id, name)`` pairs of the names, in any
+    language, and synonyms of all tags or of the tag with the given id.
+    """
+    from tagging.models import Synonym, _connection, _tag_names_table
+
+    names_table, names_tag_id = _tag_names_table()
+    qn = _connection(None).ops.quote_name
+    query = 'SELECT %s, %s FROM %s' % (qn(names_tag_id), qn('name'), qn(names_table))
+    params = []
+    synonyms = Synonym._default_manager.all()
+    if tag_id is not None:
+        query += ' WHERE %s = %%s' % qn(names_tag_id)
+        params.append(tag_id)
+        synonyms = synonyms.filter(tag__pk=tag_id)
+    cursor = _connection(None).cursor()
+    cursor.execute(query, params)
+    names = [(row[0], row[1]) for row in cursor.fetchall() if row[1]]
+    names.extend(synonyms.values_list('tag', 'name'))
+    return names
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+def get_matcher():
+    """
+    Returns this process' ``TagMatcher``, building it if it doesn't
+    exist yet, and bringing it up to date if tags were changed by
+    another process.
+    """
+    global _matcher
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # Starting from the time, a version lost by the cache can't come
+        # back with a value some process already has.
+        cache.add(VERSION_KEY, int(time.time()), VERSION_TIMEOUT)
+        version = cache.get(VERSION_KEY)
+    matcher = _matcher
+    if matcher is not None and matcher.version == version:
+        return matcher
+    _matcher_lock.acquire()
+    try:
+        if _matcher is not None and (_matcher.version == version or
+                                     _matcher.catch_up(version)):
+            return _matcher
+        matcher = TagMatcher(version)
+        matcher.load()
+        _matcher = matcher
+        return matcher
+    finally:
+        _matcher_lock.release()
+
+def _bump_version():
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # Nobody has built a matcher since the version was lost.
+        return None
+
+def tag_changed(tag_id, deleted=False):
+    """
+    Updates the matcher of this process, if it was built, after the
+    names or synonyms of the tag with the given id were changed, and
+    tells other processes to refresh theirs.
+    """
+    version = _bump_version()
+    if version is not None:
+        cache.set(CHANGE_KEY % version, (tag_id, deleted), VERSION_TIMEOUT)
+    matcher = _matcher
+    if matcher is None:
+        return
+    if matcher.version is None:
+        # The cache doesn't keep versions, so only this process can be
+        # kept up to date.
+        matcher.refresh(tag_id, deleted)
+    elif version is not None and matcher.version == version - 1:
+        matcher.refresh(tag_id, deleted)
+        matcher.version = version
+
+def invalidate():
+    """
+    Makes every process, this one included, rebuild its matcher, after
+    names were changed without sending signals.
+    """
+    global _matcher
+    _bump_version()
+    _matcher = None
+
+def suggest_tags(text, limit=None, exclude=None):
+    """
+    Returns the list of existing tags whose names, or the names of
+    whose synonyms, occur in ``text`` as whole words, most frequent
+    first. Each tag has a ``count`` attribute holding its number of
+    occurrences.
+
+    ``limit`` caps the number of returned tags, and tags whose names
+    are in ``exclude`` are skipped.
+    """
+    from tagging.models import Tag
+
+    counts = get_matcher().count(text)
+    tags = Tag.objects._in_bulk(counts.keys()).values()
+    if exclude:
+        exclude = set([_normalize(name) for name in exclude])
+        tags = [tag for tag in tags
+                if _normalize(tag.name or tag.name_any) not in exclude]
+    for tag in tags:
+        tag.count = counts[tag.pk]
+    tags.sort(key=lambda tag: (-tag.count, tag.name or tag.name_any))
+    if limit is not None:
+        tags = tags[:limit]
+    return tags
@@ -1,3 +1,5 @@
+from datetime import timedelta
+
 from django.db.models import get_model
 from django.template import Library, Node, TemplateSyntaxError, Variable, resolve_variable
 from django.utils.translation import ugettext as _
@@ -34,6 +36,21 @@ class TagCloudForModelNode(Node):
             Tag.objects.cloud_for_model(model, **self.kwargs)
         return ''
 
+class TrendingTagsForModelNode(Node):
+    def __init__(self, model, context_var, window, limit):
+        self.model = model
+        self.context_var = context_var
+        self.window = window
+        self.limit = limit
+
+    def render(self, context):
+        model = get_model(*self.model.split('.'))
+        if model is None:
+            raise TemplateSyntaxError(_('trending_tags_for_model tag was given an invalid model: %s') % self.model)
+        context[self.context_var] = \
+            Tag.objects.trending(model, self.window, self.limit)
+        return ''
+
 class TagsForObjectNode(Node):
     def __init__(self, obj, context_var):
         self.obj = Variable(obj)
@@ -193,6 +210,77 @@ def do_tag_cloud_for_model(parser, token):
                 })
     return TagCloudForModelNode(bits[1], bits[3], **kwargs)
 
+def do_trending_tags_for_model(parser, token):
+    """
+    Retrieves a list of the ``Tag`` objects which were most often added
+    to instances of a given model recently, with a ``count`` attribute,
+    and stores them in a context variable.
+
+    Usage::
+
+       {% trending_tags_for_model [model] as [varname] %}
+
+    The model is specified in ``[appname].[modelname]`` format.
+
+    Extended usage::
+
+       {% trending_tags_for_model [model] as [varname] with [options] %}
+
+    Extra options can be provided after an optional ``with`` argument,
+    with each option being specified in ``[name]=[value]`` format. Valid
+    extra options are:
+
+       ``days``
+          Integer. The number of days to look back. Defaults to 7.
+
+       ``hours``
+          Integer. The number of hours to look back, added to ``days``.
+
+       ``limit``
+          Integer. The maximum number of tags. Defaults to 10.
+
+    Examples::
+
+       {% trending_tags_for_model products.Widget as widget_tags %}
+       {% trending_tags_for_model products.Widget as widget_tags with hours=6 limit=5 %}
+
+    """
+    bits = token.contents.split()
+    len_bits = len(bits)
+    if len_bits != 4 and len_bits not in range(6, 9):
+        raise TemplateSyntaxError(_('%s tag requires either three or between five and seven arguments') % bits[0])
+    if bits[2] != 'as':
+        raise TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
+    options = {}
+    if len_bits > 5:
+        if bits[4] != 'with':
+            raise TemplateSyntaxError(_("if given, fourth argument to %s tag must be 'with'") % bits[0])
+        for i in range(5, len_bits):
+            try:
+                name, value = bits[i].split('=')
+            except ValueError:
+                raise TemplateSyntaxError(_("%(tag)s tag was given a badly formatted option: '%(option)s'") % {
+                    'tag': bits[0],
+                    'option': bits[i],
+                })
+            if name not in ('days', 'hours', 'limit'):
+                raise TemplateSyntaxError(_("%(tag)s tag was given an invalid option: '%(option)s'") % {
+                    'tag': bits[0],
+                    'option': name,
+                })
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise TemplateSyntaxError(_("%(tag)s tag's '%(option)s' option was not a valid integer: '%(value)s'") % {
+                    'tag': bits[0],
+                    'option': name,
+                    'value': value,
+                })
+    if 'days' not in options and 'hours' not in options:
+        options['days'] = 7
+    window = timedelta(days=options.get('days', 0), hours=options.get('hours', 0))
+    return TrendingTagsForModelNode(bits[1], bits[3], window, options.get('limit', 10))
+
 def do_tags_for_object(parser, token):
     """
     Retrieves a list of ``Tag`` objects associated with an object and
@@ -262,6 +350,7 @@ def do_related_objects(parser, token):
 
 register.tag('tags_for_model', do_tags_for_model)
 register.tag('tag_cloud_for_model', do_tag_cloud_for_model)
+register.tag('trending_tags_for_model', do_trending_tags_for_model)
 register.tag('tags_for_object', do_tags_for_object)
 register.tag('tagged_objects', do_tagged_objects)
 register.tag('related_objects', do_related_objects)
@@ -3,11 +3,19 @@ import os
 from pdb import set_trace
 from unittest import TestCase
 from django import forms
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
-from tagging.forms import TagField
-from tagging import settings
-from tagging.models import Tag, TaggedItem
-from tagging.tests.models import Article, Link, Perch, Parrot, FormTest
+from tagging.forms import TagField, add_tag_suggestions
+from tagging import minhash, settings, suggest
+from tagging.autotag import autotag
+from tagging.duplicates import duplicate_rules, find_duplicates
+from tagging.generic import fetch_content_objects, fetch_synonyms, fetch_tags, prefetch_queryset
+from tagging.managers import tagged_queryset
+from tagging.models import Synonym, Tag, TaggedItem, TagBucket, TagClosure, TagCounter, TagStamp
+from tagging.pagination import tagged_keyset_page
+from tagging.results import result_key
+from tagging.snapshot import get_snapshot, write_snapshot
+from tagging.tests.models import Article, Link, Perch, Parrot, FormTest, Post, Widget
 from tagging.utils import calculate_cloud, get_tag_list, get_tag, parse_tag_input
 from tagging.utils import LINEAR
 
@@ -221,6 +229,17 @@ class RetrivingTests(BaseTestCase):
         self.assertEqual([],
             get_tagcounts(Tag.objects.usage_for_model(Parrot, filters=dict(perch__size__gt=99))))
 
+    def testReadDatabase(self):
+        settings.TAG_READ_DATABASE = 'default'
+        try:
+            self.assertEqual(
+                [(u'bar', 3), (u'baz', 1), (u'foo', 2), (u'ter', 3)],
+                get_tagcounts(Tag.objects.usage_for_model(Parrot, counts=True)))
+            self.assertEqual('[<Parrot: late>, <Parrot: passed on>]',
+                repr(TaggedItem.objects.get_by_model(Parrot, [self.bar, self.ter])))
+        finally:
+            settings.TAG_READ_DATABASE = None
+
     def testRelatedTags(self):
         self.assertEqual([(u'baz', 1), (u'foo', 1), (u'ter', 2)],
             get_tagcounts(Tag.objects.related_for_model(Tag.objects.filter(name__in=['bar']), Parrot, counts=True)))
@@ -286,6 +305,63 @@ class RetrivingTests(BaseTestCase):
         self.assertEqual('[<Parrot: late>, <Parrot: passed on>, <Parrot: pining for the fjords>]',
             repr(TaggedItem.objects.get_union_by_model(Parrot, ['bar', 'baz'])))
 
+    def testRankedUnions(self):
+        def states(parrots):
+            return [parrot.state for parrot in parrots]
+        self.assertEqual(['passed on', 'late', 'pining for the fjords', 'no more'],
+            states(TaggedItem.objects.get_ranked_union_by_model(Parrot, 'bar ter baz')))
+        self.assertEqual(['late', 'pining for the fjords'],
+            states(TaggedItem.objects.get_ranked_union_by_model(Parrot, 'bar ter baz',
+                                                                num=2, offset=1)))
+        self.assertEqual(['pining for the fjords', 'no more', 'passed on', 'late'],
+            states(TaggedItem.objects.get_ranked_union_by_model(Parrot, 'foo bar ter',
+                                                                weights={'foo': 5})))
+        self.assertEqual(['pining for the fjords'],
+            states(TaggedItem.objects.get_ranked_union_by_model(
+                Parrot.objects.filter(perch__smelly=True), 'bar ter baz', num=1)))
+        self.assertEqual([], TaggedItem.objects.get_ranked_union_by_model(Parrot, []))
+
+    def testRankedUnionsIgnoreDeletedInstances(self):
+        from django.db import connection
+
+        passed_on = Parrot.objects.get(state='passed on')
+        # As if the instance had been deleted without signals.
+        connection.cursor().execute('DELETE FROM %s WHERE id = %%s'
+                                    % Parrot._meta.db_table, [passed_on.pk])
+        self.assertEqual(['late', 'pining for the fjords'],
+            [parrot.state for parrot in TaggedItem.objects.get_ranked_union_by_model(
+                Parrot, 'bar ter baz', num=2)])
+
+    def testRelatedByInverseDocumentFrequency(self):
+        def states(parrots):
+            return [parrot.state for parrot in parrots]
+        TagStamp.objects.update_counts()
+        self.assertEqual(2, TagStamp.objects.get_for(self.foo, Parrot).count)
+        self.assertEqual(3, TagStamp.objects.get_for(self.bar, Parrot).count)
+        pining = Parrot.objects.get(state='pining for the fjords')
+        # Sharing the rarer 'foo' beats sharing 'bar'.
+        self.assertEqual(['no more', 'passed on', 'late'],
+            states(TaggedItem.objects.get_related(pining, Parrot, idf=True)))
+        self.assertEqual(['no more'],
+            states(TaggedItem.objects.get_related(pining, Parrot, num=1, idf=True)))
+        self.assertEqual(['no more'],
+            states(TaggedItem.objects.get_related(pining, Parrot, idf=True,
+                                                  max_frequency=0.5)))
+        self.assertEqual([],
+            TaggedItem.objects.get_related(pining, Parrot, idf=True,
+                                           max_frequency=0.25))
+        self.assertEqual(Parrot.objects.count(), TagStamp.objects.total(Parrot))
+
+        # Counts missing since the last update aren't taken as rare tags.
+        TagStamp.objects.all().update(count=0)
+        self.assertEqual(['no more', 'passed on', 'late'],
+            states(TaggedItem.objects.get_related(pining, Parrot, idf=True)))
+
+        # Neither are tags without stamps, which are still ranked.
+        TagStamp.objects.filter(tag__pk=self.bar.pk).delete()
+        self.assertEqual(['no more', 'passed on', 'late'],
+            states(TaggedItem.objects.get_related(pining, Parrot, idf=True)))
+
     def testIssue114UnionWithNonExistantTags(self):
         self.assertListsEqual([], TaggedItem.objects.get_union_by_model(Parrot, []))
 
@@ -378,3 +454,774 @@ class TagFieldTests(BaseTestCase):
         self.assertEqual(u'foo qwertyuiopasdfghjklzxcvbnmqwertyuiopasdfghjklzxcvb bar',
                          t.clean('foo qwertyuiopasdfghjklzxcvbnmqwertyuiopasdfghjklzxcvb bar'))
         self.assertRaises(ValidationError, t.clean, 'foo qwertyuiopasdfghjklzxcvbnmqwertyuiopasdfghjklzxcvbn bar')
+
+class TagStampTests(BaseTestCase):
+    def setUp(self):
+        super(TagStampTests, self).setUp()
+        self.parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(self.parrot, 'foo bar')
+        self.foo = Tag.objects.get(name='foo')
+
+    def testVersionChangesWithAssociations(self):
+        stamp = TagStamp.objects.get_for(self.foo, Parrot)
+        self.assertEqual(1, stamp.version)
+        self.assertEqual(None, TagStamp.objects.get_for(self.foo, Link))
+
+        other = Parrot.objects.create(state='late')
+        Tag.objects.update_tags(other, 'foo')
+        self.assertEqual(2, TagStamp.objects.get_for(self.foo, Parrot).version)
+
+        Tag.objects.update_tags(self.parrot, 'bar')
+        self.assertEqual(3, TagStamp.objects.get_for(self.foo, Parrot).version)
+
+        # Changing other tags doesn't touch this one
+        Tag.objects.update_tags(self.parrot, 'bar baz')
+        self.assertEqual(3, TagStamp.objects.get_for(self.foo, Parrot).version)
+
+    def testConditionalTaggedObjectList(self):
+        from django.http import HttpRequest, QueryDict
+        from tagging.views import tagged_object_list
+
+        stamp = TagStamp.objects.get_for(self.foo, Parrot)
+        request = HttpRequest()
+        request.method = 'GET'
+        request.GET = QueryDict('')
+        request.META['HTTP_IF_NONE_MATCH'] = '"%s"' % stamp.etag('', False, True)
+        response = tagged_object_list(request, Parrot, 'foo', conditional=True)
+        self.assertEqual(304, response.status_code)
+
+class KeysetPaginationTests(BaseTestCase):
+    def setUp(self):
+        super(KeysetPaginationTests, self).setUp()
+        self.parrots = []
+        for state in ('late', 'no more', 'passed on'):
+            parrot = Parrot.objects.create(state=state)
+            Tag.objects.update_tags(parrot, 'bar')
+            self.parrots.append(parrot)
+
+    def testPages(self):
+        page = tagged_keyset_page(Parrot, 'bar', per_page=2)
+        self.assertEqual(self.parrots[:2], page.object_list)
+        self.assertEqual(3, page.count)
+        self.assertEqual(True, page.has_next())
+        self.assertEqual(False, page.has_previous())
+
+        page = tagged_keyset_page(Parrot, 'bar', after=page.next_after, per_page=2)
+        self.assertEqual(self.parrots[2:], page.object_list)
+        self.assertEqual(False, page.has_next())
+        self.assertEqual(True, page.has_previous())
+
+        page = tagged_keyset_page(Parrot, 'bar', per_page=2, descending=True)
+        self.assertEqual([self.parrots[2], self.parrots[1]], page.object_list)
+
+    def testPagesOfSeveralTags(self):
+        for parrot in self.parrots:
+            Tag.objects.update_tags(parrot, 'bar foo')
+        Tag.objects.update_tags(self.parrots[1], 'bar')
+        page = tagged_keyset_page(Parrot, 'bar foo', per_page=1)
+        self.assertEqual(self.parrots[:1], page.object_list)
+        self.assertEqual(2, page.count)
+        page = tagged_keyset_page(Parrot, 'bar foo', after=page.next_after, per_page=1)
+        self.assertEqual(self.parrots[2:], page.object_list)
+        self.assertEqual(False, page.has_next())
+
+        page = tagged_keyset_page(Parrot.objects.exclude(pk=self.parrots[2].pk),
+                                  'bar foo', descending=True)
+        self.assertEqual(self.parrots[:1], page.object_list)
+        self.assertEqual(1, page.count)
+
+    def testCachedCountFollowsTagChanges(self):
+        self.assertEqual(3, tagged_keyset_page(Parrot, 'bar').count)
+        Tag.objects.update_tags(self.parrots[0], 'foo')
+        self.assertEqual(2, tagged_keyset_page(Parrot, 'bar').count)
+
+class ResultCacheTests(BaseTestCase):
+    def setUp(self):
+        super(ResultCacheTests, self).setUp()
+        self.result_cache = settings.TAG_RESULT_CACHE
+        settings.TAG_RESULT_CACHE = True
+        self.parrots = [Parrot.objects.create(state='parrot %d' % i) for i in range(3)]
+        Tag.objects.update_tags(self.parrots[0], 'foo bar')
+        Tag.objects.update_tags(self.parrots[1], 'foo bar')
+        Tag.objects.update_tags(self.parrots[2], 'foo baz')
+        self.content_type = ContentType.objects.get_for_model(Parrot)
+
+    def tearDown(self):
+        settings.TAG_RESULT_CACHE = self.result_cache
+        super(ResultCacheTests, self).tearDown()
+
+    def testResultsAreCachedUntilTagsChange(self):
+        from django.core.cache import cache
+
+        tags = get_tag_list('foo bar')
+        self.assertEqual(self.parrots[:2],
+                         list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+        key = result_key(self.content_type, tags, 'all')
+        self.assertEqual([self.parrots[0].pk, self.parrots[1].pk], sorted(cache.get(key)))
+        self.assertNotEqual(key, result_key(self.content_type, tags, 'any'))
+
+        # The cached ids are used as long as the tags don't change.
+        cache.set(key, [self.parrots[0].pk])
+        self.assertEqual(self.parrots[:1],
+                         list(TaggedItem.objects.get_by_model(Parrot, tags)))
+        Tag.objects.update_tags(self.parrots[2], 'foo baz ter')
+        self.assertEqual(key, result_key(self.content_type, tags, 'all'))
+
+        Tag.objects.update_tags(self.parrots[2], 'foo bar')
+        self.assertNotEqual(key, result_key(self.content_type, tags, 'all'))
+        self.assertEqual(self.parrots,
+                         list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+
+    def testTagsWithoutStampsAreNotCached(self):
+        from django.core.cache import cache
+
+        # As if the tags had been added before stamps existed.
+        TagStamp.objects.all().delete()
+        tags = get_tag_list('foo bar')
+        self.assertEqual(None, result_key(self.content_type, tags, 'all'))
+        self.assertEqual(self.parrots[:2],
+                         list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+        Tag.objects.update_tags(self.parrots[1], 'foo')
+        self.assertEqual(0, TagStamp.objects.filter(tag__name='bar').count())
+        self.assertEqual(self.parrots[:1],
+                         list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+
+        self.assertEqual(3, TagStamp.objects.create_missing(self.content_type))
+        key = result_key(self.content_type, tags, 'all')
+        self.assertEqual(self.parrots[:1],
+                         list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+        self.assertEqual([self.parrots[0].pk], cache.get(key))
+        Tag.objects.update_tags(self.parrots[0], 'foo')
+        self.assertEqual([], list(TaggedItem.objects.get_intersection_by_model(Parrot, tags)))
+
+    def testUnionsAreCached(self):
+        from django.core.cache import cache
+
+        tags = get_tag_list('bar baz')
+        self.assertEqual(self.parrots,
+                         list(TaggedItem.objects.get_union_by_model(Parrot, tags)))
+        key = result_key(self.content_type, tags, 'any')
+        self.assertEqual(sorted([parrot.pk for parrot in self.parrots]),
+                         sorted(cache.get(key)))
+        Tag.objects.update_tags(self.parrots[2], 'foo')
+        self.assertEqual(self.parrots[:2],
+                         list(TaggedItem.objects.get_union_by_model(Parrot, tags)))
+
+class PrefetchTests(BaseTestCase):
+    def setUp(self):
+        super(PrefetchTests, self).setUp()
+        self.parrot = Parrot.objects.create(state='dead')
+        self.link = Link.objects.create(name='link 1')
+        Tag.objects.update_tags(self.parrot, 'foo bar')
+        Tag.objects.update_tags(self.link, 'foo')
+        Tag.objects.get(name='foo').synonyms.create(name='fu')
+
+    def testPrefetchingQuerySetCallsCallbacks(self):
+        batches = []
+        queryset = prefetch_queryset(Tag.objects.all(), fetch_synonyms, batches.append)
+        tags = list(queryset.filter(name__in=['bar', 'foo'])[:2])
+        self.assertEqual(1, len(batches))
+        self.assertEqual(tags, batches[0])
+        self.assertEqual([[], [u'fu']],
+            [[s.name for s in tag.synonyms_cache] for tag in tags])
+        # Classes are only created once for each set of callbacks.
+        self.assert_(queryset.__class__ is prefetch_queryset(
+            Tag.objects.filter(name='foo'), fetch_synonyms, batches.append).__class__)
+
+    def testFetchContentObjects(self):
+        items = list(TaggedItem.objects.filter(tag__name='foo').order_by('id'))
+        self.link.delete()
+        fetch_content_objects(items)
+        self.assertEqual([self.parrot, None], [item.object for item in items])
+
+    def testFetchContentObjectsInChunksAndThreads(self):
+        from tagging.generic import _db_for, _threads_can_load
+
+        # Other threads can't see the rows of the test's transaction,
+        # so the objects are loaded by this one.
+        self.assertEqual(False, _threads_can_load(set([_db_for(Parrot)])))
+        items = list(TaggedItem.objects.filter(tag__name__in=['foo', 'bar']))
+        fetch_content_objects(items, only={'parrot': ['state']}, chunk_size=1,
+                              threads=2)
+        objects = dict([(item.object_id, item.object) for item in items
+                        if item.content_type.model == 'parrot'])
+        self.assertEqual([self.link], [item.object for item in items
+                                       if item.content_type.model == 'link'])
+        self.assertEqual(self.parrot, objects[self.parrot.pk])
+        self.assertEqual(True, objects[self.parrot.pk]._deferred)
+        self.assertEqual(u'dead', objects[self.parrot.pk].state)
+
+class TagIdsFieldTests(BaseTestCase):
+    def testTagIdsAreKeptUpToDate(self):
+        post = Post.objects.create(name='post 1')
+        self.assertEqual(u'', Post.objects.get(pk=post.pk).tag_ids)
+
+        Tag.objects.update_tags(post, 'foo bar')
+        foo, bar = Tag.objects.get(name='foo'), Tag.objects.get(name='bar')
+        self.assertEqual(u',%d,%d,' % tuple(sorted([foo.pk, bar.pk])),
+                         Post.objects.get(pk=post.pk).tag_ids)
+
+        Tag.objects.update_tags(post, 'bar')
+        self.assertEqual(u',%d,' % bar.pk, Post.objects.get(pk=post.pk).tag_ids)
+
+        bar.delete()
+        self.assertEqual(u'', Post.objects.get(pk=post.pk).tag_ids)
+
+    def testLookups(self):
+        first = Post.objects.create(name='post 1')
+        second = Post.objects.create(name='post 2')
+        Tag.objects.update_tags(first, 'foo bar')
+        Tag.objects.update_tags(second, 'bar')
+        self.assertListsEqual([first], TaggedItem.objects.get_by_model(Post, 'foo'))
+        self.assertListsEqual([first], TaggedItem.objects.get_by_model(Post, 'foo bar'))
+        self.assertListsEqual([first, second], TaggedItem.objects.get_union_by_model(Post, 'foo bar'))
+
+class HierarchyTests(BaseTestCase):
+    def setUp(self):
+        super(HierarchyTests, self).setUp()
+        for name in ('media', 'video', 'clips', 'audio'):
+            setattr(self, name, Tag.objects.create(name=name))
+        TagClosure.objects.set_parent(self.video, self.media)
+        TagClosure.objects.set_parent(self.clips, self.video)
+        TagClosure.objects.set_parent(self.audio, self.media)
+        self.parrot = Parrot.objects.create(state='dead')
+        self.other = Parrot.objects.create(state='late')
+        Tag.objects.update_tags(self.parrot, 'clips audio')
+        Tag.objects.update_tags(self.other, 'video')
+
+    def testNavigation(self):
+        self.assertEqual(self.video, TagClosure.objects.get_parent(self.clips))
+        self.assertEqual(None, TagClosure.objects.get_parent(self.media))
+        self.assertEqual([self.media, self.video],
+                         TagClosure.objects.get_ancestors(self.clips))
+        self.assertEqual(set([self.video, self.audio]),
+                         set(TagClosure.objects.get_children(self.media)))
+        self.assertEqual(set([self.video, self.clips, self.audio]),
+                         set(TagClosure.objects.get_descendants(self.media)))
+
+    def testFilteringIncludesDescendants(self):
+        self.assertListsEqual([], TaggedItem.objects.get_by_model(Parrot, 'media'))
+        self.assertEqual(set([self.parrot, self.other]), set(
+            TaggedItem.objects.get_by_model(Parrot, 'media', include_descendants=True)))
+        self.assertListsEqual([self.parrot], TaggedItem.objects.get_intersection_by_model(
+            Parrot, 'video audio', include_descendants=True))
+        self.assertEqual(set([self.parrot, self.other]), set(
+            TaggedItem.objects.get_union_by_model(Parrot, 'video', include_descendants=True)))
+
+    def testUsageRollsUp(self):
+        usage = dict([(tag.name, tag.count) for tag in Tag.objects.usage_for_model(
+            Parrot, counts=True, include_descendants=True)])
+        # The parrot has two tags below "media", but is counted once.
+        self.assertEqual({u'media': 2, u'video': 2, u'clips': 1, u'audio': 1}, usage)
+
+    def testMovingSubtree(self):
+        TagClosure.objects.set_parent(self.video, self.audio)
+        self.assertEqual([self.media, self.audio, self.video],
+                         TagClosure.objects.get_ancestors(self.clips))
+        self.assertListsEqual([self.parrot], TaggedItem.objects.get_by_model(
+            Parrot, 'audio', include_descendants=False))
+        self.assertEqual(set([self.parrot, self.other]), set(
+            TaggedItem.objects.get_by_model(Parrot, 'audio', include_descendants=True)))
+        self.assertRaises(ValueError, TagClosure.objects.set_parent, self.media, self.clips)
+
+    def testDeletingTagMovesChildrenUp(self):
+        self.video.delete()
+        self.assertEqual(self.media, TagClosure.objects.get_parent(self.clips))
+
+class TrendingTests(BaseTestCase):
+    def setUp(self):
+        super(TrendingTests, self).setUp()
+        TagCounter.objects.all().delete()
+        for state in ('dead', 'late', 'no more'):
+            Tag.objects.update_tags(Parrot.objects.create(state=state), 'foo')
+        Tag.objects.update_tags(Parrot.objects.get(state='dead'), 'foo bar')
+
+    def testTrending(self):
+        self.assertEqual([(u'foo', 3), (u'bar', 1)], [(tag.name, tag.count)
+            for tag in Tag.objects.trending(Parrot)])
+        self.assertEqual([u'foo'], [tag.name for tag in
+            Tag.objects.trending(Parrot, limit=1)])
+        self.assertEqual([], Tag.objects.trending(Link))
+
+    def testCompaction(self):
+        from datetime import datetime, timedelta
+        old = datetime.now() - timedelta(days=3)
+        foo = Tag.objects.get(name='foo')
+        TagCounter.objects.record(foo, ContentType.objects.get_for_model(Parrot), old)
+        TagCounter.objects.record(foo, ContentType.objects.get_for_model(Parrot), old)
+        self.assertEqual(1, TagCounter.objects.compact())
+        self.assertEqual(2, TagCounter.objects.get(period=TagCounter.DAY).count)
+        self.assertEqual(5, Tag.objects.trending(Parrot)[0].count)
+        self.assertEqual(3, Tag.objects.trending(Parrot, timedelta(days=1))[0].count)
+        TagCounter.objects.compact(daily_before=datetime.now())
+        self.assertEqual(0, TagCounter.objects.filter(period=TagCounter.DAY).count())
+
+class QuerySetTaggingTests(BaseTestCase):
+    def setUp(self):
+        super(QuerySetTaggingTests, self).setUp()
+        self.first = FormTest.objects.create(tags='foo')
+        self.second = FormTest.objects.create(tags='')
+        self.third = FormTest.objects.create(tags='')
+
+    def testAddTagToQuerySet(self):
+        queryset = FormTest.objects.filter(pk__in=[self.first.pk, self.second.pk])
+        self.assertEqual(3, Tag.objects.add_tag_to_queryset(queryset, 'foo bar'))
+        self.assertEqual(set([self.first, self.second]),
+                         set(TaggedItem.objects.get_by_model(FormTest, 'foo bar')))
+        self.assertListsEqual([], TaggedItem.objects.get_by_model(
+            FormTest.objects.filter(pk=self.third.pk), 'foo'))
+        self.assertEqual(set([u'foo', u'bar']),
+                         set(FormTest.objects.get(pk=self.second.pk).tags.split(' ')))
+        # Already tagged objects are skipped
+        self.assertEqual(0, Tag.objects.add_tag_to_queryset(queryset, 'bar'))
+
+    def testRemoveTagFromQuerySet(self):
+        Tag.objects.add_tag_to_queryset(FormTest, 'bar')
+        queryset = FormTest.objects.exclude(pk=self.third.pk)
+        self.assertEqual(3, Tag.objects.remove_tag_from_queryset(queryset, 'foo bar'))
+        self.assertEqual(u'', FormTest.objects.get(pk=self.first.pk).tags)
+        self.assertEqual(u'bar', FormTest.objects.get(pk=self.third.pk).tags)
+
+    def testRemoveTagFromTaggedQuerySet(self):
+        parrots = [Parrot.objects.create(state=state) for state in ('dead', 'late')]
+        Tag.objects.add_tag_to_queryset(Parrot.objects.filter(pk__in=[parrot.pk for parrot in parrots]),
+                                        'foo bar')
+        # The queryset joins the tagged items it removes.
+        self.assertEqual(2, Tag.objects.remove_tag_from_queryset(
+            TaggedItem.objects.get_by_model(Parrot, 'foo'), 'foo'))
+        self.assertListsEqual([], TaggedItem.objects.get_by_model(Parrot, 'foo'))
+        self.assertEqual(0, Tag.objects.remove_tag_from_queryset(Parrot, 'foo'))
+
+    def testTagIdsAreUpdated(self):
+        post = Post.objects.create(name='post 1')
+        Tag.objects.add_tag_to_queryset(Post.objects.all(), 'foo')
+        self.assertEqual(u',%d,' % Tag.objects.get(name='foo').pk,
+                         Post.objects.get(pk=post.pk).tag_ids)
+
+class ApproximateRelatedTests(BaseTestCase):
+    def setUp(self):
+        super(ApproximateRelatedTests, self).setUp()
+        self.minhash = settings.TAG_MINHASH
+        settings.TAG_MINHASH = True
+        self.parrot = Parrot.objects.create(state='dead')
+        self.twin = Parrot.objects.create(state='late')
+        self.other = Parrot.objects.create(state='passed on')
+        Tag.objects.update_tags(self.parrot, 'foo bar baz')
+        Tag.objects.update_tags(self.twin, 'foo bar baz')
+        Tag.objects.update_tags(self.other, 'ter')
+
+    def tearDown(self):
+        settings.TAG_MINHASH = self.minhash
+        super(ApproximateRelatedTests, self).tearDown()
+
+    def testBucketsAreUpdatedWithTags(self):
+        content_type = ContentType.objects.get_for_model(Parrot)
+        self.assertEqual(settings.TAG_MINHASH_BANDS, TagBucket.objects.filter(
+            content_type__pk=content_type.pk, object_id=self.twin.pk).count())
+        # Identical sets of tags share all their buckets.
+        self.assertEqual([self.twin],
+            TaggedItem.objects.get_related(self.parrot, Parrot, approximate=True))
+        Tag.objects.update_tags(self.twin, 'ter')
+        self.assertEqual([],
+            TaggedItem.objects.get_related(self.parrot, Parrot, approximate=True))
+        self.assertEqual([self.twin],
+            TaggedItem.objects.get_related(self.other, Parrot, num=1, approximate=True))
+        Tag.objects.update_tags(self.twin, None)
+        self.assertEqual(0, TagBucket.objects.filter(
+            content_type__pk=content_type.pk, object_id=self.twin.pk).count())
+
+    def testBucketsAreUpdatedInBulk(self):
+        content_type = ContentType.objects.get_for_model(Parrot)
+        Tag.objects.add_tag_to_queryset(Parrot.objects.filter(pk=self.other.pk), 'foo bar baz')
+        Tag.objects.remove_tag_from_queryset(Parrot.objects.filter(pk=self.other.pk), 'ter')
+        self.assertEqual([self.parrot, self.twin],
+            TaggedItem.objects.get_related(self.other, Parrot, approximate=True))
+        Tag.objects.get(name='foo').delete()
+        Tag.objects.get(name='bar').delete()
+        Tag.objects.get(name='baz').delete()
+        self.assertEqual(0, TagBucket.objects.filter(content_type__pk=content_type.pk).count())
+
+    def testRebuild(self):
+        TagBucket.objects.all().delete()
+        self.assertEqual(3, minhash.rebuild(Parrot))
+        self.assertEqual([self.twin],
+            TaggedItem.objects.get_related(self.parrot, Parrot, approximate=True))
+
+class SuggestionTests(BaseTestCase):
+    def setUp(self):
+        super(SuggestionTests, self).setUp()
+        suggest.invalidate()
+        for name in ('new york', 'york', 'python'):
+            Tag.objects.create(name=name)
+        Synonym.objects.create(name='py', tag=Tag.objects.get(name='python'))
+
+    def testAutomaton(self):
+        automaton = suggest.Automaton()
+        for pattern in ('he', 'she', 'his', 'hers'):
+            automaton.add(pattern, pattern)
+        self.assertEqual([(1, 4, 'she'), (2, 4, 'he'), (2, 6, 'hers')],
+                         sorted(automaton.search('ushers')))
+        automaton.remove('he', 'he')
+        self.assertEqual([(1, 4, 'she'), (2, 6, 'hers')],
+                         sorted(automaton.search('ushers')))
+
+    def testSuggestTags(self):
+        text = 'I moved to New York. Python, py and PYTHON! Pythonic york'
+        self.assertEqual([(u'python', 3), (u'york', 2), (u'new york', 1)],
+                         get_tagcounts(suggest.suggest_tags(text)))
+        self.assertEqual([u'python'], get_tagnames(suggest.suggest_tags(text, limit=1)))
+        self.assertEqual([u'york', u'new york'],
+                         get_tagnames(suggest.suggest_tags(text, exclude=['Python'])))
+
+    def testMatcherIsUpdated(self):
+        self.assertEqual([], suggest.suggest_tags('flask and django'))
+        tag = Tag.objects.create(name='django')
+        self.assertEqual([u'django'], get_tagnames(suggest.suggest_tags('flask and django')))
+        tag.name = 'flask'
+        tag.save()
+        self.assertEqual([u'flask'], get_tagnames(suggest.suggest_tags('flask and django')))
+        tag.delete()
+        self.assertEqual([], suggest.suggest_tags('flask and django'))
+        Synonym.objects.add_synonyms({'python': ['django']})
+        self.assertEqual([u'python'], get_tagnames(suggest.suggest_tags('flask and django')))
+
+    def testChangesByOtherProcessesAreApplied(self):
+        matcher = suggest.get_matcher()
+        # Changes made while the matcher is unknown come from another process.
+        suggest._matcher = None
+        Tag.objects.create(name='django')
+        Synonym.objects.add_synonyms({'python': ['flask']})
+        suggest._matcher = matcher
+        self.failUnless(suggest.get_matcher() is matcher)
+        self.assertEqual([u'django', u'python'],
+                         get_tagnames(suggest.suggest_tags('flask and django')))
+
+        # Without its changes, a version makes the matcher be rebuilt.
+        suggest._matcher = None
+        suggest.invalidate()
+        suggest._matcher = matcher
+        self.failIf(suggest.get_matcher() is matcher)
+        self.assertEqual([u'django', u'python'],
+                         get_tagnames(suggest.suggest_tags('flask and django')))
+
+    def testFormHelper(self):
+        class ArticleForm(forms.Form):
+            tags = TagField()
+        form = ArticleForm(initial={'tags': 'york'})
+        self.assertEqual([u'new york', u'python'],
+            get_tagnames(add_tag_suggestions(form, 'tags', 'Python in New York')))
+        self.assert_('<ul class="tag-suggestions"><li>new york</li><li>python</li></ul>'
+                     in unicode(form['tags']))
+
+class AutotagTests(BaseTestCase):
+    def setUp(self):
+        super(AutotagTests, self).setUp()
+        Parrot.objects.all().delete()
+        for name in ('fjords', 'dead'):
+            Tag.objects.create(name=name)
+        Synonym.objects.create(name='late', tag=Tag.objects.get(name='dead'))
+        self.parrots = [Parrot.objects.create(state=state) for state in
+                        ('dead', 'pining for the fjords', 'late', 'resting')]
+
+    def tagnames(self):
+        return [get_tagnames(Tag.objects.get_for_object(parrot))
+                for parrot in self.parrots]
+
+    def testAutotag(self):
+        progress = autotag(Parrot, ['state'], chunk_size=2, processes=1)
+        self.assertEqual(4, progress.rows)
+        self.assertEqual(3, progress.added)
+        self.assertEqual([[u'dead'], [u'fjords'], [u'dead'], []], self.tagnames())
+
+    def testRerunDoesntTouchStamps(self):
+        autotag(Parrot, ['state'], processes=1)
+        versions = list(TagStamp.objects.order_by('pk').values_list('version', flat=True))
+        progress = autotag(Parrot, ['state'], processes=1)
+        self.assertEqual(3, progress.found)
+        self.assertEqual(0, progress.added)
+        self.assertEqual(versions,
+            list(TagStamp.objects.order_by('pk').values_list('version', flat=True)))
+
+    def testDryRun(self):
+        progress = autotag(Parrot, ['state'], processes=1, dry_run=True)
+        self.assertEqual(3, progress.found)
+        self.assertEqual(0, progress.added)
+        self.assertEqual([[], [], [], []], self.tagnames())
+
+    def testCheckpoint(self):
+        import tempfile
+        handle, checkpoint = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            open(checkpoint, 'w').write('%d\n' % self.parrots[1].pk)
+            progress = autotag(Parrot.objects.all(), ['state'], chunk_size=1,
+                               processes=1, checkpoint=checkpoint)
+            self.assertEqual(2, progress.rows)
+            self.assertEqual([[], [], [u'dead'], []], self.tagnames())
+            self.assertEqual(str(self.parrots[3].pk), open(checkpoint).read().strip())
+        finally:
+            os.remove(checkpoint)
+
+    def testWorkerProcesses(self):
+        progress = autotag(Parrot, ['state'], chunk_size=1, processes=2)
+        self.assertEqual(3, progress.added)
+        self.assertEqual([[u'dead'], [u'fjords'], [u'dead'], []], self.tagnames())
+
+class DuplicateTests(BaseTestCase):
+    def setUp(self):
+        super(DuplicateTests, self).setUp()
+        parrots = [Parrot.objects.create(state='parrot %d' % i) for i in range(3)]
+        for parrot in parrots:
+            Tag.objects.add_tag(parrot, '"Open Source"')
+        Tag.objects.add_tag(parrots[0], 'OpenSource')
+        Tag.objects.add_tag(parrots[0], 'pythn')
+        for name in ('opensource', 'python', 'go', 'js', 'django'):
+            Tag.objects.create(name=name)
+
+    def testFindDuplicates(self):
+        groups = find_duplicates()
+        self.assertEqual([u'Open Source = OpenSource = opensource', u'pythn = python'],
+                         [group.rule() for group in groups])
+        self.assertEqual([1.0, 1.0 - 1.0 / 6], [group.similarity for group in groups])
+        self.assertEqual([3, 1, 0], [tag.count for tag in groups[0].tags])
+        self.assertEqual([u'Open Source = OpenSource = opensource'],
+                         [group.rule() for group in find_duplicates(max_distance=0)])
+
+    def testChainsAreNotJoined(self):
+        Tag.objects.all().delete()
+        for name, count in (('bath', 3), ('cats', 2), ('maths', 1)):
+            for i in range(count):
+                Tag.objects.add_tag(Parrot.objects.create(state='%s %d' % (name, i)), name)
+        for name in ('bats', 'math'):
+            Tag.objects.create(name=name)
+        groups = find_duplicates()
+        self.assertEqual([u'maths = math', u'bath = bats'],
+                         [group.rule() for group in groups])
+        self.assertEqual([0.8, 0.75], [group.similarity for group in groups])
+
+    def testRulesJoinDuplicates(self):
+        Tag.objects.process_rules(duplicate_rules(find_duplicates()))
+        self.assertEqual([u'Open Source', u'django', u'go', u'js', u'pythn'],
+                         sorted([tag.name for tag in Tag.objects.all()]))
+        self.assertEqual(3, TaggedItem.objects.filter(tag__name='Open Source').count())
+
+class SnapshotTests(BaseTestCase):
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.parrots = [Parrot.objects.create(state='parrot %d' % i) for i in range(3)]
+        Tag.objects.update_tags(self.parrots[0], 'foo bar baz')
+        Tag.objects.update_tags(self.parrots[1], 'foo bar')
+        Tag.objects.update_tags(self.parrots[2], 'foo')
+        Tag.objects.update_tags(Article.objects.create(name='article'), 'foo')
+
+    def testSnapshotQueries(self):
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            write_snapshot(path)
+            snapshot = get_snapshot(path)
+            self.failUnless(snapshot is get_snapshot(path))
+            ids = dict([(name, snapshot.tag_id(name)) for name in ('foo', 'bar', 'baz')])
+            self.assertEqual(Tag.objects.get(name='foo').pk, ids['foo'])
+            self.assertEqual(u'bar', snapshot.name(ids['bar']))
+            self.assertEqual(sorted([(ids['foo'], 3), (ids['bar'], 2), (ids['baz'], 1)]),
+                             snapshot.usage(Parrot))
+            self.assertEqual([(ids['foo'], 1)], snapshot.usage(Article))
+            self.assertEqual([self.parrots[0].pk, self.parrots[1].pk],
+                             snapshot.intersection(Parrot, ['foo', 'bar']))
+            self.assertEqual([], snapshot.intersection(Parrot, ['foo', 'missing']))
+            self.assertEqual(sorted([parrot.pk for parrot in self.parrots]),
+                             snapshot.union(Parrot, ['bar', 'foo']))
+            self.assertEqual([(ids['bar'], 2), (ids['baz'], 1)],
+                             snapshot.related(Parrot, ['foo']))
+
+            # A new snapshot is mapped once it replaces the file.
+            Tag.objects.update_tags(self.parrots[2], 'foo bar')
+            write_snapshot(path)
+            self.assertEqual(sorted([parrot.pk for parrot in self.parrots]),
+                             list(get_snapshot(path).objects(Parrot, 'bar')))
+        finally:
+            os.remove(path)
+        self.assertEqual(None, get_snapshot(path))
+
+class ConcurrentWriteTests(BaseTestCase):
+    def testFewerQueriesPerSave(self):
+        from django.conf import settings as django_settings
+        from django.db import connection
+
+        names = ['tag%d' % i for i in range(10)]
+        Tag.objects.update_tags(Parrot.objects.create(state='dead'), ' '.join(names))
+        parrot = Parrot.objects.create(state='late')
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            Tag.objects.update_tags(parrot, ' '.join(names))
+            queries = len(connection.queries)
+        finally:
+            django_settings.DEBUG = debug
+        self.assertEqual(set(names), set([tag.name for tag in Tag.objects.get_for_object(parrot)]))
+        # Formerly, each new association took at least four queries.
+        self.assertTrue(queries < 2 * len(names), queries)
+
+    def testConcurrentUpdates(self):
+        import threading
+        from django.db import connection
+        from tagging.generic import _threads_have_connections
+
+        self.failUnless(_threads_have_connections(),
+            'Threads must be able to connect to the test database; '
+            'set TEST_DATABASE_NAME to a file with SQLite.')
+        parrots = [Parrot.objects.create(state='parrot %d' % i) for i in range(8)]
+        names = ['shared', 'common', 'popular']
+        errors = []
+
+        def work(parrot, index):
+            try:
+                for round in range(5):
+                    Tag.objects.update_tags(parrot, ' '.join(
+                        names + ['own%d' % index, 'round%d' % round]))
+                    Tag.objects.add_tag(parrot, 'extra')
+            except Exception, e:
+                errors.append(e)
+            connection.close()
+
+        threads = [threading.Thread(target=work, args=(parrot, i))
+                   for i, parrot in enumerate(parrots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        for name in names + ['extra', 'round4']:
+            self.assertEqual(1, Tag.objects.filter(name=name).count())
+        for i, parrot in enumerate(parrots):
+            self.assertEqual(set(names + ['own%d' % i, 'round4', 'extra']),
+                set([tag.name for tag in Tag.objects.get_for_object(parrot)]))
+        self.assertEqual(6 * len(parrots), TaggedItem.objects.filter(
+            object_id__in=[parrot.pk for parrot in parrots],
+            content_type=ContentType.objects.get_for_model(Parrot)).count())
+
+class RegisteredModelTests(BaseTestCase):
+    def setUp(self):
+        super(RegisteredModelTests, self).setUp()
+        Widget.objects.all().delete()
+        self.first = Widget.objects.create(name='first')
+        self.second = Widget.objects.create(name='second')
+        self.first.tags = 'foo bar'
+        self.second.tags = 'bar'
+
+    def testGenericRelation(self):
+        bar = Tag.objects.get(name='bar')
+        self.assertListsEqual([self.first, self.second],
+                              Widget.objects.filter(tagged_items__tag=bar))
+
+    def testDescriptorUsesFetchedTags(self):
+        from django.conf import settings as django_settings
+        from django.db import connection
+
+        widgets = list(prefetch_queryset(Widget.objects.all(), fetch_tags))
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            tags = [set([tag.name for tag in widget.tags]) for widget in widgets]
+            queries = len(connection.queries)
+        finally:
+            django_settings.DEBUG = debug
+        self.assertEqual([set([u'bar', u'foo']), set([u'bar'])], tags)
+        self.assertEqual(0, queries)
+
+        widgets[1].tags = 'baz'
+        self.assertEqual([u'baz'], [tag.name for tag in widgets[1].tags])
+        del widgets[0].tags
+        self.assertEqual([], list(widgets[0].tags))
+
+    def testRelatedAcrossModels(self):
+        parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(parrot, 'foo bar baz')
+        related = TaggedItem.objects.get_related_across(parrot, [Parrot, Widget])
+        self.assertEqual([self.first, self.second], related)
+        self.assertEqual([2, 1], [widget.shared_tags for widget in related])
+        self.assertEqual([self.first],
+            TaggedItem.objects.get_related_across(parrot, [Parrot, Widget], num=1))
+        self.assertEqual([parrot, self.second],
+            TaggedItem.objects.get_related_across(self.first, [Parrot, Widget]))
+        self.assertEqual([self.second],
+            TaggedItem.objects.get_related_across(self.first))
+
+    def testRelatedAcrossModelsIgnoresDeletedInstances(self):
+        from django.db import connection
+
+        parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(parrot, 'foo bar baz')
+        # As if the instance had been deleted without signals.
+        connection.cursor().execute('DELETE FROM %s WHERE id = %%s'
+                                    % Widget._meta.db_table, [self.first.pk])
+        self.assertEqual([self.second],
+            TaggedItem.objects.get_related_across(parrot, [Parrot, Widget], num=1))
+
+    def testUsageForModels(self):
+        Tag.objects.update_tags(Parrot.objects.create(state='dead'), 'foo bar baz')
+        tags = Tag.objects.usage_for_models([Parrot, Widget], counts=True)
+        self.assertEqual([(u'bar', 3), (u'baz', 1), (u'foo', 2)], get_tagcounts(tags))
+        self.assertEqual({Parrot: 1, Widget: 2}, tags[0].model_counts)
+        self.assertEqual([u'bar', u'foo'],
+            get_tagnames(Tag.objects.usage_for_models([Parrot, Widget], min_count=2)))
+        self.assertEqual([(u'bar', 2), (u'foo', 1)],
+            get_tagcounts(Tag.objects.usage_for_models(counts=True)))
+
+    def testUsageForModelsIgnoresDeletedInstances(self):
+        from django.db import connection
+
+        parrot = Parrot.objects.create(state='dead')
+        Tag.objects.update_tags(parrot, 'foo ter')
+        # As if the instance had been deleted without signals.
+        connection.cursor().execute('DELETE FROM %s WHERE id = %%s'
+                                    % Parrot._meta.db_table, [parrot.pk])
+        self.assertEqual([(u'bar', 2), (u'foo', 1)],
+            get_tagcounts(Tag.objects.usage_for_models([Parrot, Widget], counts=True)))
+
+    def testChainedTagFilters(self):
+        third = Widget.objects.create(name='third')
+        third.tags = 'baz'
+        self.assertListsEqual([self.first],
+                              Widget.tagged.tagged_with_all('foo bar'))
+        self.assertListsEqual([self.first, third],
+                              Widget.tagged.tagged_with_any(['foo', 'baz']))
+        self.assertListsEqual([self.second],
+                              Widget.tagged.tagged_with_any('foo bar baz')
+                                           .not_tagged_with('foo baz'))
+        self.assertListsEqual([self.second],
+                              Widget.tagged.filter(name='second')
+                                           .tagged_with_all(Tag.objects.filter(name='bar')))
+        self.assertListsEqual([self.first, self.second, third],
+                              Widget.tagged.not_tagged_with('nonexistent'))
+        self.assertListsEqual([], Widget.tagged.tagged_with_any([]))
+        self.assertListsEqual([], Widget.tagged.tagged_with_all('').not_tagged_with('foo'))
+        self.assertListsEqual([self.first],
+                              Widget.tagged.tagged_with_all(Tag.objects.filter(name__in=['foo', 'bar'])))
+        self.assertListsEqual([self.first, self.second],
+                              Widget.tagged.tagged_with_any(
+                                  [tag.pk for tag in Tag.objects.filter(name='bar')]))
+        Synonym.objects.create(name='baa', tag=Tag.objects.get(name='bar'))
+        self.assertListsEqual([self.second],
+                              Widget.tagged.tagged_with_all('baa').not_tagged_with('foo'))
+
+        from django.conf import settings as django_settings
+        from django.db import connection
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            widgets = Widget.tagged.tagged_with_all('baa foo').tagged_with_any(
+                Tag.objects.filter(name='foo')).not_tagged_with([1, 2])
+            queries = len(connection.queries)
+        finally:
+            django_settings.DEBUG = debug
+        self.assertEqual(0, queries)
+
+        widgets = tagged_queryset(Widget.objects.exclude(name='first'))
+        self.assertListsEqual([self.second], widgets.tagged_with_all('bar'))
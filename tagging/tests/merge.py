@@ -1,7 +1,8 @@
 from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase
 
-from tagging.models import Tag, TaggedItem, Synonym
+from tagging.jobs import run_job, run_pending
+from tagging.models import Tag, TaggedItem, Synonym, TagJob
 from tagging.utils import merge, get_tag
 from tagging.tests.synonym_tests import TestItem, TestItemWithCallback
 
@@ -84,3 +85,51 @@ class Merge(TestCase):
         self.assertEqual([], [s.name for s in get_tag('two').synonyms.all()])
         self.assertEqual(['second'], [s.name for s in get_tag('blah').synonyms.all()])
 
+
+class Jobs(TestCase):
+    def setUp(self):
+        self.first = TestItem(title = 'first', tags = 'one, two')
+        self.first.save()
+        self.second = TestItem(title = 'second', tags = 'second')
+        self.second.save()
+
+    def createJob(self, action, tag, **kwargs):
+        tag = get_tag(tag)
+        return TagJob.objects.create(action = action, tag_pk = tag.pk,
+                                     tag_name = tag.name, **kwargs)
+
+    def testMergeJob(self):
+        Synonym.objects.create(name = 'deuxieme', tag = get_tag('second'))
+        job = self.createJob(TagJob.MERGE, 'second', target_pk = get_tag('two').pk)
+        self.assertEqual(True, run_job(job.pk))
+        self.assertEqual(False, run_job(job.pk))
+
+        job = TagJob.objects.get(pk = job.pk)
+        self.assertEqual(TagJob.DONE, job.status)
+        self.assertEqual((1, 1, 100), (job.done, job.total, job.progress()))
+        self.assertEqual(2, len(with_tag('two')))
+        self.assertEqual(None, get_tag('second'))
+        self.assertEqual(['deuxieme', 'second'],
+                         sorted([s.name for s in get_tag('two').synonyms.all()]))
+        self.assertEqual(u'two', TestItem.objects.get(pk = self.second.pk).tags)
+
+    def testDeleteJob(self):
+        self.createJob(TagJob.DELETE, 'one')
+        self.assertEqual(1, run_pending())
+        self.assertEqual(None, get_tag('one'))
+        self.assertEqual(u'two', TestItem.objects.get(pk = self.first.pk).tags)
+
+    def testRenameJob(self):
+        self.createJob(TagJob.RENAME, 'one', new_name = 'three')
+        self.assertEqual(1, run_pending())
+        self.assertEqual(None, get_tag('one'))
+        self.assertEqual(1, len(with_tag('three')))
+        self.assertEqual(set([u'three', u'two']),
+                         set(TestItem.objects.get(pk = self.first.pk).tags.split()))
+
+    def testFailedJob(self):
+        job = self.createJob(TagJob.MERGE, 'second', target_pk = 999999)
+        run_job(job.pk)
+        job = TagJob.objects.get(pk = job.pk)
+        self.assertEqual(TagJob.FAILED, job.status)
+        self.assertNotEqual(u'', job.error)
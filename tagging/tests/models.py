@@ -1,6 +1,7 @@
 from django.db import models
 
-from tagging.fields import TagField
+import tagging
+from tagging.fields import TagField, TagIdsField
 
 class Perch(models.Model):
     size = models.IntegerField()
@@ -36,3 +37,24 @@ class Article(models.Model):
 
 class FormTest(models.Model):
     tags = TagField('Test', help_text='Test')
+
+class Post(models.Model):
+    name = models.CharField(max_length=50)
+    tag_ids = TagIdsField()
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        ordering = ['name']
+
+class Widget(models.Model):
+    name = models.CharField(max_length=50)
+
+    def __unicode__(self):
+        return self.name
+
+    class Meta:
+        ordering = ['name']
+
+tagging.register(Widget, generic_relation_attr='tagged_items')
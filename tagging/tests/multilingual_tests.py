@@ -69,3 +69,27 @@ if settings.MULTILINGUAL_TAGS:
             self.assertEqual(default_name, t.name_en)
             self.assertEqual(None,         t.name_ru)
 
+
+        def testNamesAreLoadedInBulk(self):
+            from django.conf import settings as django_settings
+            from django.db import connection
+
+            parrot = Parrot.objects.create(state='dead')
+            Tag.objects.update_tags(parrot, ' '.join(['tag%d' % i for i in range(10)]))
+            set_default_language('ru')
+            debug = django_settings.DEBUG
+            django_settings.DEBUG = True
+            try:
+                connection.queries = []
+                names = [tag.name for tag in Tag.objects.usage_for_model(Parrot)]
+                usage_queries = len(connection.queries)
+                connection.queries = []
+                names = [tag.name for tag in Tag.objects.get_for_object(parrot)]
+                object_queries = len(connection.queries)
+            finally:
+                django_settings.DEBUG = debug
+                set_default_language(settings.DEFAULT_LANGUAGE)
+            # The tags only have names in the fallback language.
+            self.assertEqual(10, len([name for name in names if name]))
+            self.assertTrue(usage_queries <= 3, usage_queries)
+            self.assertTrue(object_queries <= 2, object_queries)
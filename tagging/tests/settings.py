@@ -5,6 +5,8 @@ DEFAULT_CHARSET = 'utf-8'
 
 DATABASE_ENGINE = 'sqlite3'
 DATABASE_NAME = os.path.join(DIRNAME, 'tagging_test.sqlite')
+# A file rather than memory, so that tests can use several threads.
+TEST_DATABASE_NAME = os.path.join(DIRNAME, 'tagging_test_db.sqlite')
 
 #DATABASE_ENGINE = 'mysql'
 #DATABASE_NAME = 'tagging_test'
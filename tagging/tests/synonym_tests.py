@@ -32,6 +32,13 @@ class TestItemWithCallback( models.Model ):
     def __unicode__(self):
         return self.title
 
+class TestItemWithDeferredCallback( models.Model ):
+    title = models.CharField( _('Title'), max_length = 30)
+    tags = TagField(create_synonyms = create_synonyms, defer_synonyms = True)
+
+    def __unicode__(self):
+        return self.title
+
 class TaggingTestCase(unittest.TestCase):
     def setUp(self):
         TestItem.objects.all().delete()
@@ -276,3 +283,84 @@ world; en: world''', Tag.objects.dumpAsText())
         self.assertEqual(1, len(objs))
         self.assertEqual('Test callbacks', objs[0].title)
 
+
+    def testResolveSynonymsInSQL(self):
+        hello = Tag.objects.create(name='hello')
+        Synonym.objects.create(name='aloha', tag=hello)
+        self.first.tags = 'hello, world'
+        self.second.tags = 'world'
+        self.saveAll()
+
+        objs = TaggedItem.objects.get_by_model(TestItem, 'aloha', resolve_synonyms=True)
+        self.assertEquals([self.first], list(objs))
+        objs = TaggedItem.objects.get_by_model(TestItem, ['aloha', 'world'], resolve_synonyms=True)
+        self.assertEquals([self.first], list(objs))
+        # A name matching neither a tag nor a synonym isn't ignored
+        objs = TaggedItem.objects.get_intersection_by_model(TestItem, ['aloha', 'nothing'],
+                                                            resolve_synonyms=True)
+        self.assertEquals([], list(objs))
+        objs = TaggedItem.objects.get_union_by_model(TestItem, ['aloha', 'world'],
+                                                     resolve_synonyms=True)
+        self.assertEquals(set([self.first, self.second]), set(objs))
+
+    def testResolveSynonymsOfStringInOneQuery(self):
+        from django.conf import settings as django_settings
+        from django.db import connection
+
+        hello = Tag.objects.create(name='hello')
+        Synonym.objects.create(name='aloha', tag=hello)
+        self.first.tags = 'hello, world'
+        self.second.tags = 'world'
+        self.saveAll()
+
+        list(TaggedItem.objects.get_by_model(TestItem, 'world'))
+        debug = django_settings.DEBUG
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            objs = list(TaggedItem.objects.get_by_model(TestItem, 'aloha world',
+                                                        resolve_synonyms=True))
+            queries = len(connection.queries)
+        finally:
+            django_settings.DEBUG = debug
+        self.assertEquals([self.first], objs)
+        self.assertEquals(1, queries)
+
+    def testDeferredSynonymCreation(self):
+        from django.core.signals import request_started, request_finished
+        from tagging import settings
+
+        workers = settings.TAG_JOB_WORKERS
+        settings.TAG_JOB_WORKERS = 0
+        try:
+            request_started.send(sender=self.__class__)
+            TestItemWithDeferredCallback(title='Deferred', tags='Some Tag, Other').save()
+            TestItemWithDeferredCallback(title='Deferred too', tags='Other').save()
+            self.assertEqual(0, Synonym.objects.count())
+            request_finished.send(sender=self.__class__)
+        finally:
+            settings.TAG_JOB_WORKERS = workers
+        self.assertEqual([u'other', u'some-tag'],
+                         [s.name for s in Synonym.objects.all()])
+        self.assertEqual(u'Some Tag', Synonym.objects.get(name='some-tag').tag.name)
+
+    def testDeferredSynonymsAreFlushedOutsideRequests(self):
+        from tagging import settings
+        from tagging.fields import _pending_synonyms
+
+        workers = settings.TAG_JOB_WORKERS
+        settings.TAG_JOB_WORKERS = 0
+        try:
+            TestItemWithDeferredCallback(title='Deferred', tags='Some Tag').save()
+        finally:
+            settings.TAG_JOB_WORKERS = workers
+        self.assertEqual([], _pending_synonyms())
+        self.assertEqual([u'some-tag'], [s.name for s in Synonym.objects.all()])
+
+    def testAddSynonymsSkipsExistingOnes(self):
+        tag = Tag.objects.create(name='hello')
+        Synonym.objects.create(name='aloha', tag=tag)
+        self.assertEqual(1, Synonym.objects.add_synonyms(
+            {'hello': ['aloha', 'privet'], 'missing': ['nope']}))
+        self.assertEqual([u'aloha', u'privet'],
+                         [s.name for s in tag.synonyms.all()])
@@ -31,13 +31,15 @@ def replace_synonyms(tag_list):
     words.sort()
     return words
 
-def parse_tag_input(input):
+def parse_tag_input(input, synonyms=True):
     """
     Parses tag input, with multiple word input being activated and
     delineated by commas and double quotes. Quotes take precedence, so
     they may contain commas.
 
-    Returns a sorted list of unique tag names.
+    Returns a sorted list of unique tag names. Synonyms are replaced by
+    the names of their tags unless ``synonyms`` is ``False``, which
+    saves a query per name.
     """
     if not input:
         return []
@@ -48,7 +50,7 @@ def parse_tag_input(input):
     # input, we don't *do* a recall... I mean, we know we only need to
     # split on spaces.
     if u',' not in input and u'"' not in input:
-        return replace_synonyms(split_strip(input, u' '))
+        return _unique_names(split_strip(input, u' '), synonyms)
 
     words = []
     buffer = []
@@ -95,7 +97,14 @@ def parse_tag_input(input):
             delimiter = u' '
         for chunk in to_be_split:
             words.extend(split_strip(chunk, delimiter))
-    return replace_synonyms(words)
+    return _unique_names(words, synonyms)
+
+def _unique_names(words, synonyms):
+    if synonyms:
+        return replace_synonyms(words)
+    words = list(set(words))
+    words.sort()
+    return words
 
 def split_strip(input, delimiter=u','):
     """
@@ -140,6 +149,16 @@ def edit_string_for_tags(tags):
         glue = settings.FORCE_TAG_DELIMITER
     return glue.join(names)
 
+def format_tag_ids(tag_ids):
+    """
+    Formats the given tag ids for storage in a ``TagIdsField``: sorted,
+    without duplicates and delimited by commas, with a leading and a
+    trailing comma, so that every id is enclosed in commas.
+    """
+    if not tag_ids:
+        return ''
+    return ',%s,' % ','.join([str(tag_id) for tag_id in sorted(set(tag_ids))])
+
 def get_queryset_and_model(queryset_or_model):
     """
     Given a ``QuerySet`` or a ``Model``, returns a two-tuple of
@@ -205,6 +224,27 @@ def get_tag_list(tags):
     else:
         raise ValueError(_('The tag input given was invalid.'))
 
+def get_tag_names(tags):
+    """
+    Returns the list of tag names given as a string, which may contain
+    multiple tag names, or as a list or tuple of strings. Returns
+    ``None`` for any other tag input, such as ``Tag`` objects or ids.
+    Synonyms are left as they are, to be resolved by the queries using
+    the names.
+    """
+    if isinstance(tags, types.StringTypes):
+        return parse_tag_input(tags, synonyms=False)
+    if isinstance(tags, (types.ListType, types.TupleType)) and tags:
+        names = []
+        for item in tags:
+            if not isinstance(item, types.StringTypes):
+                return None
+            item = force_unicode(item)
+            if item not in names:
+                names.append(item)
+        return names
+    return None
+
 def get_tag(tag):
     """
     Utility function for accepting single tag input in a flexible
@@ -300,6 +340,7 @@ def merge(to_tag, from_tag, ctype = None):
         to_items = to_items.filter(content_type = ctype)
 
     to_obj_ids = [item.object_id for item in to_items]
+    moved_ctypes = set()
 
     for item in from_items:
         if item.object_id in to_obj_ids:
@@ -308,10 +349,16 @@ def merge(to_tag, from_tag, ctype = None):
         else:
             item.tag = to_tag
             item.save()
+            moved_ctypes.add(item.content_type_id)
             logger.debug('item "%s" merged' % item)
 
         _update_objects_tags(item.object)
 
+    # Saving moved items only marks the target tag's lists as changed.
+    from tagging.models import TagStamp
+    for content_type_id in moved_ctypes:
+        TagStamp.objects.touch(from_tag, content_type_id, create=False)
+
     if from_tag.items.count() == 0:
         from_tag.delete()
         try:
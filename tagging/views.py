@@ -3,13 +3,16 @@ Tagging related views.
 """
 from django.http import Http404
 from django.utils.translation import ugettext as _
+from django.views.decorators.http import condition
 from django.views.generic.list_detail import object_list
 
-from tagging.models import Tag, TaggedItem
+from tagging.models import Tag, TaggedItem, TagStamp
+from tagging.pagination import tagged_keyset_page
 from tagging.utils import get_tag, get_queryset_and_model
 
 def tagged_object_list(request, queryset_or_model=None, tag=None,
-        related_tags=False, related_tag_counts=True, **kwargs):
+        related_tags=False, related_tag_counts=True, conditional=False,
+        keyset=False, **kwargs):
     """
     A thin wrapper around
     ``django.views.generic.list_detail.object_list`` which creates a
@@ -25,6 +28,23 @@ def tagged_object_list(request, queryset_or_model=None, tag=None,
     Additionally, if ``related_tag_counts`` is ``True``, each related
     tag will have a ``count`` attribute indicating the number of items
     which have it in addition to the given tag.
+
+    If ``conditional`` is ``True``, the response will carry ``ETag``
+    and ``Last-Modified`` headers based on the tag's ``TagStamp`` for
+    the given model, and a conditional ``GET`` of an unchanged list
+    will be answered with ``304 Not Modified`` without running the
+    listing queries. Only changes of tag associations are tracked, so
+    this is suitable for lists which don't display frequently edited
+    fields of the objects. It's ignored if ``related_tags`` is ``True``,
+    since related tags also change with the other tags of the objects.
+
+    If ``keyset`` is ``True``, objects are paginated by primary key
+    instead of by page number: a page holds ``paginate_by`` objects
+    following the one whose primary key is given in the ``after``
+    ``GET`` parameter. The ``page_obj`` context variable then contains a
+    ``tagging.pagination.KeysetPage``, whose ``next_after`` should be
+    used to link to the next page and whose ``count`` is the cached total
+    number of tagged objects.
     """
     if queryset_or_model is None:
         try:
@@ -41,12 +61,42 @@ def tagged_object_list(request, queryset_or_model=None, tag=None,
     tag_instance = get_tag(tag)
     if tag_instance is None:
         raise Http404(_('No Tag found matching "%s".') % tag)
-    queryset = TaggedItem.objects.get_by_model(queryset_or_model, tag_instance)
-    if not kwargs.has_key('extra_context'):
-        kwargs['extra_context'] = {}
-    kwargs['extra_context']['tag'] = tag_instance
-    if related_tags:
-        kwargs['extra_context']['related_tags'] = \
-            Tag.objects.related_for_model(tag_instance, queryset_or_model,
-                                          counts=related_tag_counts)
-    return object_list(request, queryset, **kwargs)
+
+    def list_view(request):
+        queryset = TaggedItem.objects.get_by_model(queryset_or_model, tag_instance)
+        if not kwargs.has_key('extra_context'):
+            kwargs['extra_context'] = {}
+        kwargs['extra_context']['tag'] = tag_instance
+        if related_tags:
+            kwargs['extra_context']['related_tags'] = \
+                Tag.objects.related_for_model(tag_instance, queryset_or_model,
+                                              counts=related_tag_counts)
+        if keyset:
+            try:
+                page = tagged_keyset_page(queryset_or_model, tag_instance,
+                    after=request.GET.get('after') or None,
+                    per_page=kwargs.pop('paginate_by', None))
+            except (TypeError, ValueError):
+                raise Http404(_('Invalid "after" parameter.'))
+            if not page.object_list and not kwargs.pop('allow_empty', True):
+                raise Http404(_('Empty list and "allow_empty" is False.'))
+            # ``object_list`` applies the extra context last, so the page
+            # replaces its own unpaginated list.
+            kwargs['extra_context'].update({
+                '%s_list' % kwargs.get('template_object_name', 'object'): page.object_list,
+                'paginator': None,
+                'page_obj': page,
+                'is_paginated': page.has_other_pages(),
+            })
+        return object_list(request, queryset, **kwargs)
+
+    if conditional and not related_tags:
+        stamp = TagStamp.objects.get_for(tag_instance, queryset_or_model)
+        if stamp is not None:
+            etag = stamp.etag(request.GET.urlencode(), related_tags,
+                              related_tag_counts)
+            list_view = condition(
+                etag_func=lambda request: etag,
+                last_modified_func=lambda request: stamp.modified,
+            )(list_view)
+    return list_view(request)